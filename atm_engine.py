@@ -0,0 +1,784 @@
+import json
+import logging
+import re
+import sqlite3
+import time
+import uuid
+from decimal import Decimal, ROUND_HALF_UP
+from typing import NamedTuple
+
+from balance_cache import balance_cache
+from cash import NoteCount, dispense
+from db_pool import PoolExhaustedError, all_pools, get_pool
+from currencies import CURRENCY_RULES
+from exchange import RateTable, RateTableError, exchange_rates
+from limits import limiter
+from pin_hash import pin_hasher
+
+
+logger = logging.getLogger(__name__)
+
+
+class ATMError(Exception):
+    '''Базовая ошибка операции банкомата. Текст ошибки - причина для пользователя'''
+
+
+class CardNotFoundError(ATMError):
+    '''Карты с таким номером нет в базе'''
+
+
+class CardBlockedError(ATMError):
+    '''Карта заблокирована'''
+
+
+class WrongPinError(ATMError):
+    '''Неверный пин-код. tries_left - оставшиеся попытки, 0 - карта только что заблокирована'''
+
+    def __init__(self, tries_left: int):
+        super().__init__('Введен некорректный пин-код.')
+        self.tries_left = tries_left
+
+
+class AccountNotFoundError(ATMError):
+    '''У карты нет счета в выбранной валюте'''
+
+
+class InsufficientFundsError(ATMError):
+    '''На счете недостаточно средств'''
+
+
+class InvalidAmountError(ATMError):
+    '''Сумма операции вне допустимых пределов или не кратна номиналу купюр'''
+
+
+class CashUnavailableError(ATMError):
+    '''В кассетах банкомата нет купюр, которыми можно выдать сумму'''
+
+
+class LimitExceededError(ATMError):
+    '''Превышен суточный лимит снятия или частота операций (limits.py)'''
+
+
+class DepositConflictError(ATMError):
+    '''Deposit_id уже использован для другого внесения'''
+
+
+class ExchangeUnavailableError(ATMError):
+    '''Курсы валют не загружены, операции с обменом недоступны'''
+
+
+# Балансы и суммы хранятся в целых минимальных единицах: 1 RUB = 10000 единиц, точность 0.0001
+MINOR_UNITS = 10000
+
+
+def to_minor(value: int | float | Decimal | str) -> int:
+    '''Сумма в минимальных единицах, лишние знаки после 4-го округляются'''
+    minor = Decimal(str(value)) * MINOR_UNITS
+    return int(minor.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def parse_amount(text: str) -> int:
+    '''Разбор суммы, введенной пользователем, в минимальные единицы без потери точности'''
+    if not re.fullmatch(r'\d+(\.\d+)?', text):
+        raise InvalidAmountError('Некорректная сумма')
+    minor = Decimal(text) * MINOR_UNITS
+    if minor != minor.to_integral_value():
+        raise InvalidAmountError('Некорректное значение, после точки не может быть более 4 цифр')
+    return int(minor)
+
+
+def format_amount(minor: int) -> str:
+    '''Сумма для вывода: 105000 -> "10.5", 100000 -> "10"'''
+    units, fraction = divmod(minor, MINOR_UNITS)
+    if fraction == 0:
+        return str(units)
+    return f'{units}.{fraction:04d}'.rstrip('0')
+
+
+class Balance(dict):
+    '''Балансы карты: валюта -> баланс в минимальных единицах. Валюты без счета в словаре нет.
+    Значение может лежать в кэше и быть общим для нескольких вызовов - не изменяется на месте'''
+
+
+class OperationResult(NamedTuple):
+    '''Результат успешной денежной операции, суммы в минимальных единицах'''
+    card_number: int
+    currency: str
+    amount: int
+    balance: int  # Баланс карты в валюте операции после нее
+    notes: dict | None = None  # Купюры {номинал: число}: выданные из кассет банкомата или принятые при внесении
+
+
+class ExchangeResult(NamedTuple):
+    '''Результат операции с обменом. currency, amount, balance - списание со счета карты,
+    to_currency, to_amount - зачисленная получателю или выданная наличными сумма'''
+    card_number: int
+    currency: str
+    amount: int
+    balance: int
+    to_currency: str
+    to_amount: int
+    notes: dict | None = None
+
+
+class HistoryEntry(NamedTuple):
+    '''Запись журнала операций'''
+    tx_id: int
+    ts: int  # Микросекунды с начала эпохи Unix
+    kind: str  # withdraw, deposit, transfer_out, transfer_in, transfer_refund (возврат перевода между шардами)
+    currency: str
+    amount: int  # Со знаком: списания отрицательные
+    balance: int  # Баланс в валюте операции после нее
+    counterparty: int | None  # Карта второй стороны перевода
+
+
+class Session:
+    '''Вход по карте, выполненный authenticate. balance - строка счета, прочитанная при входе
+    и обновляемая результатами своих операций, чтобы меню не читало базу заново'''
+
+    def __init__(self, card_number: int, balance: Balance):
+        self.card_number = card_number
+        self.balance = balance
+
+    def apply(self, result: 'OperationResult') -> None:
+        '''Учет баланса после операции этой сессии'''
+        self.balance = Balance(self.balance, **{result.currency: result.balance})
+
+
+class HistoryPage(NamedTuple):
+    '''Страница истории. next_since передается в следующий вызов get_history, None - записей больше нет'''
+    entries: list
+    next_since: tuple | None
+
+
+def _journal(db, card_number: int, kind: str, currency: str, amount: int, balance: int,
+             counterparty: int | None = None) -> None:
+    '''Запись в журнал операций. Вызывается в той же транзакции, что и изменение баланса'''
+    db.query('journal_insert', (card_number, time.time_ns() // 1000, kind, currency, amount, balance, counterparty))
+
+
+class ATMEngine:
+    '''Операции банкомата без ввода-вывода: возвращают результаты, при ошибке - исключения ATMError.
+    Все суммы - целые минимальные единицы (см. MINOR_UNITS)'''
+
+    @staticmethod
+    def card_exists(card_number: int) -> bool:
+        '''Проверка наличия карты в БД'''
+        db = get_pool(card_number).connection()
+        row = db.query('card_exists', (card_number,)).fetchone()
+        return row != None
+
+
+    @staticmethod
+    def authenticate(card_number: int, pin: str, atm_id: int | None = None,
+                     terminal: int | str | None = None) -> 'Session':
+        '''Вход по карте и пин-коду, 3 попытки до блокировки карты. Возвращает сессию со строкой счета.
+        Неизвестная карта - CardNotFoundError, неверный пин-код - WrongPinError, блокировка - CardBlockedError.
+        atm_id - терминал: слишком много неверных пин-кодов с него - LimitExceededError.
+        terminal - ключ лимитов терминала вместо atm_id, например адрес подключения терминала без номера'''
+        if terminal == None:
+            terminal = atm_id
+        if not limiter.pin_allowed(terminal):
+            raise LimitExceededError('Слишком много неверных пин-кодов на банкомате, повторите позже.')
+        # Статус, пин-код, попытки и счета - один запрос по ключам карты, без транзакции записи
+        rows = get_pool(card_number).connection().query('login', (card_number,)).fetchall()
+        if not rows:
+            raise CardNotFoundError('Введен неизвестный номер карты.')
+        status, pin_code, pin_hash, tries = rows[0][:4]
+        if status == 'blocked':
+            raise CardBlockedError('Карта заблокирована.')
+
+        if pin_hash != None:
+            correct = pin_hasher.verify(pin, pin_hash)
+        else:
+            correct = pin == str(pin_code)  # Карта еще не перехэширована, см. pin_hash.rehash_pins
+        if correct:
+            new_hash = None
+            if pin_hash == None or pin_hasher.needs_rehash(pin_hash):
+                new_hash = pin_hasher.hash(pin)  # Хэш считается до транзакции, блокировка записи не ждет KDF
+            if tries < 3 or new_hash != None:  # Иначе запись не нужна, это обычный случай
+                get_pool(card_number).run_in_transaction(ATMEngine._pin_success, card_number, tries, new_hash)
+            return Session(card_number, Balance((row[4], row[5]) for row in rows if row[4] != None))
+        limiter.pin_failed(terminal)
+        # Уменьшение счетчика попыток должно сохраниться, поэтому ошибка поднимается после commit
+        tries_left = get_pool(card_number).run_in_transaction(ATMEngine._pin_attempt, card_number, 'pin_failure')
+        raise WrongPinError(tries_left)
+
+
+    @staticmethod
+    def _pin_success(db, card_number: int, tries: int, new_hash: str | None) -> None:
+        if tries < 3:
+            ATMEngine._pin_attempt(db, card_number, 'pin_success')
+        if new_hash != None:
+            db.query('set_pin_hash', (new_hash, card_number))
+
+
+    @staticmethod
+    def _pin_attempt(db, card_number: int, query: str) -> int:
+        '''Одно условное обновление счетчика попыток. Возвращает оставшиеся попытки'''
+        # Счетчик меняется относительно текущего значения в базе, поэтому параллельные входы не теряют попытки
+        row = db.query(query, (card_number,)).fetchone()
+        if row == None:
+            raise CardBlockedError('Карта заблокирована.')  # Заблокирована другим терминалом после чтения
+        return row[0]
+
+
+    @staticmethod
+    def get_balance(card_number: int) -> Balance:
+        '''Балансы карты по всем валютам. Читаются через кэш balance_cache'''
+        return balance_cache.get(get_pool(card_number).connection(), card_number, ATMEngine._load_balance)
+
+
+    @staticmethod
+    def _load_balance(card_number: int) -> Balance:
+        db = get_pool(card_number).connection()
+        rows = db.query('balance_by_card', (card_number,)).fetchall()
+        if not rows:
+            raise CardNotFoundError('Пользователя с данным номером карты не существует.')
+        return Balance(row for row in rows if row[0] != None)
+
+
+    @staticmethod
+    def withdraw(card_number: int, currency: str, amount: int, atm_id: int | None = None,
+                 terminal: int | str | None = None) -> OperationResult:
+        '''Снятие наличных. Сумма должна быть в пределах CURRENCY_RULES и кратна номиналу купюр.
+        atm_id - банкомат, из кассет которого выдаются купюры; None - без учета кассет.
+        terminal - ключ лимитов терминала, по умолчанию atm_id (см. authenticate)'''
+        ATMEngine._check_withdraw(currency, amount)
+        balance, notes = ATMEngine._run_withdraw(card_number, currency, amount, currency, amount, atm_id, terminal)
+        return OperationResult(card_number, currency, amount, balance, notes)
+
+
+    @staticmethod
+    def _run_withdraw(card_number: int, currency: str, charge: int, cash_currency: str, cash_amount: int,
+                      atm_id: int | None, terminal: int | str | None) -> tuple:
+        '''Проверка лимитов в памяти и выдача. Сумма неудавшейся выдачи возвращается в суточный лимит'''
+        if terminal == None:
+            terminal = atm_id
+        error = limiter.withdraw(card_number, terminal, cash_currency, cash_amount // MINOR_UNITS)
+        if error != None:
+            raise LimitExceededError(error)
+        pool = get_pool(card_number)
+        try:
+            if atm_id == None or pool is get_pool():
+                result = pool.run_in_transaction(
+                    ATMEngine._withdraw_cash, card_number, currency, charge, cash_currency, cash_amount, atm_id)
+            else:
+                result = ATMEngine._withdraw_sharded(pool, card_number, currency, charge, cash_currency, cash_amount,
+                                                     atm_id)
+        except BaseException:
+            limiter.refund_withdraw(card_number, cash_currency, cash_amount // MINOR_UNITS)
+            raise
+        balance_cache.invalidate(card_number)
+        return result
+
+
+    @staticmethod
+    def _withdraw_cash(db, card_number: int, currency: str, charge: int, cash_currency: str, cash_amount: int,
+                       atm_id: int | None) -> tuple:
+        '''Купюры из кассет и списание со счета в одной транзакции. Возвращает (баланс, купюры)'''
+        notes = None
+        if atm_id != None:
+            notes = ATMEngine._take_notes(db, atm_id, cash_currency, cash_amount)
+        balance = ATMEngine._debit(db, card_number, currency, charge)
+        return balance, notes
+
+
+    @staticmethod
+    def _withdraw_sharded(pool, card_number: int, currency: str, charge: int, cash_currency: str, cash_amount: int,
+                          atm_id: int) -> tuple:
+        '''Выдача по карте из другого шарда: кассеты - в основной базе, счет - в шарде карты. Общей
+        транзакции у двух файлов нет, поэтому выдача - сага с журналом, как перевод (_transfer_between):
+        1. основная база: купюры из кассет и запись Cash_withdrawals (pending) одной транзакцией;
+        2. шард карты: списание и запись Card_withdrawals (debited) одной транзакцией;
+        3. основная база: pending -> done, или returned с возвратом купюр, если списания нет.
+        Выдачу, прерванную после шага 1, доводит recover_transfers. Возвращает (баланс, купюры)'''
+        home = get_pool()
+        withdrawal_id = uuid.uuid4().hex
+        notes = home.run_in_transaction(ATMEngine._take_withdrawal_notes, withdrawal_id, atm_id, card_number,
+                                        cash_currency, cash_amount)
+        try:
+            balance = pool.run_in_transaction(ATMEngine._debit_withdrawal, withdrawal_id, card_number, currency,
+                                              charge)
+        except BaseException:
+            try:
+                ATMEngine._complete_withdrawal(pool, withdrawal_id, card_number)
+            except (sqlite3.Error, PoolExhaustedError):
+                pass  # Шард недоступен: выдача остается pending, купюры вернет восстановление
+            raise
+        try:
+            home.run_in_transaction(ATMEngine._finish_withdrawal, withdrawal_id, 'debited')
+        except (sqlite3.Error, PoolExhaustedError):
+            pass  # Деньги списаны, купюры выдаются: выдачу отметит выполненной восстановление
+        return balance, notes
+
+
+    @staticmethod
+    def _take_withdrawal_notes(db, withdrawal_id: str, atm_id: int, card_number: int, currency: str,
+                               amount: int) -> dict:
+        '''Шаг 1 выдачи по карте другого шарда, транзакция основной базы. Возвращает купюры'''
+        notes = ATMEngine._take_notes(db, atm_id, currency, amount)
+        db.query('cash_withdrawal_insert', (withdrawal_id, atm_id, currency, json.dumps(notes, sort_keys=True),
+                                            card_number, time.time_ns() // 1000))
+        return notes
+
+
+    @staticmethod
+    def _debit_withdrawal(db, withdrawal_id: str, card_number: int, currency: str, amount: int) -> int:
+        '''Шаг 2, транзакция шарда карты. Выдачу, уже отмененную восстановлением, списать нельзя'''
+        if db.query('card_withdrawal_by_id', (withdrawal_id,)).fetchone() != None:
+            raise CashUnavailableError('Выдача отменена, купюры возвращены в кассеты.')
+        balance = ATMEngine._debit(db, card_number, currency, amount)
+        db.query('card_withdrawal_insert', (withdrawal_id, card_number, 'debited', time.time_ns() // 1000))
+        return balance
+
+
+    @staticmethod
+    def _cancel_withdrawal(db, withdrawal_id: str, card_number: int) -> str:
+        '''Транзакция шарда карты: отмена выдачи, если списания по ней еще не было.
+        Возвращает debited или cancelled - в том числе при повторе'''
+        row = db.query('card_withdrawal_by_id', (withdrawal_id,)).fetchone()
+        if row != None:
+            return row[0]
+        db.query('card_withdrawal_insert', (withdrawal_id, card_number, 'cancelled', time.time_ns() // 1000))
+        return 'cancelled'
+
+
+    @staticmethod
+    def _finish_withdrawal(db, withdrawal_id: str, state: str) -> None:
+        '''Шаг 3, транзакция основной базы. Выдача, уже завершенная другим потоком, не меняется'''
+        row = db.query('cash_withdrawal_finish', ('done' if state == 'debited' else 'returned',
+                                                  withdrawal_id)).fetchone()
+        if row == None or state == 'debited':
+            return
+        atm_id, currency, notes = row
+        ATMEngine._return_notes(db, atm_id, currency, {int(note): count for note, count in json.loads(notes).items()})
+
+
+    @staticmethod
+    def _complete_withdrawal(pool, withdrawal_id: str, card_number: int) -> str:
+        '''Шаги 2 и 3 выдачи, прерванной после шага 1: списание, если оно было, иначе отмена и возврат купюр.
+        Возвращает debited или cancelled'''
+        state = pool.run_in_transaction(ATMEngine._cancel_withdrawal, withdrawal_id, card_number)
+        get_pool().run_in_transaction(ATMEngine._finish_withdrawal, withdrawal_id, state)
+        balance_cache.invalidate(card_number)
+        return state
+
+
+    @staticmethod
+    def _take_notes(db, atm_id: int, currency: str, amount: int) -> dict:
+        '''Подбор и списание купюр из кассет внутри транзакции. Возвращает {номинал: число}'''
+        # Транзакция уже держит блокировку записи, поэтому прочитанные остатки кассет не устареют
+        stock = dict(db.query('cassettes', (atm_id, currency)).fetchall())
+        notes = dispense(amount // MINOR_UNITS, stock)
+        if notes == None:
+            raise CashUnavailableError('Банкомат не может выдать эту сумму имеющимися купюрами.')
+        for note, count in notes.items():
+            db.query('take_notes', (count, atm_id, currency, note))
+        return notes
+
+
+    @staticmethod
+    def _return_notes(db, atm_id: int, currency: str, notes: dict) -> None:
+        for note, count in notes.items():
+            db.query('take_notes', (-count, atm_id, currency, note))
+
+
+    @staticmethod
+    def _check_withdraw(currency: str, amount: int) -> None:
+        rules = CURRENCY_RULES[currency]
+        if not rules.withdraw_min * MINOR_UNITS <= amount <= rules.withdraw_max * MINOR_UNITS:
+            raise InvalidAmountError(f'Допускается снятие не менее {rules.withdraw_min} {currency} '
+                                     f'и не более {rules.withdraw_max} {currency} за операцию.')
+        if amount % (rules.withdraw_note * MINOR_UNITS) != 0:
+            raise InvalidAmountError(f'Нет купюр номиналом менее {rules.withdraw_note} {currency} для выдачи.')
+
+
+    @staticmethod
+    def deposit(card_number: int, currency: str, amount: int) -> OperationResult:
+        '''Внесение наличных. Сумма должна быть в пределах CURRENCY_RULES и кратна номиналу купюр'''
+        ATMEngine._check_deposit(currency, amount)
+        balance = get_pool(card_number).run_in_transaction(ATMEngine._credit, card_number, currency, amount)
+        balance_cache.invalidate(card_number)
+        return OperationResult(card_number, currency, amount, balance)
+
+
+    @staticmethod
+    def _check_deposit(currency: str, amount: int) -> None:
+        rules = CURRENCY_RULES[currency]
+        if not rules.deposit_min * MINOR_UNITS <= amount <= rules.deposit_max * MINOR_UNITS:
+            raise InvalidAmountError(f'Сумма вносимых средств не может быть менее {rules.deposit_min} {currency} '
+                                     f'и более {rules.deposit_max} {currency}.')
+        if amount % (rules.deposit_note * MINOR_UNITS) != 0:
+            raise InvalidAmountError(f'Банкомат не принимает купюры номиналом менее {rules.deposit_note} {currency}.')
+
+
+    @staticmethod
+    def deposit_notes(card_number: int, deposit_id: str, count: NoteCount) -> OperationResult:
+        '''Зачисление пересчитанных купюр (cash.count_notes) одной транзакцией.
+
+        deposit_id - идентификатор внесения, который терминал создает до приема купюр и повторяет
+        при повторной отправке. Повтор уже зачисленного внесения возвращает прежний результат
+        и ничего не зачисляет; тот же deposit_id с другими данными - DepositConflictError
+        '''
+        amount = count.total() * MINOR_UNITS
+        ATMEngine._check_deposit(count.currency, amount)
+        balance = get_pool(card_number).run_in_transaction(
+            ATMEngine._deposit_once, card_number, deposit_id, count.currency, amount, count.notes)
+        balance_cache.invalidate(card_number)
+        return OperationResult(card_number, count.currency, amount, balance, count.notes)
+
+
+    @staticmethod
+    def _deposit_once(db, card_number: int, deposit_id: str, currency: str, amount: int, notes: dict) -> int:
+        '''Зачисление и запись внесения, если deposit_id еще не встречался. Возвращает баланс после внесения'''
+        notes_json = json.dumps(notes, sort_keys=True)
+        row = db.query('deposit_by_id', (deposit_id,)).fetchone()
+        if row != None:
+            if row[:4] != (card_number, currency, amount, notes_json):
+                raise DepositConflictError('Внесение с таким идентификатором уже выполнено с другими данными.')
+            return row[4]
+        balance = ATMEngine._credit(db, card_number, currency, amount)
+        db.query('deposit_insert', (deposit_id, card_number, currency, amount, notes_json, balance,
+                                    time.time_ns() // 1000))
+        return balance
+
+
+    @staticmethod
+    def _debit(db, card_number: int, currency: str, amount: int) -> int:
+        '''Условное списание внутри транзакции. Возвращает новый баланс'''
+        row = db.query('debit', (amount, card_number, currency, amount)).fetchone()
+        if row == None:
+            ATMEngine._raise_missing(db, card_number, currency)
+            raise InsufficientFundsError('На балансе недостаточно средств для данной операции.')
+        _journal(db, card_number, 'withdraw', currency, -amount, row[0])
+        return row[0]
+
+
+    @staticmethod
+    def _credit(db, card_number: int, currency: str, amount: int) -> int:
+        '''Зачисление внутри транзакции. Возвращает новый баланс'''
+        row = db.query('credit', (amount, card_number, currency)).fetchone()
+        if row == None:
+            ATMEngine._raise_missing(db, card_number, currency)
+        _journal(db, card_number, 'deposit', currency, amount, row[0])
+        return row[0]
+
+
+    @staticmethod
+    def _raise_missing(db, card_number: int, currency: str) -> None:
+        '''Ошибка, если карты или счета в валюте нет. Вызывается только после неудачного UPDATE'''
+        if db.query('account', (card_number, currency)).fetchone() != None:
+            return
+        if db.query('card_exists', (card_number,)).fetchone() == None:
+            raise CardNotFoundError('Пользователя с данным номером карты не существует.')
+        raise AccountNotFoundError(f'На карте нет счета в {currency}.')
+
+
+    @staticmethod
+    def _transfer(db, card_number: int, recipient_card: int, currency: str, amount: int) -> int:
+        '''Перевод внутри уже открытой транзакции записи. При ошибке ничего не изменяется'''
+        ATMEngine._check_transfer(card_number, recipient_card, amount)
+
+        # Одно чтение обоих счетов. Под BEGIN IMMEDIATE они не изменятся до конца транзакции
+        accounts = dict(db.query('pair_accounts', (card_number, recipient_card, currency)).fetchall())
+        if recipient_card not in accounts:
+            if db.query('card_exists', (recipient_card,)).fetchone() == None:
+                raise CardNotFoundError('Пользователя с данным номером карты не существует.')
+            raise AccountNotFoundError(f'У получателя нет счета в {currency}.')
+        if card_number not in accounts:
+            raise AccountNotFoundError(f'У отправителя нет счета в {currency}.')
+
+        # Списание условное: баланс проверяется в момент записи
+        row = db.query('debit', (amount, card_number, currency, amount)).fetchone()
+        if row == None:
+            raise InsufficientFundsError('На балансе недостаточно средств для перевода данной суммы.')
+        recipient_row = db.query('credit', (amount, recipient_card, currency)).fetchone()
+        _journal(db, card_number, 'transfer_out', currency, -amount, row[0], recipient_card)
+        _journal(db, recipient_card, 'transfer_in', currency, amount, recipient_row[0], card_number)
+        return row[0]
+
+
+    @staticmethod
+    def _check_transfer(card_number: int, recipient_card: int, amount: int) -> None:
+        if card_number == recipient_card:
+            raise InvalidAmountError('Невозможно осуществить перевод самому себе.')
+        if not isinstance(amount, int) or amount <= 0:
+            raise InvalidAmountError('Сумма перевода должна быть целым положительным числом минимальных единиц.')
+
+
+    @staticmethod
+    def transfer(card_number: int, recipient_card: int, currency: str, amount: int) -> OperationResult:
+        '''Перевод amount в валюте currency с карты card_number на recipient_card одной транзакцией.
+        Если карты в разных шардах - сагой с журналом, см. _transfer_between'''
+        pool = get_pool(card_number)
+        if pool is not get_pool(recipient_card):
+            balance = ATMEngine._transfer_between(card_number, recipient_card, currency, amount, currency, amount)
+            return OperationResult(card_number, currency, amount, balance)
+        balance = pool.run_in_transaction(ATMEngine._transfer, card_number, recipient_card, currency, amount)
+        balance_cache.invalidate(card_number, recipient_card)
+        return OperationResult(card_number, currency, amount, balance)
+
+
+    @staticmethod
+    def _transfer_between(card_number: int, recipient_card: int, currency: str, amount: int, to_currency: str,
+                          credited: int) -> int:
+        '''Перевод между шардами. Общей транзакции у двух файлов нет, поэтому перевод - сага:
+        1. шард отправителя: списание и запись Outgoing_transfers (pending) одной транзакцией;
+        2. шард получателя: зачисление и запись Incoming_transfers (credited) или только запись (rejected);
+        3. шард отправителя: pending -> done, или refunded с возвратом денег отправителю.
+        Шаги 2 и 3 идемпотентны, поэтому перевод, прерванный после шага 1, доводит recover_transfers.
+        Возвращает баланс отправителя; отклоненный получателем перевод - AccountNotFoundError после возврата'''
+        ATMEngine._check_transfer(card_number, recipient_card, amount)
+        # Проверка до списания: обычные ошибки получателя не доходят до возврата денег
+        target = get_pool(recipient_card).connection()
+        if target.query('account', (recipient_card, to_currency)).fetchone() == None:
+            if target.query('card_exists', (recipient_card,)).fetchone() == None:
+                raise CardNotFoundError('Пользователя с данным номером карты не существует.')
+            raise AccountNotFoundError(f'У получателя нет счета в {to_currency}.')
+
+        source = get_pool(card_number)
+        transfer_id = uuid.uuid4().hex
+        balance = source.run_in_transaction(ATMEngine._send_transfer, transfer_id, card_number, recipient_card,
+                                            currency, amount, to_currency, credited)
+        balance_cache.invalidate(card_number)
+        try:
+            state = ATMEngine._complete_transfer(source, transfer_id, card_number, recipient_card, to_currency,
+                                                 credited)
+        except (sqlite3.Error, PoolExhaustedError):
+            # Списание уже зафиксировано вместе с записью о переводе: перевод принят, зачисление доведет восстановление
+            return balance
+        if state == 'rejected':
+            raise AccountNotFoundError(f'У получателя нет счета в {to_currency}, деньги возвращены на счет.')
+        return balance
+
+
+    @staticmethod
+    def _send_transfer(db, transfer_id: str, card_number: int, recipient_card: int, currency: str, amount: int,
+                       to_currency: str, credited: int) -> int:
+        '''Шаг 1 перевода между шардами, транзакция шарда отправителя. Возвращает баланс отправителя'''
+        row = db.query('debit', (amount, card_number, currency, amount)).fetchone()
+        if row == None:
+            ATMEngine._raise_missing(db, card_number, currency)
+            raise InsufficientFundsError('На балансе недостаточно средств для перевода данной суммы.')
+        _journal(db, card_number, 'transfer_out', currency, -amount, row[0], recipient_card)
+        db.query('outgoing_insert', (transfer_id, card_number, recipient_card, currency, amount, to_currency, credited,
+                                     time.time_ns() // 1000))
+        return row[0]
+
+
+    @staticmethod
+    def _receive_transfer(db, transfer_id: str, recipient_card: int, card_number: int, currency: str,
+                          amount: int) -> str:
+        '''Шаг 2, транзакция шарда получателя: зачисление не больше одного раза на transfer_id.
+        Возвращает credited или rejected - в том числе при повторе'''
+        row = db.query('incoming_by_id', (transfer_id,)).fetchone()
+        if row != None:
+            return row[0]
+        state = 'rejected'  # Счет получателя исчез после проверки - деньги вернутся отправителю
+        recipient_row = db.query('credit', (amount, recipient_card, currency)).fetchone()
+        if recipient_row != None:
+            _journal(db, recipient_card, 'transfer_in', currency, amount, recipient_row[0], card_number)
+            state = 'credited'
+        db.query('incoming_insert', (transfer_id, recipient_card, state, time.time_ns() // 1000))
+        return state
+
+
+    @staticmethod
+    def _finish_transfer(db, transfer_id: str, state: str) -> None:
+        '''Шаг 3, транзакция шарда отправителя. Перевод, уже завершенный другим потоком, не меняется'''
+        row = db.query('outgoing_finish', ('done' if state == 'credited' else 'refunded', transfer_id)).fetchone()
+        if row == None or state == 'credited':
+            return
+        card_number, recipient_card, currency, amount = row
+        refund_row = db.query('credit', (amount, card_number, currency)).fetchone()
+        if refund_row == None:
+            ATMEngine._raise_missing(db, card_number, currency)  # Перевод остается pending до ручного разбора
+        _journal(db, card_number, 'transfer_refund', currency, amount, refund_row[0], recipient_card)
+
+
+    @staticmethod
+    def _complete_transfer(source, transfer_id: str, card_number: int, recipient_card: int, currency: str,
+                           amount: int) -> str:
+        '''Шаги 2 и 3 перевода между шардами. Возвращает состояние зачисления: credited или rejected'''
+        state = get_pool(recipient_card).run_in_transaction(
+            ATMEngine._receive_transfer, transfer_id, recipient_card, card_number, currency, amount)
+        source.run_in_transaction(ATMEngine._finish_transfer, transfer_id, state)
+        balance_cache.invalidate(card_number, recipient_card)
+        return state
+
+
+    @staticmethod
+    def recover_transfers(min_age: float = 60.0) -> int:
+        '''Завершение переводов и выдач наличных между шардами, которые остались pending дольше min_age
+        секунд (процесс упал или шард был недоступен). Возвращает число доведенных операций.
+        Ошибка одной операции или шарда не останавливает остальные: операция остается pending до
+        следующего прохода или ручного разбора, ее идентификатор пишется в лог'''
+        cutoff = time.time_ns() // 1000 - int(min_age * 1_000_000)
+        recovered = 0
+        for index, pool in enumerate(all_pools()):
+            try:
+                db = pool.connection()
+                pending = [(f'перевод {transfer_id}', ATMEngine._complete_transfer,
+                            (pool, transfer_id, card_number, recipient_card, to_currency, credited))
+                           for transfer_id, card_number, recipient_card, _, _, to_currency, credited
+                           in db.query('outgoing_pending', (cutoff,)).fetchall()]
+                # Выдачи журналирует база с кассетами - основная, в остальных шардах таблица пуста
+                pending += [(f'выдача {withdrawal_id}', ATMEngine._complete_withdrawal,
+                             (get_pool(card_number), withdrawal_id, card_number))
+                            for withdrawal_id, card_number
+                            in db.query('cash_withdrawal_pending', (cutoff,)).fetchall()]
+            except (sqlite3.Error, PoolExhaustedError) as error:
+                logger.error('Шард %d недоступен, операции между шардами не доведены: %s', index, error)
+                continue
+            for name, complete, args in pending:
+                try:
+                    complete(*args)
+                except (ATMError, sqlite3.Error, PoolExhaustedError) as error:
+                    logger.error('Не доведена операция %s: %s: %s', name, type(error).__name__, error)
+                    continue
+                recovered += 1
+        return recovered
+
+
+    @staticmethod
+    def rates() -> RateTable:
+        '''Текущая таблица курсов. Операция берет ее один раз и считает по ней до конца'''
+        try:
+            return exchange_rates.current()
+        except RateTableError as error:
+            raise ExchangeUnavailableError('Обмен валют временно недоступен.') from error
+
+
+    @staticmethod
+    def transfer_exchange(card_number: int, recipient_card: int, currency: str, to_currency: str,
+                          amount: int) -> ExchangeResult:
+        '''Перевод amount в валюте currency со счета отправителя на счет получателя в to_currency по курсу'''
+        if currency == to_currency:
+            result = ATMEngine.transfer(card_number, recipient_card, currency, amount)
+            return ExchangeResult(result.card_number, currency, amount, result.balance, to_currency, amount)
+        table = ATMEngine.rates()
+        pool = get_pool(card_number)
+        if pool is not get_pool(recipient_card):
+            ATMEngine._check_transfer(card_number, recipient_card, amount)
+            credited = ATMEngine._exchange_amount(table, amount, currency, to_currency)
+            balance = ATMEngine._transfer_between(card_number, recipient_card, currency, amount, to_currency, credited)
+            return ExchangeResult(card_number, currency, amount, balance, to_currency, credited)
+        balance, credited = pool.run_in_transaction(
+            ATMEngine._transfer_exchange, card_number, recipient_card, currency, to_currency, amount, table)
+        balance_cache.invalidate(card_number, recipient_card)
+        return ExchangeResult(card_number, currency, amount, balance, to_currency, credited)
+
+
+    @staticmethod
+    def _transfer_exchange(db, card_number: int, recipient_card: int, currency: str, to_currency: str,
+                           amount: int, table: RateTable) -> tuple:
+        '''Перевод с обменом внутри транзакции записи. Возвращает (баланс отправителя, зачисленная сумма)'''
+        ATMEngine._check_transfer(card_number, recipient_card, amount)
+        credited = ATMEngine._exchange_amount(table, amount, currency, to_currency)
+
+        row = db.query('debit', (amount, card_number, currency, amount)).fetchone()
+        if row == None:
+            ATMEngine._raise_missing(db, card_number, currency)
+            raise InsufficientFundsError('На балансе недостаточно средств для перевода данной суммы.')
+        recipient_row = db.query('credit', (credited, recipient_card, to_currency)).fetchone()
+        if recipient_row == None:
+            # Ошибка откатывает и списание - вся функция выполняется в одной транзакции
+            if db.query('card_exists', (recipient_card,)).fetchone() == None:
+                raise CardNotFoundError('Пользователя с данным номером карты не существует.')
+            raise AccountNotFoundError(f'У получателя нет счета в {to_currency}.')
+        _journal(db, card_number, 'transfer_out', currency, -amount, row[0], recipient_card)
+        _journal(db, recipient_card, 'transfer_in', to_currency, credited, recipient_row[0], card_number)
+        return row[0], credited
+
+
+    @staticmethod
+    def _exchange_amount(table: RateTable, amount: int, currency: str, to_currency: str) -> int:
+        credited = table.convert(amount, currency, to_currency)
+        if credited <= 0:
+            raise InvalidAmountError(f'Сумма слишком мала для перевода в {to_currency}.')
+        return credited
+
+
+    @staticmethod
+    def withdraw_exchange(card_number: int, currency: str, cash_currency: str, cash_amount: int,
+                          atm_id: int | None = None, terminal: int | str | None = None) -> ExchangeResult:
+        '''Выдача наличных cash_currency со списанием со счета в currency по курсу.
+        Сумма выдачи проверяется по правилам CURRENCY_RULES для cash_currency'''
+        ATMEngine._check_withdraw(cash_currency, cash_amount)
+        charge = cash_amount
+        if currency != cash_currency:
+            charge = ATMEngine.rates().convert(cash_amount, cash_currency, currency, round_up=True)
+        balance, notes = ATMEngine._run_withdraw(card_number, currency, charge, cash_currency, cash_amount, atm_id,
+                                                 terminal)
+        return ExchangeResult(card_number, currency, charge, balance, cash_currency, cash_amount, notes)
+
+
+    @staticmethod
+    def transfer_many(transfers, chunk_size: int = 1000) -> list:
+        '''Пакетные переводы (например, из файла расчетов): итерируемый набор
+        (card_number, recipient_card, currency, amount). Каждая пачка - одна транзакция.
+        Возвращает [(номер перевода, OperationResult или ATMError), ...]
+        '''
+        def run_chunk(db, chunk):
+            chunk_results = []
+            for index, item in chunk:
+                try:
+                    balance = ATMEngine._transfer(db, *item)
+                    chunk_results.append((index, OperationResult(item[0], item[2], item[3], balance)))
+                except ATMError as error:
+                    # Неудачный перевод ничего не меняет, остальные переводы пачки продолжаются
+                    chunk_results.append((index, error))
+            return chunk_results
+
+        results = []
+        chunk = []
+        for index, item in enumerate(transfers):
+            chunk.append((index, tuple(item)))
+            if len(chunk) >= chunk_size:
+                results.extend(ATMEngine._run_transfer_chunk(run_chunk, chunk))
+                chunk = []
+        if chunk:
+            results.extend(ATMEngine._run_transfer_chunk(run_chunk, chunk))
+        return results
+
+
+    @staticmethod
+    def _run_transfer_chunk(run_chunk, chunk: list) -> list:
+        '''Пачка переводов: по транзакции на шард для переводов внутри шарда, между шардами - по одному'''
+        groups = {}  # Пул -> переводы пачки внутри его шарда
+        chunk_results = []
+        for index, item in chunk:
+            pool = get_pool(item[0])
+            if pool is get_pool(item[1]):
+                groups.setdefault(pool, []).append((index, item))
+                continue
+            try:
+                balance = ATMEngine._transfer_between(item[0], item[1], item[2], item[3], item[2], item[3])
+                chunk_results.append((index, OperationResult(item[0], item[2], item[3], balance)))
+            except ATMError as error:
+                chunk_results.append((index, error))
+        for pool, items in groups.items():
+            chunk_results.extend(pool.run_in_transaction(run_chunk, items))
+            balance_cache.invalidate(*{card for _, item in items for card in item[:2]})
+        chunk_results.sort(key=lambda result: result[0])
+        return chunk_results
+
+
+    @staticmethod
+    def get_history(card_number: int, since: int | tuple | None = None, limit: int = 50) -> HistoryPage:
+        '''История операций карты по возрастанию времени, не более limit записей.
+
+        since - None (с начала), время в микросекундах (записи не раньше него)
+        или next_since предыдущей страницы. Пагинация по ключу (Ts, TxID) вместо OFFSET:
+        каждая страница - один проход по индексу Transactions_card_ts с нужного места
+        '''
+        if since == None:
+            since = (-1, 0)
+        elif isinstance(since, int):
+            since = (since, 0)  # TxID всегда больше 0, поэтому (Ts, TxID) > (since, 0) - это Ts >= since
+        db = get_pool(card_number).connection()
+        rows = db.query('history_page', (card_number, since[0], since[1], limit)).fetchall()
+        entries = [HistoryEntry(*row) for row in rows]
+        next_since = (entries[-1].ts, entries[-1].tx_id) if len(entries) == limit else None
+        return HistoryPage(entries, next_since)
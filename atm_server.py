@@ -0,0 +1,282 @@
+'''Сервер банкомата на asyncio: много терминалов на одном процессе.
+
+Протокол - JSON-строки, одна строка на запрос и ответ:
+    {"op": "card", "card": 1234, "atm": 1}   (atm - банкомат терминала: выдача из его кассет, необязательно)
+    {"op": "pin", "pin": "1111"}
+    {"op": "balance"}
+    {"op": "withdraw", "currency": "RUB", "amount": 500}
+    {"op": "deposit", "currency": "USD", "amount": 50}
+    {"op": "deposit", "currency": "RUB", "deposit_id": "<uuid>", "notes": [1000, 1000, 500]}
+        (купюры от модуля приема; повтор с тем же deposit_id не зачисляет повторно)
+    {"op": "transfer", "to": 2345, "currency": "RUB", "amount": "10.5"}
+    {"op": "transfer", "to": 2345, "currency": "RUB", "to_currency": "USD", "amount": 1000}
+    {"op": "withdraw", "currency": "USD", "from": "RUB", "amount": 50}   (наличные USD со счета RUB)
+    {"op": "quit"}
+Без atm лимиты терминала (частота снятий, неверные пин-коды) считаются по адресу подключения.
+Ответ: {"ok": true, ...} или {"ok": false, "error": "<класс ошибки>", "message": "<причина>"}.
+Ошибка базы данных - "error": "StorageError", соединение при этом не закрывается.
+Суммы в запросах и ответах - строки или числа в единицах валюты, не более 4 знаков после точки.
+
+Запуск: python atm_server.py [--db atm.db | --shards shards.json] [--host 127.0.0.1] [--port 8765]
+                            [--unix путь] [--workers 8]
+                            [--pin-iterations 50000] [--pin-workers N] [--rates rates.json]
+                            [--limits-snapshot limits.json] [--no-limits]
+                            [--metrics-file metrics.prom] [--metrics-port 9108] [--metrics-interval 10]
+'''
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from atm_engine import ATMEngine, ATMError, ExchangeResult, format_amount, parse_amount
+from cash import count_notes
+from currencies import CURRENCIES
+from db_pool import PoolExhaustedError, all_pools, close_all, configure
+from exchange import exchange_rates
+from limits import limiter
+from metrics import metrics
+from pin_hash import DEFAULT_ITERATIONS, pin_hasher
+import shards
+from sql_query import SQLatm
+
+
+class ProtocolError(Exception):
+    '''Некорректный запрос клиента'''
+
+
+class Session:
+    '''Состояние одного подключенного терминала'''
+
+    def __init__(self):
+        self.card_number = None
+        self.atm_id = None  # Без номера банкомата купюры в кассетах не учитываются
+        self.peer = None  # Ключ лимитов терминала без номера банкомата - адрес подключения
+        self.authenticated = False
+
+    def terminal(self) -> int | str:
+        '''Ключ лимитов терминала: номер банкомата, а без него - адрес подключения, иначе лимитов бы не было'''
+        return self.atm_id if self.atm_id != None else self.peer
+
+
+class ATMServer:
+    '''Мультиплексирование сессий терминалов. Работа с базой - в ограниченном пуле потоков'''
+
+    def __init__(self, workers: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='atm-db')
+        # Не больше запросов в работе, чем потоков - остальные ждут, не копя очередь в executor
+        self.slots = asyncio.Semaphore(workers)
+        self.handlers = {
+            'card': self.op_card,
+            'pin': self.op_pin,
+            'balance': self.op_balance,
+            'withdraw': self.op_withdraw,
+            'deposit': self.op_deposit,
+            'transfer': self.op_transfer,
+        }
+
+    async def run_db(self, func, *args):
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session()
+        peer = writer.get_extra_info('peername')
+        # Все терминалы с одного адреса делят лимиты: переподключение не дает новых попыток пин-кода
+        session.peer = f'peer:{peer[0]}' if isinstance(peer, tuple) else 'peer:unix'
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ProtocolError('Запрос должен быть JSON-объектом')
+                    if request.get('op') == 'quit':
+                        break
+                    response = await self.dispatch(session, request)
+                except (ProtocolError, ValueError, KeyError, TypeError) as error:
+                    response = {'ok': False, 'error': 'ProtocolError', 'message': str(error)}
+                except ATMError as error:
+                    response = {'ok': False, 'error': type(error).__name__, 'message': str(error)}
+                    if hasattr(error, 'tries_left'):
+                        response['tries_left'] = error.tries_left
+                except (sqlite3.Error, PoolExhaustedError) as error:
+                    # База недоступна или занята дольше повторов run_in_transaction - сессия терминала остается открытой
+                    response = {'ok': False, 'error': 'StorageError', 'message': str(error)}
+                writer.write(json.dumps(response, ensure_ascii=False).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            pass  # Остановка сервера: сессия просто закрывается, задача клиента на этом заканчивается
+        finally:
+            writer.close()
+
+    async def recover_loop(self, interval: float) -> None:
+        '''Доведение переводов и выдач между шардами, прерванных недоступностью шарда'''
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run_db(ATMEngine.recover_transfers, interval)
+            except (sqlite3.Error, PoolExhaustedError):
+                pass  # Шард все еще недоступен - повторим на следующем шаге
+
+    async def dispatch(self, session: Session, request: dict) -> dict:
+        handler = self.handlers.get(request.get('op'))
+        if handler == None:
+            raise ProtocolError(f'Неизвестная операция: {request.get("op")}')
+        if request['op'] not in ('card', 'pin') and not session.authenticated:
+            raise ProtocolError('Требуется ввод карты и пин-кода')
+        return await handler(session, request)
+
+    async def op_card(self, session: Session, request: dict) -> dict:
+        # Карта проверяется вместе с пин-кодом одним запросом authenticate
+        session.card_number = int(request['card'])
+        session.atm_id = int(request['atm']) if request.get('atm') != None else None
+        session.authenticated = False
+        return {'ok': True}
+
+    async def op_pin(self, session: Session, request: dict) -> dict:
+        if session.card_number == None:
+            raise ProtocolError('Сначала требуется ввод карты')
+        await self.run_db(ATMEngine.authenticate, session.card_number, str(request['pin']), session.atm_id,
+                          session.terminal())
+        session.authenticated = True
+        return {'ok': True}
+
+    async def op_balance(self, session: Session, request: dict) -> dict:
+        balance = await self.run_db(ATMEngine.get_balance, session.card_number)
+        return {'ok': True, 'balance': {currency: format_amount(value) for currency, value in balance.items()}}
+
+    async def op_withdraw(self, session: Session, request: dict) -> dict:
+        if 'from' in request:  # Наличные в currency со списанием со счета в валюте from по курсу
+            result = await self.run_db(ATMEngine.withdraw_exchange, session.card_number,
+                                       currency_of(request, 'from'), currency_of(request), amount_of(request),
+                                       session.atm_id, session.terminal())
+        else:
+            result = await self.run_db(ATMEngine.withdraw, session.card_number, currency_of(request),
+                                       amount_of(request), session.atm_id, session.terminal())
+        return operation_response(result)
+
+    async def op_deposit(self, session: Session, request: dict) -> dict:
+        if 'notes' in request:
+            if not request.get('deposit_id'):
+                raise ProtocolError('Для внесения купюр требуется deposit_id')
+            currency = currency_of(request)
+            count = count_notes(((currency, int(note)) for note in request['notes']), currency)
+            result = await self.run_db(ATMEngine.deposit_notes, session.card_number, str(request['deposit_id']),
+                                       count)
+            response = operation_response(result)
+            response['rejected'] = [{'currency': note_currency, 'note': note, 'count': number}
+                                    for (note_currency, note), number in count.rejected.items()]
+            return response
+        result = await self.run_db(ATMEngine.deposit, session.card_number, currency_of(request),
+                                   amount_of(request))
+        return operation_response(result)
+
+    async def op_transfer(self, session: Session, request: dict) -> dict:
+        if 'to_currency' in request:
+            result = await self.run_db(ATMEngine.transfer_exchange, session.card_number, int(request['to']),
+                                       currency_of(request), currency_of(request, 'to_currency'), amount_of(request))
+        else:
+            result = await self.run_db(ATMEngine.transfer, session.card_number, int(request['to']),
+                                       currency_of(request), amount_of(request))
+        return operation_response(result)
+
+
+def currency_of(request: dict, field: str = 'currency') -> str:
+    currency = str(request[field]).upper()
+    if currency not in CURRENCIES:
+        raise ProtocolError(f'Неизвестная валюта: {currency}')
+    return currency
+
+
+def amount_of(request: dict) -> int:
+    '''Сумма запроса в минимальных единицах. Число берется через str, чтобы не терять точность'''
+    return parse_amount(str(request['amount']))
+
+
+def operation_response(result) -> dict:
+    response = {'ok': True, 'currency': result.currency, 'amount': format_amount(result.amount),
+                'balance': format_amount(result.balance)}
+    if isinstance(result, ExchangeResult):
+        response['to_currency'] = result.to_currency
+        response['to_amount'] = format_amount(result.to_amount)
+    if result.notes:
+        response['notes'] = {str(note): count for note, count in result.notes.items()}
+    return response
+
+
+async def serve(host: str = '127.0.0.1', port: int = 8765, unix_path: str | None = None,
+                workers: int = 8) -> None:
+    server = ATMServer(workers)
+    if unix_path:
+        listener = await asyncio.start_unix_server(server.handle_client, path=unix_path)
+    else:
+        listener = await asyncio.start_server(server.handle_client, host, port)
+    recovery = None
+    if len(all_pools()) > 1:
+        recovery = asyncio.create_task(server.recover_loop(60.0))  # Ссылка держит задачу до конца работы
+    # SIGTERM (systemd, Popen.terminate) завершает serve штатно: main закрывает пулы, лимиты и метрики в finally.
+    # Обработчик ставится до сообщения о запуске: после него сервер уже можно останавливать
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    print(f'ATM server: {unix_path or f"{host}:{port}"}, потоков БД: {workers}, баз: {len(all_pools())}')
+    async with listener:
+        await stop.wait()
+    if recovery != None:
+        recovery.cancel()
+        await asyncio.gather(recovery, return_exceptions=True)  # Начатый шаг в потоке БД дождется executor.shutdown
+    server.executor.shutdown()  # Операции, уже начатые в потоках БД, доходят до commit до закрытия пулов
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Сервер банкомата на asyncio')
+    parser.add_argument('--db', default='atm.db')
+    parser.add_argument('--shards', help='Карта шардов (shards.py) вместо одной базы --db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='Путь к Unix-сокету вместо TCP')
+    parser.add_argument('--workers', type=int, default=8, help='Потоков для работы с базой')
+    parser.add_argument('--pin-iterations', type=int, default=DEFAULT_ITERATIONS, help='Стоимость хэша пин-кода')
+    parser.add_argument('--pin-workers', type=int, default=os.cpu_count(),
+                        help='Процессов для проверки пин-кодов, 0 - в потоках БД')
+    parser.add_argument('--rates', default='rates.json', help='Файл курсов валют')
+    parser.add_argument('--limits-snapshot', default='limits.json', help='Файл снимка суточных лимитов и частоты операций')
+    parser.add_argument('--no-limits', action='store_true', help='Отключить лимиты (нагрузочные тесты)')
+    parser.add_argument('--metrics-file', help='Файл метрик в формате Prometheus, обновляется периодически')
+    parser.add_argument('--metrics-port', type=int, help='Порт HTTP-эндпоинта /metrics')
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help='Период записи файла метрик, с')
+    args = parser.parse_args()
+
+    # WAL: чтения терминалов не ждут записи. Соединений - по одному на поток executor в каждой базе
+    if args.shards != None:
+        shards.configure(args.shards, max_connections=args.workers)
+    else:
+        configure(args.db, max_connections=args.workers, concurrent=True)
+        SQLatm.create_table()  # Новая база получает схему, старая - недостающие миграции (шарды - в shards.configure)
+    # KDF пин-кода - самая дорогая часть входа, она считается в отдельных процессах
+    pin_hasher.configure(args.pin_iterations, args.pin_workers)
+    exchange_rates.configure(args.rates)
+    if not args.no_limits:
+        limiter.configure(enabled=True, snapshot_path=args.limits_snapshot)
+    if args.metrics_file != None or args.metrics_port != None:
+        metrics.configure(enabled=True, path=args.metrics_file, interval=args.metrics_interval,
+                          port=args.metrics_port, host=args.host)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.close()
+        limiter.close()
+        pin_hasher.close()
+        close_all()
+
+
+if __name__ == '__main__':
+    main()
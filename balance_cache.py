@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class BalanceCache:
+    '''Кэш балансов карт в памяти процесса: LRU с ограничением размера и временем жизни записи.
+
+    Записи движка сбрасывают карту явно (invalidate). Изменения из других процессов видны по
+    PRAGMA data_version соединения потока. Версия меняется и от commit соседних потоков этого же
+    процесса, поэтому кэш очищается целиком, только если с прошлой проверки соединения процесс
+    не начинал своих commit. Чужая запись, совпавшая по времени со своей, видна не позже ttl
+    '''
+
+    def __init__(self, max_size: int = 10000, ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()  # card_number -> (время устаревания, баланс)
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Последние data_version, увиденные соединениями потока
+        self._generation = 0  # Растет при каждом сбросе, чтобы не положить в кэш значение, прочитанное до него
+        self._writes = 0  # Записи этого процесса через invalidate и clear - общий счетчик всех потоков
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.clears = 0  # Полные очистки, в том числе по data_version
+
+    def get(self, db, card_number: int, loader):
+        '''Баланс карты из кэша или loader(card_number) с сохранением результата'''
+        self._check_version(db)
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(card_number)
+            if item != None and item[0] > now:
+                self._items.move_to_end(card_number)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = loader(card_number)
+        with self._lock:
+            if generation == self._generation:
+                self._items[card_number] = (now + self.ttl, value)
+                self._items.move_to_end(card_number)
+                if len(self._items) > self.max_size:
+                    self._items.popitem(last=False)  # Вытесняется давно не использованная карта
+        return value
+
+    def _check_version(self, db) -> None:
+        # Версия - своя у каждого соединения потока: при шардировании поток читает разные базы по очереди
+        versions = getattr(self._local, 'versions', None)
+        if versions == None:
+            versions = self._local.versions = {}
+        # Свои commit, завершенные до чтения версии, в ней уже учтены. Если с тех пор процесс не начал
+        # ни одного commit, новая версия - запись другого процесса
+        finished = self._writes + _commit_counts(db)[1]
+        version = db.execute('PRAGMA data_version;').fetchone()[0]
+        started = self._writes + _commit_counts(db)[0]
+        seen = versions.get(id(db))
+        if seen != None and seen[0] != version and seen[1] == started:
+            self._reset()
+        versions[id(db)] = (version, finished)
+
+    def invalidate(self, *card_numbers: int) -> None:
+        '''Сброс карт после записи. Вызывается после commit'''
+        with self._lock:
+            self._generation += 1
+            self._writes += 1
+            for card_number in card_numbers:
+                self._items.pop(card_number, None)
+            self.invalidations += len(card_numbers)
+
+    def clear(self) -> None:
+        '''Сброс всего кэша после массовой записи этого процесса. Вызывается после commit'''
+        with self._lock:
+            self._writes += 1
+        self._reset()
+
+    def _reset(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+            self.invalidations += 1
+            self.clears += 1
+
+    def stats(self) -> dict:
+        '''Счетчики попаданий и промахов'''
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'clears': self.clears,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+
+def _commit_counts(db) -> tuple:
+    '''Начатые и завершенные commit процесса по db_pool.PooledConnection. Для других соединений не считаются'''
+    commit_counts = getattr(db, 'commit_counts', None)
+    return commit_counts() if commit_counts != None else (0, 0)
+
+
+balance_cache = BalanceCache()
@@ -0,0 +1 @@
+# Бенчмарки запускаются из корня репозитория: python -m benchmarks.<имя>
@@ -0,0 +1,106 @@
+'''Счета в таблице Accounts (карта, валюта, баланс) против прежних столбцов Balance_* в Users_data.
+
+Запуск: python -m benchmarks.accounts_schema [размер ...]
+По умолчанию 100k и 1M карт, у каждой карты счета RUB, USD и EUR. Замеры - средняя задержка
+чтения одного счета и всех счетов карты, а также размер файла базы.
+'''
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from currencies import CURRENCIES
+from db_pool import get_pool
+from sql_query import SQLatm
+
+
+SIZES = (100_000, 1_000_000)
+LOOKUPS = 20_000
+FIRST_CARD = 10_000_000
+BATCH = 100_000
+
+# Прежняя схема (версия 4): балансы - столбцы строки карты
+WIDE_TABLE = '''
+    CREATE TABLE Users_data
+    (
+        UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Card_number INTEGER NOT NULL,
+        Pin_code INTEGER,
+        Pin_hash VARCHAR(255),
+        Pin_remaining_tries INTEGER NOT NULL DEFAULT 3,
+        Status VARCHAR(255) NOT NULL DEFAULT 'open',
+        Balance_RUB INTEGER,
+        Balance_USD INTEGER,
+        Balance_EUR INTEGER
+    );
+'''
+
+
+def fill_wide(db: sqlite3.Connection, size: int) -> None:
+    db.execute(WIDE_TABLE)
+    db.execute('CREATE UNIQUE INDEX Users_data_card ON Users_data (Card_number);')
+    for start in range(0, size, BATCH):
+        db.executemany('''
+            INSERT INTO Users_data (Card_number, Pin_code, Balance_RUB, Balance_USD, Balance_EUR)
+            VALUES (?, 1111, 10000000, 10000000, 10000000);
+        ''', ((FIRST_CARD + i,) for i in range(start, min(start + BATCH, size))))
+    db.commit()
+
+
+def fill_accounts(db: sqlite3.Connection, size: int) -> None:
+    for start in range(0, size, BATCH):
+        cards = range(FIRST_CARD + start, FIRST_CARD + min(start + BATCH, size))
+        db.executemany('''
+            INSERT INTO Users_data (Card_number, Pin_code)
+            VALUES (?, 1111);
+        ''', ((card,) for card in cards))
+        db.executemany('''
+            INSERT INTO Accounts (Card_number, Currency, Balance)
+            VALUES (?, ?, 10000000);
+        ''', ((card, currency) for card in cards for currency in CURRENCIES))
+    db.commit()
+
+
+def measure(run, cards: list) -> float:
+    '''Средняя задержка одного вызова run(card) в микросекундах'''
+    for card in cards[:1000]:  # Прогрев кэша страниц
+        run(card)
+    started = time.perf_counter()
+    for card in cards:
+        run(card)
+    return (time.perf_counter() - started) / len(cards) * 1e6
+
+
+def main(sizes) -> None:
+    print(f'{"карт":>9} | {"схема":>8} | {"один счет, мкс":>14} | {"все счета, мкс":>14} | {"файл, МБ":>8}')
+    for size in sizes:
+        cards = [FIRST_CARD + random.randrange(size) for _ in range(LOOKUPS)]
+        with tempfile.TemporaryDirectory() as tmp:
+            wide_path = os.path.join(tmp, 'wide.db')
+            wide = sqlite3.connect(wide_path)
+            fill_wide(wide, size)
+            one = measure(lambda card: wide.execute(
+                'SELECT Balance_USD FROM Users_data WHERE Card_number = ?;', (card,)).fetchone(), cards)
+            portfolio = measure(lambda card: wide.execute(
+                'SELECT Balance_RUB, Balance_USD, Balance_EUR FROM Users_data WHERE Card_number = ?;',
+                (card,)).fetchone(), cards)
+            wide.close()
+            print(f'{size:>9} | {"Balance_*":>8} | {one:>14.2f} | {portfolio:>14.2f} | '
+                  f'{os.path.getsize(wide_path) / 2 ** 20:>8.1f}')
+
+            accounts_path = os.path.join(tmp, 'accounts.db')
+            SQLatm.configure_db(accounts_path)
+            SQLatm.create_table()
+            db = get_pool().connection()
+            fill_accounts(db, size)
+            one = measure(lambda card: db.query('account', (card, 'USD')).fetchone(), cards)
+            portfolio = measure(lambda card: db.query('balance_by_card', (card,)).fetchall(), cards)
+            get_pool().close()
+            print(f'{size:>9} | {"Accounts":>8} | {one:>14.2f} | {portfolio:>14.2f} | '
+                  f'{os.path.getsize(accounts_path) / 2 ** 20:>8.1f}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,59 @@
+'''Задержка поиска по номеру карты в зависимости от размера таблицы.
+
+Запуск: python -m benchmarks.card_lookup [размер ...]
+По умолчанию 1k, 10k, 100k, 1M и 10M пользователей. Каждый размер - во временной базе.
+'''
+import os
+import random
+import sys
+import tempfile
+import time
+
+from db_pool import get_pool
+from sql_query import SQLatm
+
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+LOOKUPS = 20_000
+FIRST_CARD = 10_000_000  # Номера шире 4 цифр, чтобы уместить 10M карт - проверка формата тут не нужна
+
+
+def fill(size: int) -> None:
+    '''Прямая вставка size пользователей, минуя проверки insert_user'''
+    with get_pool().connection() as db:
+        batch = 100_000
+        for start in range(0, size, batch):
+            cards = range(FIRST_CARD + start, FIRST_CARD + min(start + batch, size))
+            db.executemany('''
+                INSERT INTO Users_data (Card_number, Pin_code)
+                VALUES (?, 1111);
+            ''', ((card,) for card in cards))
+            db.executemany('''
+                INSERT INTO Accounts (Card_number, Currency, Balance)
+                VALUES (?, 'RUB', 10000000);
+            ''', ((card,) for card in cards))
+
+
+def measure(size: int) -> float:
+    '''Средняя задержка одного поиска в микросекундах'''
+    cards = [FIRST_CARD + random.randrange(size) for _ in range(LOOKUPS)]
+    db = get_pool().connection()
+    started = time.perf_counter()
+    for card in cards:
+        db.query('balance_by_card', (card,)).fetchall()
+    return (time.perf_counter() - started) / LOOKUPS * 1e6
+
+
+def main(sizes) -> None:
+    print(f'{"пользователей":>14} | {"поиск, мкс":>10}')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            SQLatm.configure_db(os.path.join(tmp, 'atm.db'))
+            SQLatm.create_table()
+            fill(size)
+            print(f'{size:>14} | {measure(size):>10.2f}')
+            get_pool().close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,100 @@
+'''Скорость подбора купюр cash.dispense на типичных наборах кассет.
+
+Запуск: python -m benchmarks.dispensing [--requests 20000]
+Для каждого набора: средняя задержка dispense на случайных суммах, доля выполнимых запросов
+и сравнение с точным решением динамическим программированием (ограниченный рюкзак по остаткам)
+по задержке и по ответу "можно ли выдать". В конце - снятие через движок без учета кассет и с ним.
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from math import gcd
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from cash import dispense, load_cassettes
+from db_pool import get_pool
+from sql_query import SQLatm
+
+
+# (название, {номинал: число купюр}, шаг и максимум суммы запроса)
+SCENARIOS = (
+    ('RUB, 7 номиналов, полные', {5000: 2000, 2000: 2000, 1000: 2000, 500: 2000, 200: 2000, 100: 2000, 50: 2000},
+     50, 200_000),
+    ('RUB, 4 кассеты', {5000: 1500, 1000: 1500, 500: 1500, 100: 1500}, 100, 200_000),
+    ('RUB, почти пустые', {5000: 3, 1000: 2, 500: 1, 100: 4}, 100, 30_000),
+    ('RUB, без 100 и 1000', {5000: 200, 2000: 200, 500: 200, 200: 300, 50: 5}, 50, 100_000),
+    ('USD, 5 номиналов', {100: 2000, 50: 2000, 20: 2000, 10: 2000, 5: 2000}, 5, 10_000),
+    ('EUR, 7 номиналов', {500: 500, 200: 1000, 100: 2000, 50: 2000, 20: 2000, 10: 2000, 5: 2000}, 5, 10_000),
+    ('неканонический 30/70/110', {110: 50, 70: 50, 30: 50}, 10, 5_000),
+)
+
+
+def dp_feasible(amount: int, stock: dict) -> bool:
+    '''Точная проверка выполнимости: множество достижимых сумм в единицах НОД номиналов'''
+    step = 0
+    for note in stock:
+        step = gcd(step, note)
+    if step == 0 or amount % step:
+        return amount == 0
+    target = amount // step
+    reach = 1  # Бит i - сумма i * step достижима
+    mask = (1 << (target + 1)) - 1
+    for note, count in stock.items():
+        # Двоичное разбиение количества: 1, 2, 4, ... купюр - ограниченный рюкзак за O(log count) сдвигов
+        part = 1
+        while count > 0:
+            take = min(part, count)
+            reach |= (reach << (take * note // step)) & mask
+            count -= take
+            part *= 2
+    return bool(reach >> target & 1)
+
+
+def measure(func, amounts: list, stock: dict) -> tuple:
+    '''(средняя задержка в мкс, ответы)'''
+    started = time.perf_counter()
+    answers = [func(amount, stock) for amount in amounts]
+    return (time.perf_counter() - started) / len(amounts) * 1e6, answers
+
+
+def engine_withdrawals(requests: int) -> tuple:
+    '''Задержка снятия через движок в мкс: без кассет и с подбором купюр из кассет'''
+    with tempfile.TemporaryDirectory() as tmp:
+        SQLatm.configure_db(os.path.join(tmp, 'atm.db'))
+        SQLatm.create_table()
+        SQLatm.insert_users_bulk([(1000, 1111, 10 ** 11, None, None)])
+        load_cassettes(1, 'RUB', {note: 10 ** 6 for note in (5000, 2000, 1000, 500, 200, 100, 50)})
+        results = []
+        for atm_id in (None, 1):
+            started = time.perf_counter()
+            for i in range(requests):
+                ATMEngine.withdraw(1000, 'RUB', (50 + i % 1000 * 50) * MINOR_UNITS, atm_id)
+            results.append((time.perf_counter() - started) / requests * 1e6)
+        get_pool().close()
+    return tuple(results)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20_000)
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    print(f'{"набор":<28} | {"dispense, мкс":>13} | {"ДП, мкс":>9} | {"выполнимо":>9} | {"совпадает":>9}')
+    for name, stock, step, maximum in SCENARIOS:
+        amounts = [rnd.randrange(1, maximum // step + 1) * step for _ in range(args.requests)]
+        solver_time, answers = measure(dispense, amounts, stock)
+        dp_amounts = amounts[:max(1, args.requests // 20)]  # ДП на крупных суммах медленный - берем часть
+        dp_time, dp_answers = measure(dp_feasible, dp_amounts, stock)
+        feasible = sum(answer != None for answer in answers) / len(answers)
+        agree = all((answer != None) == dp_answer for answer, dp_answer in zip(answers, dp_answers))
+        print(f'{name:<28} | {solver_time:>13.2f} | {dp_time:>9.2f} | {feasible:>9.1%} | {"да" if agree else "НЕТ":>9}')
+
+    plain, with_cash = engine_withdrawals(args.requests // 4)
+    print(f'\nATMEngine.withdraw: без кассет {plain:.1f} мкс, с подбором купюр из кассет {with_cash:.1f} мкс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''Скорость выборки истории операций (ATMEngine.get_history) в зависимости от размера журнала.
+
+Запуск: python -m benchmarks.history [размер ...]
+По умолчанию 1M, 10M и 100M записей журнала на 100k карт. Каждый размер - во временной базе;
+для 100M нужно около 6 ГБ свободного места.
+'''
+import os
+import random
+import sys
+import tempfile
+import time
+
+from atm_engine import ATMEngine
+from db_pool import get_pool
+from sql_query import SQLatm
+
+
+SIZES = (1_000_000, 10_000_000, 100_000_000)
+CARDS = 100_000
+PAGES = 5_000
+PAGE_SIZE = 20
+
+
+def fill(size: int) -> None:
+    '''Прямая вставка size записей журнала со случайными картами и растущим временем'''
+    rnd = random.Random(size)
+    db = get_pool().connection()
+    batch = 500_000
+    for start in range(0, size, batch):
+        with db:
+            db.executemany('''
+                INSERT INTO Transactions (Card_number, Ts, Kind, Currency, Amount, Balance)
+                VALUES (?, ?, 'deposit', 'RUB', 500000, 0);
+            ''', ((rnd.randrange(CARDS), i) for i in range(start, min(start + batch, size))))
+
+
+def measure(size: int) -> tuple:
+    '''Средняя задержка выборки первой страницы и страницы из середины истории, мкс'''
+    rnd = random.Random(1)
+    cards = [rnd.randrange(CARDS) for _ in range(PAGES)]
+    started = time.perf_counter()
+    for card in cards:
+        ATMEngine.get_history(card, limit=PAGE_SIZE)
+    first = (time.perf_counter() - started) / PAGES * 1e6
+
+    started = time.perf_counter()
+    for card in cards:
+        ATMEngine.get_history(card, since=rnd.randrange(size), limit=PAGE_SIZE)
+    middle = (time.perf_counter() - started) / PAGES * 1e6
+    return first, middle
+
+
+def main(sizes) -> None:
+    print(f'{"записей":>12} | {"1-я страница, мкс":>18} | {"из середины, мкс":>17}')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            SQLatm.configure_db(os.path.join(tmp, 'atm.db'))
+            SQLatm.create_table()
+            fill(size)
+            first, middle = measure(size)
+            print(f'{size:>12} | {first:>18.1f} | {middle:>17.1f}')
+            get_pool().close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
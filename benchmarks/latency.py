@@ -0,0 +1,52 @@
+'''Задержки в бенчмарках: перцентиль по списку замеров и гистограмма для длинных прогонов.
+
+percentile - точное значение по всем замерам (stress_terminals, suite). LatencyHistogram хранит
+только счетчики корзин, поэтому годится для миллионов замеров (server_load, replay); ее
+перцентиль - верхняя граница корзины, погрешность до 9%.
+'''
+import math
+
+
+def percentile(values: list, fraction: float) -> float:
+    '''Перцентиль по отсортированному списку замеров, 0.0 - если замеров нет'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LatencyHistogram:
+    '''Гистограмма задержек с логарифмическими корзинами: 8 корзин на каждое удвоение, от 1 мкс'''
+
+    BUCKETS_PER_OCTAVE = 8
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def record(self, seconds: float) -> None:
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log2(micros) * self.BUCKETS_PER_OCTAVE)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def upper_bound(self, bucket: int) -> float:
+        '''Верхняя граница корзины в миллисекундах'''
+        return 2 ** ((bucket + 1) / self.BUCKETS_PER_OCTAVE) / 1e3
+
+    def percentile(self, fraction: float) -> float:
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= self.total * fraction:
+                return self.upper_bound(bucket)
+        return 0.0
+
+    def print(self, title: str) -> None:
+        print(f'{title}: {self.total} запросов, p50 {self.percentile(0.5):.2f} мс, '
+              f'p99 {self.percentile(0.99):.2f} мс, p99.9 {self.percentile(0.999):.2f} мс')
+        if not self.total:
+            return
+        largest = max(self.counts.values())
+        for bucket in sorted(self.counts):
+            bar = '#' * max(1, round(self.counts[bucket] / largest * 40))
+            print(f'  <= {self.upper_bound(bucket):>9.3f} мс | {self.counts[bucket]:>8} {bar}')
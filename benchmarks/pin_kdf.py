@@ -0,0 +1,70 @@
+'''Пропускная способность входа в зависимости от стоимости хэша пин-кода.
+
+Запуск: python -m benchmarks.pin_kdf [--iterations 10000 50000 ...] [--workers N] [--logins 200]
+Для каждого числа итераций PBKDF2: входов в секунду при проверке в потоке (одно ядро),
+в пуле из workers процессов (всего и на ядро) и при попадании в кэш проверок.
+'''
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from atm_engine import ATMEngine
+from db_pool import get_pool
+from pin_hash import pin_hasher
+from sql_query import SQLatm
+
+
+ITERATIONS = (10_000, 50_000, 100_000, 200_000)
+FIRST_CARD = 1000
+
+
+def logins_per_second(cards: list, threads: int) -> float:
+    '''Входов в секунду: каждая карта входит один раз, threads параллельных терминалов'''
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda card: ATMEngine.authenticate(card, str(card)), cards))
+    return len(cards) / (time.perf_counter() - started)
+
+
+def measure(db_path: str, iterations: int, workers: int, logins: int) -> tuple:
+    cards = [FIRST_CARD + i for i in range(logins)]
+    SQLatm.configure_db(db_path, max_connections=workers * 2 + 1, concurrent=True)  # + основной поток
+    SQLatm.create_table()
+    pin_hasher.configure(iterations, workers)
+    SQLatm.insert_users_bulk([(card, card, 1000, None, None) for card in cards])
+
+    pin_hasher.configure(workers=0)
+    pin_hasher.clear()
+    inline = logins_per_second(cards, 1)
+
+    pin_hasher.configure(workers=workers)
+    pin_hasher.clear()
+    logins_per_second(cards[:workers], workers)  # Запуск процессов пула не входит в замер
+    pin_hasher.clear()
+    pooled = logins_per_second(cards, workers * 2)
+
+    cached = logins_per_second(cards, 1)  # Все пин-коды уже проверены
+    pin_hasher.close()
+    get_pool().close()
+    return inline, pooled, cached
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, nargs='+', default=ITERATIONS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--logins', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'Процессов проверки: {args.workers}')
+    print(f'{"итераций":>9} | {"в потоке, вх/с":>14} | {"пул, вх/с":>10} | {"пул на ядро":>11} | {"кэш, вх/с":>10}')
+    for iterations in args.iterations:
+        with tempfile.TemporaryDirectory() as tmp:
+            inline, pooled, cached = measure(os.path.join(tmp, 'atm.db'), iterations, args.workers, args.logins)
+        print(f'{iterations:>9} | {inline:>14.1f} | {pooled:>10.1f} | {pooled / args.workers:>11.1f} | {cached:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''Стоимость одного запроса реестра: соединение на каждый вызов против долгоживущего соединения.
+
+Запуск: python -m benchmarks.queries [вызовов]
+Режимы:
+    connect - новое соединение, разбор SQL и commit на каждый вызов (как было до пула)
+    no-cache - соединение пула, но без кэша подготовленных выражений (cached_statements=0)
+    query - соединение пула, db.query по имени: выражение берется из кэша, курсор общий
+Запросы на запись выполняются внутри одной транзакции, которая затем откатывается.
+'''
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from db_pool import PooledConnection, get_pool
+from queries import QUERIES
+from sql_query import SQLatm
+
+
+USERS = 10_000
+CALLS = 20_000
+FIRST_CARD = 10_000_000
+
+# Имя запроса -> параметры очередного вызова по номеру карты
+WORKLOAD = {
+    'card_exists': lambda card: (card,),
+    'login': lambda card: (card,),
+    'balance_by_card': lambda card: (card,),
+    'account': lambda card: (card, 'RUB'),
+    'history_page': lambda card: (card, -1, -1, 50),
+    'credit': lambda card: (1, card, 'RUB'),
+    'debit': lambda card: (1, card, 'RUB', 1),
+}
+WRITES = ('credit', 'debit')
+
+
+def fill() -> None:
+    with get_pool().connection() as db:
+        db.executemany('''
+            INSERT INTO Users_data (Card_number, Pin_code)
+            VALUES (?, 1111);
+        ''', ((FIRST_CARD + i,) for i in range(USERS)))
+        db.executemany('''
+            INSERT INTO Accounts (Card_number, Currency, Balance)
+            VALUES (?, 'RUB', 10000000);
+        ''', ((FIRST_CARD + i,) for i in range(USERS)))
+
+
+def measure_connect(db_path: str, name: str, cards: list) -> float:
+    sql = QUERIES[name]
+    params = WORKLOAD[name]
+    started = time.perf_counter()
+    for card in cards:
+        db = sqlite3.connect(db_path)
+        db.execute(sql, params(card)).fetchall()
+        if name in WRITES:
+            db.rollback()  # Исходный код делал commit - откат не дешевле, результат не завышен
+        db.close()
+    return (time.perf_counter() - started) / len(cards) * 1e6
+
+
+def measure_pooled(db: sqlite3.Connection, name: str, cards: list, use_query: bool) -> float:
+    sql = QUERIES[name]
+    params = WORKLOAD[name]
+    started = time.perf_counter()
+    if use_query:
+        for card in cards:
+            db.query(name, params(card)).fetchall()
+    else:
+        for card in cards:
+            db.execute(sql, params(card)).fetchall()
+    elapsed = time.perf_counter() - started
+    if name in WRITES:
+        db.rollback()
+    return elapsed / len(cards) * 1e6
+
+
+def main(calls: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'atm.db')
+        SQLatm.configure_db(db_path)
+        SQLatm.create_table()
+        fill()
+        get_pool().close()
+
+        # Соединение на вызов в 100 раз медленнее - ему хватает меньшего числа вызовов
+        cards = [FIRST_CARD + random.randrange(USERS) for _ in range(calls)]
+        uncached = sqlite3.connect(db_path, factory=PooledConnection, cached_statements=0)
+        cached = sqlite3.connect(db_path, factory=PooledConnection, cached_statements=256)
+        print(f'{"запрос":>16} | {"connect, мкс":>12} | {"no-cache, мкс":>13} | {"query, мкс":>10} | {"ускорение":>9}')
+        for name in WORKLOAD:
+            connect = measure_connect(db_path, name, cards[:max(calls // 20, 1)])
+            no_cache = measure_pooled(uncached, name, cards, use_query=False)
+            query = measure_pooled(cached, name, cards, use_query=True)
+            print(f'{name:>16} | {connect:>12.2f} | {no_cache:>13.2f} | {query:>10.2f} | {connect / query:>8.1f}x')
+        uncached.close()
+        cached.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else CALLS)
@@ -0,0 +1,265 @@
+'''Воспроизведение консольных сессий банкомата без человека: нагрузка через настоящее меню atm_logic.
+
+Сессия - сценарий нажатий: номер карты, пин-код и дальше ответы на запросы меню, включая 00 -
+возврат в главное меню. Сценарии записываются из живой консоли или генерируются, файл - JSONL:
+    {"keys": ["1234", "1111", "2", "RUB", "500", "0"]}
+
+Ввод и вывод консоли подменяются потоками в памяти: input() читает нажатия из io.StringIO,
+print() пишет в другой, сам код меню не меняется. Сессии раздаются пулу процессов. Задержка шага
+меню - от нажатия до следующего запроса ввода (или конца сессии), то есть вся работа, которую
+вызвало нажатие: проверка пин-кода, операция движка, вывод.
+
+Запуск:
+    python -m benchmarks.replay --generate 5000 [--cards 1000] [--processes N] [--save-script s.jsonl]
+    python -m benchmarks.replay --script s.jsonl [--db atm.db] [--processes N] [--output steps.json]
+    python -m benchmarks.replay --capture s.jsonl [--db atm.db]     (запись своей сессии в консоли)
+Без --db создается временная база из --cards карт 1000, 1001, ..., пин-код каждой равен ее номеру.
+'''
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+import atm
+from benchmarks.latency import LatencyHistogram
+from cash import DEFAULT_NOTES, load_cassettes
+from db_pool import get_pool
+from pin_hash import DEFAULT_ITERATIONS, pin_hasher
+from sql_query import SQLatm
+
+
+FIRST_CARD = 1000
+# Шаги меню: (функция, запросившая ввод, начало текста запроса, имя шага). Пустое начало - любой запрос
+STEPS = (
+    ('atm_logic', '', 'card'),
+    ('login', '', 'pin'),
+    ('input_operation', '', 'menu'),
+    ('withdraw_money', '', 'withdraw_currency'),
+    ('_withdraw_currency', 'Введите сумму', 'withdraw_amount'),
+    ('_withdraw_currency', '', 'withdraw_confirm'),
+    ('deposit_money', '', 'deposit_currency'),
+    ('_deposit_currency', '', 'deposit_notes'),
+    ('transfer_money', 'Введите номер карты', 'transfer_card'),
+    ('transfer_money', '', 'transfer_currency'),
+    ('_transfer_currency', '', 'transfer_amount'),
+)
+MENU = {'1': 'balance', '2': 'withdraw', '3': 'deposit', '4': 'transfer', '0': 'exit'}
+
+
+def step_name(function: str, prompt: str, key: str) -> str:
+    for step_function, prefix, name in STEPS:
+        if step_function == function and prompt.startswith(prefix):
+            return f'menu:{MENU.get(key, key)}' if name == 'menu' else name
+    return function
+
+
+def caller_name(frame) -> str:
+    '''Имя функции меню, вызвавшей input(), начиная с кадра frame. Обертки замеров metrics
+    (с metrics.configure(enabled=True) input в sql_query - обертка) пропускаются: у них свое имя кода'''
+    while frame.f_back != None and frame.f_globals.get('__name__') == 'metrics':
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+
+class ScriptedInput(io.StringIO):
+    '''Поток нажатий для sys.stdin. Встроенная input() читает его readline, когда stdin не терминал:
+    каждое чтение закрывает замер предыдущего шага и открывает следующий'''
+
+    def __init__(self, keys: list, output: io.StringIO):
+        super().__init__(''.join(f'{key}\n' for key in keys))
+        self.output = output
+        self.steps = []  # (шаг, секунды)
+        self._step = None
+        self._started = 0.0
+        self._prompt_at = 0  # Позиция вывода, после которой напечатан текущий запрос
+
+    def readline(self, size: int = -1) -> str:
+        now = time.perf_counter()
+        self.finish(now)
+        line = super().readline(size)
+        if line:
+            # Запрос - последняя строка вывода, функция - та, что вызвала input()
+            prompt = self.output.getvalue()[self._prompt_at:].rsplit('\n', 1)[-1]
+            self._step = step_name(caller_name(sys._getframe(1)), prompt, line.rstrip('\n'))
+            self.output.write(line)  # Эхо нажатия, как в терминале: вывод читается как стенограмма
+            self._prompt_at = self.output.tell()
+            self._started = time.perf_counter()
+        return line
+
+    def finish(self, now: float) -> None:
+        if self._step != None:
+            self.steps.append((self._step, now - self._started))
+            self._step = None
+
+
+def replay_session(keys: list) -> dict:
+    '''Прогон одной сессии через atm_logic. Возвращает задержки шагов, длительность сессии,
+    число сообщений об ошибке в выводе и признак того, что нажатия кончились раньше выхода из меню'''
+    output = io.StringIO()
+    scripted = ScriptedInput(keys, output)
+    started = time.perf_counter()
+    incomplete = False
+    stdin = sys.stdin
+    sys.stdin = scripted
+    try:
+        with contextlib.redirect_stdout(output):
+            atm.atm_logic()
+    except EOFError:
+        incomplete = True
+    finally:
+        sys.stdin = stdin
+    finished = time.perf_counter()
+    scripted.finish(finished)
+    return {
+        'steps': scripted.steps,
+        'seconds': finished - started,
+        'errors': output.getvalue().count('ОШИБКА'),
+        'incomplete': incomplete,
+    }
+
+
+def generate_session(rnd: random.Random, cards: int) -> list:
+    '''Случайная сессия клиента: вход, от 1 до 5 операций, иногда - возврат в меню, выход'''
+    card_number = FIRST_CARD + rnd.randrange(cards)
+    keys = [str(card_number), str(card_number)]
+    for _ in range(rnd.randint(1, 5)):
+        operation = rnd.choices(('balance', 'withdraw', 'deposit', 'transfer', 'back'), (40, 25, 15, 15, 5))[0]
+        if operation == 'balance':
+            keys.append('1')
+        elif operation == 'withdraw':
+            amount = rnd.randrange(1, 100) * 50
+            keys += ['2', 'RUB', str(amount)]
+            if rnd.random() < 0.1:  # Сумма не кратна купюре - подтверждение округления
+                keys[-1] = str(amount + 20)
+                keys.append('1')
+        elif operation == 'deposit':
+            keys += ['3', 'RUB', f'1000x{rnd.randint(1, 5)} 500 100']
+        elif operation == 'transfer' and cards > 1:
+            other = FIRST_CARD + (card_number - FIRST_CARD + rnd.randrange(1, cards)) % cards
+            keys += ['4', str(other), 'RUB', f'{rnd.randint(1, 1000)}.{rnd.randint(0, 99):02}']
+        else:
+            keys += [rnd.choice('234'), '00']
+    keys.append('0')
+    return keys
+
+
+def setup_db(db_path: str, cards: int, atm_id: int | None) -> None:
+    '''База из cards карт с пин-кодом, равным номеру карты, и кассеты банкомата atm_id'''
+    SQLatm.configure_db(db_path, concurrent=True)
+    SQLatm.create_table()
+    pin_hasher.configure(workers=os.cpu_count())  # Хэши пин-кодов - самая долгая часть подготовки
+    report = SQLatm.insert_users_bulk((card, card, 1_000_000, 10_000, 10_000)
+                                      for card in range(FIRST_CARD, FIRST_CARD + cards))
+    pin_hasher.close()
+    if atm_id != None:
+        for currency, notes in DEFAULT_NOTES.items():
+            load_cassettes(atm_id, currency, {note: 10 ** 6 for note in notes})
+    get_pool().close()
+    print(f'Подготовлена база: карт {report["inserted"]}')
+
+
+def init_worker(db_path: str, iterations: int, atm_id: int | None) -> None:
+    SQLatm.configure_db(db_path, concurrent=True)
+    pin_hasher.configure(iterations, workers=0)
+    SQLatm.atm_id = atm_id
+
+
+def capture(path: str) -> None:
+    '''Живая сессия в консоли с записью нажатий в конец файла сценариев'''
+    keys = []
+    stdin = sys.stdin
+
+    class Recorder:
+        def readline(self):
+            line = stdin.readline()
+            if line:
+                keys.append(line.rstrip('\n'))
+            return line
+
+    sys.stdin = Recorder()
+    try:
+        atm.atm_logic()
+    finally:
+        sys.stdin = stdin
+        if keys:
+            with open(path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps({'keys': keys}, ensure_ascii=False) + '\n')
+            print(f'Сессия записана в {path}: нажатий {len(keys)}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--script', help='файл сценариев JSONL')
+    source.add_argument('--generate', type=int, help='сгенерировать столько сессий')
+    source.add_argument('--capture', help='записать свою сессию в файл сценариев')
+    parser.add_argument('--db', help='база; без нее создается временная из --cards карт')
+    parser.add_argument('--cards', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--atm', type=int, help='номер банкомата: выдача из его кассет')
+    parser.add_argument('--pin-iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--save-script', help='сохранить сгенерированные сессии в JSONL')
+    parser.add_argument('--output', help='файл JSON с задержками шагов')
+    args = parser.parse_args()
+
+    if args.capture != None:
+        SQLatm.configure_db(args.db or 'atm.db', concurrent=True)
+        SQLatm.atm_id = args.atm
+        try:
+            capture(args.capture)
+        finally:
+            get_pool().close()
+        return
+
+    if args.script != None:
+        with open(args.script, encoding='utf-8') as file:
+            sessions = [json.loads(line)['keys'] for line in file if line.strip()]
+    else:
+        rnd = random.Random(args.seed)
+        sessions = [generate_session(rnd, args.cards) for _ in range(args.generate)]
+        if args.save_script != None:
+            with open(args.save_script, 'w', encoding='utf-8') as file:
+                file.writelines(json.dumps({'keys': keys}, ensure_ascii=False) + '\n' for keys in sessions)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if db_path == None:
+            db_path = os.path.join(tmp, 'atm.db')
+            pin_hasher.configure(args.pin_iterations)
+            setup_db(db_path, args.cards, args.atm)
+        started = time.perf_counter()
+        with multiprocessing.Pool(args.processes, init_worker, (db_path, args.pin_iterations, args.atm)) as pool:
+            results = list(pool.imap_unordered(replay_session, sessions, chunksize=16))
+        elapsed = time.perf_counter() - started
+
+    histograms = {'session': LatencyHistogram()}
+    for result in results:
+        histograms['session'].record(result['seconds'])
+        for step, seconds in result['steps']:
+            histograms.setdefault(step, LatencyHistogram()).record(seconds)
+    keystrokes = sum(len(result['steps']) for result in results)
+    print(f'Сессий: {len(results)} за {elapsed:.1f} с, {len(results) / elapsed:.0f} сессий/с, '
+          f'{keystrokes / elapsed:.0f} нажатий/с, процессов: {args.processes}')
+    print(f'Сообщений об ошибке: {sum(result["errors"] for result in results)}, '
+          f'сессий без выхода из меню: {sum(result["incomplete"] for result in results)}')
+    for name in sorted(histograms, key=lambda name: (name != 'session', name)):
+        histograms[name].print(name)
+
+    if args.output != None:
+        steps = {name: {'count': histogram.total, 'p50_ms': histogram.percentile(0.5),
+                        'p99_ms': histogram.percentile(0.99), 'p999_ms': histogram.percentile(0.999)}
+                 for name, histogram in histograms.items()}
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'sessions': len(results), 'seconds': elapsed, 'processes': args.processes, 'steps': steps},
+                      file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
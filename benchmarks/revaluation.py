@@ -0,0 +1,66 @@
+'''Время пересчета всех счетов в одну валюту.
+
+Запуск: python -m benchmarks.revaluation [размер ...]
+По умолчанию 1M и 10M карт. revalue_accounts - оценка каждой карты (векторно, если установлен numpy),
+revaluation_total - точная сумма по всем картам агрегатами sqlite.
+'''
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from currencies import CURRENCIES
+from db_pool import get_pool
+from exchange import exchange_rates, np, revalue_accounts, revaluation_total
+from sql_query import SQLatm
+
+
+SIZES = (1_000_000, 10_000_000)
+FIRST_CARD = 10_000_000
+RATES = {'base': 'RUB', 'rates': {'RUB': '1', 'USD': '92.5', 'EUR': '100.25'}}
+
+
+def fill(size: int) -> None:
+    '''Прямая вставка: у карты случайный набор счетов со случайными балансами'''
+    rnd = random.Random(size)
+    with get_pool().connection() as db:
+        batch = 100_000
+        for start in range(0, size, batch):
+            cards = range(FIRST_CARD + start, FIRST_CARD + min(start + batch, size))
+            db.executemany('''
+                INSERT INTO Users_data (Card_number, Pin_code)
+                VALUES (?, 1111);
+            ''', ((card,) for card in cards))
+            db.executemany('''
+                INSERT INTO Accounts (Card_number, Currency, Balance)
+                VALUES (?, ?, ?);
+            ''', ((card, currency, rnd.randrange(10 ** 9)) for card in cards for currency in CURRENCIES
+                  if rnd.random() < 0.7))
+
+
+def main(sizes) -> None:
+    print(f'numpy: {"да" if np != None else "нет"}')
+    print(f'{"карт":>10} | {"по картам, с":>12} | {"карт/с":>10} | {"итог, с":>8}')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'rates.json'), 'w') as file:
+                json.dump(RATES, file)
+            exchange_rates.configure(os.path.join(tmp, 'rates.json'))
+            SQLatm.configure_db(os.path.join(tmp, 'atm.db'))
+            SQLatm.create_table()
+            fill(size)
+
+            started = time.perf_counter()
+            accounts = sum(len(cards) for cards, _ in revalue_accounts('RUB'))
+            per_card = time.perf_counter() - started
+            started = time.perf_counter()
+            revaluation_total('RUB')
+            total = time.perf_counter() - started
+            print(f'{accounts:>10} | {per_card:>12.2f} | {accounts / per_card:>10.0f} | {total:>8.2f}')
+            get_pool().close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,116 @@
+'''Генератор нагрузки для atm_server.py: много одновременных сессий терминалов на localhost.
+
+Запуск: python -m benchmarks.server_load [--sessions 1000] [--seconds 10] [--port 8765]
+С --spawn сам создает временную базу, запускает сервер и останавливает его по завершении.
+Каждая сессия входит по карте и пин-коду, затем выполняет balance (60%), withdraw и deposit.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.latency import LatencyHistogram
+from sql_query import SQLatm
+
+
+CARDS = range(1000, 2000)
+OPERATIONS = (
+    ({'op': 'balance'}, 0.6),
+    ({'op': 'withdraw', 'currency': 'RUB', 'amount': 50}, 0.2),
+    ({'op': 'deposit', 'currency': 'RUB', 'amount': 50}, 0.2),
+)
+
+
+async def call(reader, writer, request: dict) -> dict:
+    writer.write(json.dumps(request).encode() + b'\n')
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+
+async def session(args, histograms: dict, deadline: float, rnd: random.Random) -> None:
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    card_number = rnd.choice(CARDS)
+    started = time.perf_counter()
+    await call(reader, writer, {'op': 'card', 'card': card_number})
+    await call(reader, writer, {'op': 'pin', 'pin': '1111'})
+    histograms['login'].record(time.perf_counter() - started)
+
+    requests = [item[0] for item in OPERATIONS]
+    weights = [item[1] for item in OPERATIONS]
+    while time.perf_counter() < deadline:
+        request = rnd.choices(requests, weights)[0]
+        started = time.perf_counter()
+        response = await call(reader, writer, request)
+        histograms[request['op']].record(time.perf_counter() - started)
+        if not response['ok']:
+            histograms['errors'] += 1
+    writer.write(b'{"op": "quit"}\n')
+    writer.close()
+
+
+async def run(args) -> dict:
+    histograms = {'login': LatencyHistogram(), 'errors': 0}
+    for request, _ in OPERATIONS:
+        histograms[request['op']] = LatencyHistogram()
+    deadline = time.perf_counter() + args.seconds
+    rnd = random.Random(args.seed)
+    await asyncio.gather(*(session(args, histograms, deadline, random.Random(rnd.random()))
+                           for _ in range(args.sessions)))
+    return histograms
+
+
+def spawn_server(args, tmp: str) -> subprocess.Popen:
+    '''Временная база с пользователями и сервер на ней'''
+    db_path = os.path.join(tmp, 'atm.db')
+    SQLatm.configure_db(db_path, concurrent=True)
+    SQLatm.create_table()
+    SQLatm.insert_users_bulk((card, 1111, 1_000_000, None, None) for card in CARDS)
+    SQLatm.configure_db(db_path)
+    command = [sys.executable, 'atm_server.py', '--db', db_path, '--workers', str(args.workers), '--no-limits']
+    command += ['--unix', args.unix] if args.unix else ['--host', args.host, '--port', str(args.port)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    server.stdout.readline()  # Сервер печатает строку, когда начал слушать
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='Путь к Unix-сокету вместо TCP')
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--spawn', action='store_true', help='Запустить сервер на временной базе')
+    parser.add_argument('--workers', type=int, default=8, help='Потоков БД сервера при --spawn')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = spawn_server(args, tmp) if args.spawn else None
+        try:
+            started = time.perf_counter()
+            histograms = asyncio.run(run(args))
+            elapsed = time.perf_counter() - started
+        finally:
+            if server != None:
+                server.terminate()
+                server.wait()
+
+    total = sum(value.total for key, value in histograms.items() if key != 'errors')
+    print(f'Сессий: {args.sessions}, запросов: {total}, {total / elapsed:.0f} запросов/с, '
+          f'ошибок: {histograms["errors"]}')
+    for name, histogram in histograms.items():
+        if name != 'errors':
+            histogram.print(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''Пропускная способность записи в зависимости от числа шардов (shards.py).
+
+Запуск: python -m benchmarks.sharding [--shards 1 2 4 8] [--processes 8] [--cards 10000]
+                                      [--ops 2000] [--scenario deposit|transfer] [--output sharding.json]
+
+Для каждого числа шардов создается набор баз с одними и теми же картами (схема hash), затем
+processes процессов выполняют по ops операций записи на случайных картах. На одной базе писатели
+ждут друг друга на блокировке записи файла, на N шардах - только писатели того же шарда, поэтому
+при достаточном числе ядер запись растет почти линейно с числом шардов, пока шардов не больше
+процессов. Ядер меньше, чем процессов, - рост упирается в процессор, а не в блокировку.
+
+deposit - внесение на одну карту, транзакция одного шарда.
+transfer - перевод между двумя случайными картами: при N шардах доля (N - 1) / N переводов
+идет между шардами сагой из трех транзакций (ATMEngine._transfer_between).
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from db_pool import close_all
+from pin_hash import pin_hasher
+import shards
+from shards import ShardMap
+from sql_query import SQLatm
+
+
+FIRST_CARD = 1000
+AMOUNT = 100 * MINOR_UNITS
+
+
+def setup(map_path: str, count: int, cards: int) -> None:
+    '''Карта из count шардов и cards карт с запасом на любое число переводов'''
+    ShardMap([f'atm-{i}.db' for i in range(count)], 'hash').save(map_path)
+    shards.configure(map_path, recover=False)
+    pin_hasher.configure(1000)  # Пин-коды в замере не участвуют
+    SQLatm.insert_users_bulk((card, 1111, 10 ** 9, None, None) for card in range(FIRST_CARD, FIRST_CARD + cards))
+    close_all()
+
+
+def run_worker(map_path: str, scenario: str, cards: int, ops: int, seed: int) -> dict:
+    shards.configure(map_path, max_connections=2, recover=False)
+    rnd = random.Random(seed)
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(ops):
+        card_number = FIRST_CARD + rnd.randrange(cards)
+        try:
+            if scenario == 'deposit':
+                ATMEngine.deposit(card_number, 'RUB', AMOUNT)
+            else:
+                other = FIRST_CARD + (card_number - FIRST_CARD + rnd.randrange(1, cards)) % cards
+                ATMEngine.transfer(card_number, other, 'RUB', AMOUNT)
+        except Exception:
+            errors += 1
+    finished = time.perf_counter()
+    close_all()
+    return {'started': started, 'finished': finished, 'errors': errors}
+
+
+def run(count: int, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        map_path = os.path.join(tmp, 'shards.json')
+        setup(map_path, count, args.cards)
+        tasks = [(map_path, args.scenario, args.cards, args.ops, args.seed * 1000 + process)
+                 for process in range(args.processes)]
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(run_worker, tasks)
+    # time.perf_counter - монотонные часы системы, общие для процессов одной машины
+    seconds = max(result['finished'] for result in results) - min(result['started'] for result in results)
+    writes = args.ops * args.processes
+    return {'shards': count, 'processes': args.processes, 'scenario': args.scenario, 'writes': writes,
+            'errors': sum(result['errors'] for result in results), 'seconds': round(seconds, 3),
+            'writes_per_sec': round(writes / seconds, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Запись в зависимости от числа шардов')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--cards', type=int, default=8000)
+    parser.add_argument('--ops', type=int, default=2000, help='операций на процесс')
+    parser.add_argument('--scenario', choices=('deposit', 'transfer'), default='deposit')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='файл JSON с результатами')
+    args = parser.parse_args()
+    if not 1 <= args.cards <= 9000:
+        parser.error('--cards: от 1 до 9000, номера карт 1000..9999')
+
+    print(f'Процессов: {args.processes}, ядер: {os.cpu_count()}, сценарий: {args.scenario}')
+    print(f'{"шардов":>6} | {"записей/с":>10} | {"ускорение":>9} | {"ошибок":>6}')
+    results = []
+    for count in args.shards:
+        result = run(count, args)
+        results.append(result)
+        speedup = result['writes_per_sec'] / results[0]['writes_per_sec']
+        print(f'{count:>6} | {result["writes_per_sec"]:>10.0f} | {speedup:>8.2f}x | {result["errors"]:>6}')
+    if args.output != None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'cpus': os.cpu_count(), 'results': results}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''Нагрузочный стенд: N процессов-терминалов работают с одной базой через SQLatm.
+
+Запуск: python -m benchmarks.stress_terminals [--terminals 8] [--seconds 10] [--wal] [--cache]
+Терминал случайно выбирает операцию движка: проверка баланса (60%), снятие или внесение 50 RUB.
+Баланс по умолчанию читается из базы мимо кэша balance_cache: стенд меряет, как читатели ждут
+писателей. --cache - чтение через кэш, как в ATMEngine.get_balance.
+'''
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from benchmarks.latency import percentile
+from sql_query import SQLatm
+
+
+CARDS = range(1000, 1100)
+SCENARIOS = (
+    ('balance', 0.6, lambda card_number: ATMEngine._load_balance(card_number)),
+    ('withdraw', 0.2, lambda card_number: ATMEngine.withdraw(card_number, 'RUB', 50 * MINOR_UNITS)),
+    ('deposit', 0.2, lambda card_number: ATMEngine.deposit(card_number, 'RUB', 50 * MINOR_UNITS)),
+)
+
+
+def terminal(db_path: str, concurrent: bool, cached: bool, seconds: float, seed: int) -> dict:
+    '''Один терминал. Возвращает задержки операций в секундах по имени операции'''
+    SQLatm.configure_db(db_path, concurrent=concurrent)
+    rnd = random.Random(seed)
+    names = [item[0] for item in SCENARIOS]
+    weights = [item[1] for item in SCENARIOS]
+    operations = {item[0]: item[2] for item in SCENARIOS}
+    if cached:
+        operations['balance'] = ATMEngine.get_balance
+    latencies = {name: [] for name in names}
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        name = rnd.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            operations[name](rnd.choice(CARDS))
+        except Exception:
+            errors += 1
+            continue
+        latencies[name].append(time.perf_counter() - started)
+    latencies['errors'] = errors
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--terminals', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--wal', action='store_true', help='WAL-режим (SQLatm.configure_db(concurrent=True))')
+    parser.add_argument('--cache', action='store_true', help='читать баланс через кэш balance_cache')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'atm.db')
+        SQLatm.configure_db(db_path, concurrent=args.wal)
+        SQLatm.create_table()
+        SQLatm.insert_users_bulk((card, 1111, 1_000_000, None, None) for card in CARDS)
+        SQLatm.configure_db(db_path)  # Освобождаем соединения родительского процесса
+
+        with multiprocessing.Pool(args.terminals) as pool:
+            results = pool.starmap(terminal, [(db_path, args.wal, args.cache, args.seconds, seed)
+                                              for seed in range(args.terminals)])
+
+    mode = 'WAL' if args.wal else 'rollback journal'
+    reads = 'через кэш' if args.cache else 'из базы'
+    print(f'Терминалов: {args.terminals}, режим: {mode}, баланс: {reads}, длительность: {args.seconds} с')
+    print(f'{"операция":>10} | {"всего":>8} | {"оп/с":>8} | {"p50, мс":>8} | {"p99, мс":>8}')
+    total = 0
+    for name, _, _ in SCENARIOS:
+        values = sorted(value for result in results for value in result[name])
+        total += len(values)
+        print(f'{name:>10} | {len(values):>8} | {len(values) / args.seconds:>8.0f} | '
+              f'{percentile(values, 0.5) * 1e3:>8.2f} | {percentile(values, 0.99) * 1e3:>8.2f}')
+    print(f'Всего: {total / args.seconds:.0f} оп/с, ошибок: {sum(result["errors"] for result in results)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+'''Воспроизводимый набор бенчмарков движка с результатами в JSON и сравнением с базовой линией.
+
+Запуск: python -m benchmarks.suite [--sizes 1000 100000] [--scenarios balance withdraw ...]
+                                   [--skew 0 1.1] [--processes 1 4] [--ops 2000] [--repeat 3]
+                                   [--data-dir DIR] [--output results.json]
+                                   [--baseline baseline.json] [--tolerance 0.1]
+
+Для каждого размера базы (1k ... 10M карт) генерируется синтетический набор данных, для каждого
+сочетания сценария, перекоса обращений и числа процессов выполняется ops операций на процесс.
+Карты выбираются по закону Ципфа с показателем skew (0 - равномерно): горячие карты разбросаны
+по всему диапазону номеров. Генератор случайных чисел фиксирован --seed, поэтому два запуска
+выполняют одни и те же операции над одними и теми же данными.
+
+С --data-dir сгенерированные базы сохраняются и переиспользуются (10M карт генерируются минутами),
+замеры идут на копии. С --baseline результаты сравниваются с прежним JSON: падение пропускной
+способности больше --tolerance или рост p99 больше --latency-tolerance - регрессия, код выхода 1.
+Сравниваются медианы --repeat повторов: одиночный прогон слишком шумный для порога в 10%.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from math import gcd
+from statistics import median
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from benchmarks.latency import percentile
+from db_pool import get_pool
+from pin_hash import DEFAULT_ITERATIONS, pin_hasher
+from queries import QUERIES
+from sql_query import SQLatm
+
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+FIRST_CARD = 10_000_000  # Карты набора данных - вне 4-значных номеров, их занимает сценарий bulk_insert
+PIN = '1111'
+BALANCE = 10 ** 9 * MINOR_UNITS  # Хватает на любое число снятий и переводов по 100 RUB
+AMOUNT = 100 * MINOR_UNITS
+BULK_CARDS = range(1000, 10000)  # Номера, которые принимает insert_users_bulk
+BULK_CHUNK = 10  # Пользователей в одной операции bulk_insert
+
+
+def _login(card_number: int, other: int) -> None:
+    # У карт набора общий хэш пин-кода, поэтому кэш проверок сбрасывается: каждый вход - с расчетом хэша
+    pin_hasher.clear()
+    ATMEngine.authenticate(card_number, PIN)
+
+
+def _balance(card_number: int, other: int) -> None:
+    ATMEngine.get_balance(card_number)
+
+
+def _withdraw(card_number: int, other: int) -> None:
+    ATMEngine.withdraw(card_number, 'RUB', AMOUNT)
+
+
+def _deposit(card_number: int, other: int) -> None:
+    ATMEngine.deposit(card_number, 'RUB', AMOUNT)
+
+
+def _transfer(card_number: int, other: int) -> None:
+    ATMEngine.transfer(card_number, other, 'RUB', AMOUNT)
+
+
+# Имя -> (операция над картой и второй картой, доля от --ops). Вход и пакетная вставка упираются
+# в хэш пин-кода (~25 мс), поэтому операций в них меньше
+SCENARIOS = {
+    'login': (_login, 0.05),
+    'balance': (_balance, 1.0),
+    'withdraw': (_withdraw, 1.0),
+    'deposit': (_deposit, 1.0),
+    'transfer': (_transfer, 1.0),
+    'bulk_insert': (None, 0.05),  # Операция - пачка из BULK_CHUNK новых пользователей, ops - пользователей
+}
+
+
+class CardPicker:
+    '''Случайные карты набора из size карт с распределением Ципфа: вероятность k-й по популярности
+    карты пропорциональна 1 / k ** skew. Памяти O(1) при любом size'''
+
+    def __init__(self, size: int, skew: float, seed: int):
+        self.size = size
+        self.skew = skew
+        self.rnd = random.Random(seed)
+        # Ранг карты переводится в номер умножением на число, взаимно простое с size:
+        # горячие карты не идут подряд и попадают в разные страницы индекса
+        self.step = 2_654_435_761 % size or 1
+        while gcd(self.step, size) != 1:
+            self.step += 1
+
+    def rank(self) -> int:
+        '''Ранг 0..size-1 по непрерывному приближению закона Ципфа (обратная функция распределения)'''
+        u = self.rnd.random()
+        if self.skew == 1:
+            rank = self.size ** u
+        else:
+            power = 1 - self.skew
+            rank = ((self.size ** power - 1) * u + 1) ** (1 / power)
+        return min(int(rank) - 1, self.size - 1)
+
+    def card(self) -> int:
+        return FIRST_CARD + self.rank() * self.step % self.size
+
+
+def generate_dataset(db_path: str, size: int, iterations: int, batch: int = 100_000) -> None:
+    '''Набор данных из size карт с пин-кодом PIN и счетом RUB, каждая вторая - еще и со счетом USD.
+    Хэш пин-кода считается один раз и общий у всех карт: иначе 10M карт генерировались бы сутками'''
+    SQLatm.configure_db(db_path)
+    SQLatm.create_table()
+    pin_hasher.configure(iterations)
+    pin_hash = pin_hasher.hash(PIN)
+    with get_pool().connection() as db:
+        db.execute('PRAGMA synchronous = OFF;')  # Генерация повторяема: при сбое файл создается заново
+        for start in range(0, size, batch):
+            cards = range(FIRST_CARD + start, FIRST_CARD + min(start + batch, size))
+            db.executemany(QUERIES['import_user'], ((card, pin_hash, 3, 'open') for card in cards))
+            db.executemany(QUERIES['insert_account'], ((card, 'RUB', BALANCE) for card in cards))
+            db.executemany(QUERIES['insert_account'], ((card, 'USD', BALANCE) for card in cards if card % 2 == 0))
+            db.commit()
+    get_pool().close()
+
+
+def prepare_dataset(work_path: str, size: int, iterations: int, data_dir: str | None) -> None:
+    '''Рабочая база в work_path: копия сохраненного набора из data_dir или новая генерация'''
+    if data_dir == None:
+        generate_dataset(work_path, size, iterations)
+        return
+    os.makedirs(data_dir, exist_ok=True)
+    saved_path = os.path.join(data_dir, f'cards-{size}-i{iterations}.db')
+    if not os.path.exists(saved_path):
+        print(f'Генерация набора данных: {size} карт')
+        generate_dataset(f'{saved_path}.tmp', size, iterations)
+        os.replace(f'{saved_path}.tmp', saved_path)
+    shutil.copyfile(saved_path, work_path)
+
+
+def run_worker(db_path: str, scenario: str, size: int, skew: float, ops: int, seed: int,
+               iterations: int, bulk_cards: range) -> dict:
+    '''Один процесс сценария. Возвращает время начала и конца, выполненные операции (для bulk_insert -
+    добавленных пользователей), задержки операций в нс и число ошибок'''
+    SQLatm.configure_db(db_path, concurrent=True)
+    pin_hasher.configure(iterations, workers=0)
+    pin_hasher.clear()
+    picker = CardPicker(size, skew, seed)
+    operation = SCENARIOS[scenario][0]
+    latencies = []
+    done = 0
+    errors = 0
+    started = time.perf_counter()
+    if scenario == 'bulk_insert':
+        for start in range(0, len(bulk_cards), BULK_CHUNK):
+            users = [(card, int(PIN), 1000, None, None) for card in bulk_cards[start:start + BULK_CHUNK]]
+            operation_started = time.perf_counter_ns()
+            report = SQLatm.insert_users_bulk(users)
+            latencies.append(time.perf_counter_ns() - operation_started)
+            done += report['inserted']
+            errors += len(report['errors'])
+    else:
+        for _ in range(ops):
+            card_number = picker.card()
+            other = picker.card()
+            if other == card_number:
+                other = FIRST_CARD + (card_number - FIRST_CARD + 1) % size
+            operation_started = time.perf_counter_ns()
+            try:
+                operation(card_number, other)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter_ns() - operation_started)
+            done += 1
+    finished = time.perf_counter()
+    get_pool().close()
+    return {'started': started, 'finished': finished, 'done': done, 'latencies': latencies, 'errors': errors}
+
+
+def run_scenario(db_path: str, scenario: str, size: int, skew: float, processes: int, ops: int,
+                 seed: int, iterations: int) -> dict:
+    '''Сценарий в processes процессах. Пропускная способность - по общему времени от первого
+    начала до последнего конца: ожидание блокировки записи другими процессами входит в замер'''
+    ops = max(1, int(ops * SCENARIOS[scenario][1]))
+    bulk_size = min(ops, len(BULK_CARDS) // processes)
+    tasks = [(db_path, scenario, size, skew, ops, seed * 1000 + process, iterations,
+              BULK_CARDS[process * bulk_size:(process + 1) * bulk_size]) for process in range(processes)]
+    if processes == 1:
+        results = [run_worker(*tasks[0])]
+    else:
+        get_pool().close()  # Дочерние процессы не должны унаследовать соединения
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(run_worker, tasks)
+    if scenario == 'bulk_insert':
+        SQLatm.configure_db(db_path)
+        with get_pool().connection() as db:  # Следующий повтор вставляет те же номера
+            db.execute('DELETE FROM Accounts WHERE Card_number < ?;', (FIRST_CARD,))
+            db.execute('DELETE FROM Users_data WHERE Card_number < ?;', (FIRST_CARD,))
+        get_pool().close()
+
+    latencies = sorted(value / 1e3 for result in results for value in result['latencies'])
+    seconds = max(result['finished'] for result in results) - min(result['started'] for result in results)
+    count = sum(result['done'] for result in results)
+    return {
+        'scenario': scenario,
+        'cards': size,
+        'skew': skew,
+        'processes': processes,
+        'ops': count,  # Для bulk_insert - вставленных пользователей
+        'errors': sum(result['errors'] for result in results),
+        'seconds': round(seconds, 4),
+        'ops_per_sec': round(count / seconds, 1) if seconds else 0.0,
+        'latency_us': {
+            'mean': round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            'p50': round(percentile(latencies, 0.5), 1),
+            'p90': round(percentile(latencies, 0.9), 1),
+            'p99': round(percentile(latencies, 0.99), 1),
+            'p999': round(percentile(latencies, 0.999), 1),
+            'max': round(latencies[-1], 1) if latencies else 0.0,
+        },
+    }
+
+
+def median_run(runs: list) -> dict:
+    '''Результат повторов: оп/с и каждый показатель задержки - медианы по повторам, отдельно друг от друга.
+    Один прогон на нагруженной машине легко отклоняется на 15-20% - медиана отсекает такие выбросы'''
+    result = dict(sorted(runs, key=lambda run: run['ops_per_sec'])[len(runs) // 2])
+    result['latency_us'] = {name: median(run['latency_us'][name] for run in runs) for name in result['latency_us']}
+    result['runs_ops_per_sec'] = [run['ops_per_sec'] for run in runs]
+    return result
+
+
+def result_key(result: dict) -> str:
+    return f'{result["scenario"]}/{result["cards"]}/skew={result["skew"]}/p={result["processes"]}'
+
+
+def environment() -> dict:
+    '''Описание окружения: без него сравнение с базовой линией с другой машины ничего не значит'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float, latency_tolerance: float) -> list:
+    '''Вывод сравнения с базовой линией. Возвращает ключи сценариев с регрессией'''
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    print(f'\nСравнение с базовой линией от {baseline["environment"]["created"]} '
+          f'(коммит {baseline["environment"]["commit"]})')
+    print(f'{"сценарий":<36} | {"было оп/с":>10} | {"стало оп/с":>10} | {"изм.":>7} | {"p99 изм.":>8} |')
+    for result in results:
+        key = result_key(result)
+        old = previous.get(key)
+        if old == None:
+            print(f'{key:<36} | {"-":>10} | {result["ops_per_sec"]:>10.0f} | {"нет в базовой линии":>20}')
+            continue
+        throughput = result['ops_per_sec'] / old['ops_per_sec'] - 1 if old['ops_per_sec'] else 0.0
+        p99 = result['latency_us']['p99'] / old['latency_us']['p99'] - 1 if old['latency_us']['p99'] else 0.0
+        regressed = throughput < -tolerance or p99 > latency_tolerance
+        if regressed:
+            regressions.append(key)
+        print(f'{key:<36} | {old["ops_per_sec"]:>10.0f} | {result["ops_per_sec"]:>10.0f} | {throughput:>+7.1%} | '
+              f'{p99:>+8.1%} | {"РЕГРЕССИЯ" if regressed else "ок"}')
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 100_000], help=f'карт в базе, например {SIZES}')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--skew', type=float, nargs='+', default=[0.0, 1.1], help='показатель Ципфа, 0 - равномерно')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--ops', type=int, default=2000, help='операций на процесс')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов, в результат идут медианы')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--pin-iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--data-dir', help='каталог для сохранения сгенерированных наборов данных')
+    parser.add_argument('--output', help='файл результатов JSON')
+    parser.add_argument('--baseline', help='JSON прежнего запуска для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='допустимое падение оп/с')
+    parser.add_argument('--latency-tolerance', type=float, default=0.25, help='допустимый рост p99')
+    args = parser.parse_args()
+
+    results = []
+    print(f'{"сценарий":<36} | {"оп/с":>10} | {"p50, мкс":>9} | {"p99, мкс":>9} | {"ошибок":>6}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            db_path = os.path.join(tmp, f'cards-{size}.db')
+            prepare_dataset(db_path, size, args.pin_iterations, args.data_dir)
+            for scenario in args.scenarios:
+                for skew in (args.skew if scenario != 'bulk_insert' else args.skew[:1]):
+                    for processes in sorted(set(args.processes)):
+                        runs = [run_scenario(db_path, scenario, size, skew, processes, args.ops,
+                                             args.seed + repeat, args.pin_iterations)
+                                for repeat in range(args.repeat)]
+                        result = median_run(runs)
+                        results.append(result)
+                        print(f'{result_key(result):<36} | {result["ops_per_sec"]:>10.0f} | '
+                              f'{result["latency_us"]["p50"]:>9.1f} | {result["latency_us"]["p99"]:>9.1f} | '
+                              f'{result["errors"]:>6}')
+            os.remove(db_path)
+
+    report = {'environment': environment(), 'args': vars(args), 'results': results}
+    if args.output != None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f'Результаты записаны в {args.output}')
+    if args.baseline != None:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance, args.latency_tolerance)
+        if regressions:
+            print(f'Регрессий: {len(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+'''Кассеты банкомата, подбор купюр для выдачи и пересчет внесенных купюр.
+
+Содержимое кассет каждого банкомата - таблица Cassettes (банкомат, валюта, номинал, число купюр).
+Снятие с указанием банкомата (ATMEngine.withdraw(..., atm_id=...)) подбирает купюры dispense()
+и списывает их из кассет в той же транзакции, что и деньги со счета: пообещать выдачу,
+которую банкомат не может собрать из имеющихся купюр, нельзя.
+
+Внесение наличных: count_notes() пересчитывает поток купюр от модуля приема, результат
+зачисляет ATMEngine.deposit_notes одной транзакцией.
+
+Загрузка и просмотр кассет:
+    python cash.py 1 RUB:5000=200 RUB:1000=500 USD:100=300 [--db atm.db]
+    python cash.py 1
+'''
+import argparse
+from collections import Counter
+from math import gcd
+from typing import NamedTuple
+
+from currencies import DEPOSIT_NOTES
+from db_pool import configure, get_pool
+from migrations import migrate
+from queries import QUERIES
+
+
+# Номиналы купюр в кассетах по умолчанию, в целых единицах валюты
+DEFAULT_NOTES = {
+    'RUB': (5000, 2000, 1000, 500, 200, 100, 50),
+    'USD': (100, 50, 20, 10, 5),
+    'EUR': (500, 200, 100, 50, 20, 10, 5),
+}
+
+
+def dispense(amount: int, stock: dict) -> dict | None:
+    '''Купюры для выдачи amount целых единиц из stock {номинал: число купюр}.
+    Возвращает {номинал: число купюр} или None, если сумму не собрать.
+
+    Сначала - жадная выдача от крупных купюр, если она не сходится - перебор от крупных номиналов
+    к мелким, начиная с максимума крупных купюр. Остаток, который больше суммы всех мелких купюр
+    или не делится на их НОД, сразу отбрасывается, а неудачные пары (номинал, остаток)
+    запоминаются - перебор не проходит их повторно
+    '''
+    if amount < 0:
+        return None
+    notes = sorted(((note, count) for note, count in stock.items() if count > 0), reverse=True)
+    # Быстрый путь - жадная выдача от крупных купюр: для обычных наборов номиналов и достаточных остатков
+    # она и есть ответ, перебор нужен только когда жадный выбор заходит в тупик
+    greedy = {}
+    rest = amount
+    for note, count in notes:
+        taken = min(count, rest // note)
+        if taken:
+            greedy[note] = taken
+            rest -= taken * note
+    if rest == 0:
+        return greedy
+
+    # Для каждого номинала: сколько всего можно выдать им и более мелкими купюрами и НОД этих номиналов
+    capacity = [0] * (len(notes) + 1)
+    divisor = [0] * (len(notes) + 1)
+    for i in range(len(notes) - 1, -1, -1):
+        capacity[i] = capacity[i + 1] + notes[i][0] * notes[i][1]
+        divisor[i] = gcd(divisor[i + 1], notes[i][0])
+    failed = set()
+
+    def solve(i: int, rest: int) -> list | None:
+        if rest == 0:
+            return []
+        if rest > capacity[i] or rest % divisor[i] != 0 or (i, rest) in failed:
+            return None
+        note, count = notes[i]
+        # Меньше купюр этого номинала взять нельзя: остаток не покроют мелкие
+        least = max(0, -(-(rest - capacity[i + 1]) // note))
+        for taken in range(min(count, rest // note), least - 1, -1):
+            tail = solve(i + 1, rest - taken * note)
+            if tail != None:
+                return [(note, taken)] + tail if taken else tail
+        failed.add((i, rest))
+        return None
+
+    result = solve(0, amount)
+    return None if result == None else dict(result)
+
+
+class NoteCount(NamedTuple):
+    '''Итог пересчета купюр одного внесения'''
+    currency: str
+    notes: dict  # Принятые купюры {номинал: число}
+    rejected: dict  # Возвращаемые клиенту {(валюта, номинал): число}
+
+    def total(self) -> int:
+        '''Сумма принятых купюр в целых единицах валюты'''
+        return sum(note * count for note, count in self.notes.items())
+
+
+def count_notes(events, currency: str) -> NoteCount:
+    '''Пересчет потока событий модуля приема наличных (валюта, номинал) для внесения в currency.
+    В памяти - только счетчики по номиналам, сколько бы купюр ни было. Купюры другой валюты
+    и номиналов не из DEPOSIT_NOTES не принимаются'''
+    accepted = DEPOSIT_NOTES[currency]
+    notes = Counter()
+    rejected = Counter()
+    for note_currency, note in events:
+        if note_currency == currency and note in accepted:
+            notes[note] += 1
+        else:
+            rejected[(note_currency, note)] += 1
+    return NoteCount(currency, dict(notes), dict(rejected))
+
+
+def format_notes(notes: dict) -> str:
+    '''{5000: 2, 100: 3} -> "5000 x 2, 100 x 3"'''
+    return ', '.join(f'{note} x {count}' for note, count in sorted(notes.items(), reverse=True))
+
+
+def load_cassettes(atm_id: int, currency: str, notes: dict) -> None:
+    '''Установка числа купюр в кассетах банкомата: notes {номинал: число купюр}'''
+    get_pool().run_in_transaction(lambda db: db.executemany(QUERIES['load_cassette'], [
+        (atm_id, currency, note, count) for note, count in notes.items()]))
+
+
+def cassettes(atm_id: int) -> dict:
+    '''Содержимое кассет банкомата: {валюта: {номинал: число купюр}}'''
+    result = {}
+    for currency, note, count in get_pool().connection().query('atm_cassettes', (atm_id,)).fetchall():
+        result.setdefault(currency, {})[note] = count
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Загрузка и просмотр кассет банкомата')
+    parser.add_argument('atm_id', type=int)
+    parser.add_argument('load', nargs='*', help='ВАЛЮТА:НОМИНАЛ=ЧИСЛО, например RUB:5000=200')
+    parser.add_argument('--db', default='atm.db')
+    args = parser.parse_args()
+
+    configure(args.db, concurrent=True)
+    migrate(get_pool().connection())  # Нужна таблица Cassettes
+    try:
+        loads = {}
+        for item in args.load:
+            currency, _, rest = item.partition(':')
+            note, _, count = rest.partition('=')
+            loads.setdefault(currency.upper(), {})[int(note)] = int(count)
+        for currency, notes in loads.items():
+            load_cassettes(args.atm_id, currency, notes)
+        for currency, notes in cassettes(args.atm_id).items():
+            print(f'{currency}: {format_notes(notes)}, всего {sum(note * count for note, count in notes.items())}')
+    finally:
+        get_pool().close()
+
+
+if __name__ == '__main__':
+    main()
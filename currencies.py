@@ -0,0 +1,28 @@
+from typing import NamedTuple
+
+
+class CurrencyRules(NamedTuple):
+    '''Ограничения операций с наличными для валюты, в целых единицах валюты'''
+    withdraw_min: int
+    withdraw_max: int
+    withdraw_note: int  # Минимальный номинал купюры для выдачи
+    deposit_min: int
+    deposit_max: int
+    deposit_note: int  # Минимальный номинал принимаемой купюры
+
+
+# Поддерживаемые валюты. Новая валюта - одна строка здесь и курс в файле курсов, схема базы не меняется
+CURRENCY_RULES = {
+    'RUB': CurrencyRules(50, 1000000, 50, 10, 1000000, 10),
+    'USD': CurrencyRules(5, 100000, 5, 5, 100000, 5),
+    'EUR': CurrencyRules(5, 100000, 5, 5, 100000, 5),
+}
+
+CURRENCIES = tuple(CURRENCY_RULES)
+
+# Номиналы купюр, которые принимает модуль приема наличных. Остальные купюры возвращаются клиенту
+DEPOSIT_NOTES = {
+    'RUB': frozenset((10, 50, 100, 200, 500, 1000, 2000, 5000)),
+    'USD': frozenset((5, 10, 20, 50, 100)),
+    'EUR': frozenset((5, 10, 20, 50, 100, 200, 500)),
+}
@@ -0,0 +1,235 @@
+import sqlite3
+import threading
+import time
+
+from queries import QUERIES
+
+
+# PRAGMA, которые выставляются один раз при открытии соединения
+DEFAULT_PRAGMAS = (
+    ('foreign_keys', 'ON'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000),  # Отрицательное значение - размер кэша в КиБ
+)
+
+# Режим для нескольких терминалов на одной базе: читатели не блокируются писателем
+CONCURRENT_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),  # В WAL-режиме fsync только на checkpoint, целостность сохраняется
+    ('busy_timeout', 5000),
+    ('wal_autocheckpoint', 1000),  # Пассивный checkpoint каждые ~1000 страниц журнала
+)
+
+
+class PoolExhaustedError(Exception):
+    '''Все соединения пула заняты живыми потоками'''
+
+
+class PooledConnection(sqlite3.Connection):
+    '''Долгоживущее соединение пула: запросы реестра queries.QUERIES по имени через один курсор'''
+
+    # commit() всех соединений процесса: начатые и завершенные. По ним BalanceCache отличает свои записи от чужих.
+    # Меняются из всех потоков, поэтому только под _counter_lock
+    _counter_lock = threading.Lock()
+    _commits_started = 0
+    _commits = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursor = self.cursor()
+
+    def query(self, name: str, params=()) -> sqlite3.Cursor:
+        '''Выполнение запроса реестра. Курсор общий: результат нужно забрать до следующего query'''
+        return self._cursor.execute(QUERIES[name], params)
+
+    def commit(self) -> None:
+        with PooledConnection._counter_lock:
+            PooledConnection._commits_started += 1
+        try:
+            super().commit()
+        finally:
+            with PooledConnection._counter_lock:
+                PooledConnection._commits += 1
+
+    @staticmethod
+    def commit_counts() -> tuple:
+        '''Число начатых и завершенных commit всех соединений процесса'''
+        with PooledConnection._counter_lock:
+            return PooledConnection._commits_started, PooledConnection._commits
+
+
+class ConnectionPool:
+    '''Пул соединений с базой. Каждый поток получает свое соединение и переиспользует его'''
+
+    def __init__(self, db_path: str = 'atm.db', max_connections: int = 8, timeout: float = 5.0,
+                 pragmas: tuple = DEFAULT_PRAGMAS, concurrent: bool = False, checkpoint_interval: float = 30.0):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout  # Сколько ждать освобождения соединения при исчерпании пула
+        self.concurrent = concurrent
+        self.pragmas = pragmas + CONCURRENT_PRAGMAS if concurrent else pragmas
+        self._local = threading.local()
+        self._connections = {}  # thread -> соединение, нужно для ограничения размера и закрытия
+        self._cond = threading.Condition()
+        self._checkpointer = None
+        self._stop = threading.Event()
+        if concurrent and checkpoint_interval:
+            # Автоматический checkpoint не срабатывает, пока журнал постоянно читают - поэтому еще и по таймеру
+            self._checkpointer = threading.Thread(
+                target=self._checkpoint_loop, args=(checkpoint_interval,), name='wal-checkpoint', daemon=True)
+            self._checkpointer.start()
+
+    def _open(self) -> sqlite3.Connection:
+        # check_same_thread=False нужен только для закрытия соединений умерших потоков из другого потока
+        # Кэш подготовленных выражений с запасом вмещает весь реестр запросов
+        db = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                             factory=PooledConnection, cached_statements=256)
+        for name, value in self.pragmas:
+            db.execute(f'PRAGMA {name} = {value};')
+        return db
+
+    def _drop_dead(self) -> None:
+        '''Закрытие соединений потоков, которые уже завершились. Вызывается под self._cond'''
+        for thread in [t for t in self._connections if not t.is_alive()]:
+            self._connections.pop(thread).close()
+
+    def connection(self) -> sqlite3.Connection:
+        '''Соединение текущего потока. Используется как "with pool.connection() as db:" - commit при выходе'''
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            return db
+
+        thread = threading.current_thread()
+        with self._cond:
+            self._drop_dead()
+            if len(self._connections) >= self.max_connections:
+                self._cond.wait_for(self._has_free_slot, timeout=self.timeout)
+            if len(self._connections) >= self.max_connections:
+                raise PoolExhaustedError(f'Превышен лимит соединений с {self.db_path}: {self.max_connections}')
+            db = self._open()
+            self._connections[thread] = db
+        self._local.db = db
+        return db
+
+    def _has_free_slot(self) -> bool:
+        self._drop_dead()
+        return len(self._connections) < self.max_connections
+
+    def release(self) -> None:
+        '''Явное закрытие соединения текущего потока (например, при завершении рабочего потока)'''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            return
+        self._local.db = None
+        with self._cond:
+            self._connections.pop(threading.current_thread(), None)
+            db.close()
+            self._cond.notify()
+
+    def run_in_transaction(self, func, *args, retries: int = 5):
+        '''Выполнение func(db, *args) в транзакции BEGIN IMMEDIATE с повтором, если база занята.
+
+        IMMEDIATE сразу берет блокировку записи, поэтому чтение и запись внутри func не перемежаются
+        с чужими записями. Если транзакция потока уже открыта, func выполняется в ней без commit
+        '''
+        db = self.connection()
+        if db.in_transaction:
+            return func(db, *args)
+        for attempt in range(retries + 1):
+            try:
+                db.execute('BEGIN IMMEDIATE;')
+                result = func(db, *args)
+                db.commit()
+                return result
+            except sqlite3.OperationalError as error:
+                if db.in_transaction:
+                    db.rollback()
+                if attempt == retries or not _is_busy(error):
+                    raise
+                time.sleep(0.01 * 2 ** attempt)  # Экспоненциальная пауза перед повтором
+            except BaseException:
+                if db.in_transaction:
+                    db.rollback()
+                raise
+
+    def checkpoint(self, mode: str = 'PASSIVE') -> tuple:
+        '''Перенос WAL-журнала в основной файл. Возвращает (занято, страниц в журнале, перенесено)'''
+        # Отдельное соединение, чтобы не занимать слот пула и не мешать транзакциям потока.
+        # Закрывается явно: "with" только фиксирует транзакцию, а соединение в цикле ссылок с кэшем
+        # выражений живет до сборки мусора - и, если процесс успел сделать fork, закрывается в потомке
+        db = sqlite3.connect(self.db_path, timeout=self.timeout)
+        try:
+            return db.execute(f'PRAGMA wal_checkpoint({mode});').fetchone()
+        finally:
+            db.close()
+
+    def _checkpoint_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.checkpoint('PASSIVE')
+            except sqlite3.Error:
+                pass  # База занята - повторим на следующем шаге
+
+    def close(self) -> None:
+        '''Закрытие всех соединений пула'''
+        self._stop.set()
+        if self._checkpointer != None:
+            self._checkpointer.join()
+            self._checkpointer = None
+        if self.concurrent and self._connections:
+            try:
+                self.checkpoint('TRUNCATE')  # Не оставляем большой журнал после завершения работы
+            except sqlite3.Error:
+                pass
+        with self._cond:
+            for db in self._connections.values():
+                db.close()
+            self._connections.clear()
+            self._cond.notify_all()
+        self._local = threading.local()
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    '''База заблокирована другим соединением - операцию можно повторить'''
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+_pool = ConnectionPool()
+_router = None  # Маршрутизация карт по шардам (shards.ShardRouter), None - одна база
+
+
+def get_pool(card_number: int | None = None) -> ConnectionPool:
+    '''Пул базы, в которой хранится карта card_number. Без шардирования и при card_number=None -
+    общий пул, при шардировании это основная база (шард 0): кассеты и другие данные не по картам'''
+    if _router == None or card_number == None:
+        return _pool
+    return _router.pool(card_number)
+
+
+def all_pools() -> list:
+    '''Пулы всех баз: для миграций, отчетов и выгрузок по всем картам'''
+    return [_pool] if _router == None else _router.pools
+
+
+def configure(db_path: str = 'atm.db', max_connections: int = 8, **kwargs) -> ConnectionPool:
+    '''Замена общего пула, например, для работы с другим файлом базы. Шардирование выключается'''
+    global _pool, _router
+    close_all()
+    _router = None
+    _pool = ConnectionPool(db_path, max_connections, **kwargs)
+    return _pool
+
+
+def configure_router(router) -> None:
+    '''Включение шардирования: router.pool(card_number) - пул базы карты, router.pools[0] - основная база'''
+    global _pool, _router
+    close_all()
+    _router = router
+    _pool = router.pools[0]
+
+
+def close_all() -> None:
+    '''Закрытие пулов всех баз'''
+    for pool in all_pools():
+        pool.close()
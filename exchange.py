@@ -0,0 +1,166 @@
+'''Курсы валют и пересчет балансов.
+
+Курсы читаются из JSON-файла вида
+    {"base": "RUB", "rates": {"RUB": "1", "USD": "92.5", "EUR": "100.25"}}
+где rates - цена единицы валюты в базовой валюте. Таблица курсов неизменяема: при изменении
+файла читается новая и подменяется одним присваиванием, поэтому операция, взявшая таблицу
+через current(), до конца считает по одним и тем же курсам.
+'''
+import json
+import os
+import threading
+import time
+from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR
+
+from currencies import CURRENCIES
+from db_pool import all_pools
+from queries import QUERIES
+
+try:
+    import numpy as np
+except ImportError:  # Пересчет работает и без numpy, но медленнее
+    np = None
+
+
+class RateTableError(Exception):
+    '''Файл курсов отсутствует или некорректен'''
+
+
+class RateTable:
+    '''Неизменяемая таблица курсов'''
+
+    def __init__(self, base: str, rates: dict, loaded_at: float):
+        self.base = base
+        self.rates = rates  # Валюта -> Decimal, цена единицы в базовой валюте
+        self.loaded_at = loaded_at
+
+    def rate(self, currency: str, to_currency: str) -> Decimal:
+        '''Сколько единиц to_currency стоит единица currency'''
+        return self.rates[currency] / self.rates[to_currency]
+
+    def convert(self, amount: int, currency: str, to_currency: str, round_up: bool = False) -> int:
+        '''Пересчет суммы в минимальных единицах. По умолчанию округление вниз - в пользу банка
+        при зачислении клиенту; round_up=True - для суммы, которую клиент платит'''
+        value = Decimal(amount) * self.rates[currency] / self.rates[to_currency]
+        return int(value.to_integral_value(rounding=ROUND_CEILING if round_up else ROUND_FLOOR))
+
+
+def parse_rates(text: str) -> RateTable:
+    try:
+        data = json.loads(text)
+        base = data['base']
+        rates = {currency: Decimal(str(value)) for currency, value in data['rates'].items()}
+    except (ValueError, KeyError, TypeError, AttributeError, InvalidOperation) as error:
+        raise RateTableError(f'Некорректный файл курсов: {error}') from error
+    missing = set(CURRENCIES) - set(rates)
+    if missing:
+        raise RateTableError(f'Нет курсов для валют: {", ".join(sorted(missing))}')
+    if any(rate <= 0 for rate in rates.values()) or rates.get(base) != 1:
+        raise RateTableError('Курсы должны быть положительными, курс базовой валюты - 1')
+    return RateTable(base, rates, time.time())
+
+
+class ExchangeRates:
+    '''Текущая таблица курсов из файла path. Изменение файла проверяется не чаще раза в check_interval
+    секунд. Если новый файл некорректен, остается прежняя таблица, а ошибка - в last_error'''
+
+    def __init__(self, path: str = 'rates.json', check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.last_error = None
+        self._table = None
+        self._stamp = None  # (mtime_ns, size) загруженного файла
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, path: str, check_interval: float | None = None) -> None:
+        with self._lock:
+            self.path = path
+            if check_interval != None:
+                self.check_interval = check_interval
+            self._table = None
+            self._stamp = None
+            self._next_check = 0.0
+
+    def current(self) -> RateTable:
+        if time.monotonic() >= self._next_check:
+            self._reload_if_changed()
+        table = self._table
+        if table == None:
+            raise RateTableError(f'Курсы валют не загружены: {self.last_error}')
+        return table
+
+    def _reload_if_changed(self) -> None:
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return  # Файл уже проверил другой поток
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                stat = os.stat(self.path)
+                if (stat.st_mtime_ns, stat.st_size) == self._stamp:
+                    return
+                with open(self.path, encoding='utf-8') as file:
+                    table = parse_rates(file.read())
+            except (OSError, RateTableError) as error:
+                self.last_error = error
+                return
+            self._table = table  # Подмена целиком: читатели видят либо старую, либо новую таблицу
+            self._stamp = (stat.st_mtime_ns, stat.st_size)
+            self.last_error = None
+
+
+exchange_rates = ExchangeRates()
+
+
+def revalue_accounts(currency: str, chunk_size: int = 100_000):
+    '''Оценка в валюте currency всех карт, у которых есть счета: генератор пачек (номера карт, оценки
+    в минимальных единицах). Счета читаются пачками по chunk_size строк (карта, валюта, баланс);
+    с numpy курс подставляется и суммируется по картам векторно, пачки - массивы int64.
+    Оценка в float64 - для отчетов; точная сумма по всем картам - revaluation_total.
+    При шардировании базы читаются по очереди, пачка не выходит за пределы шарда'''
+    table = exchange_rates.current()
+    factors = {account_currency: float(table.rate(account_currency, currency)) for account_currency in table.rates}
+    for pool in all_pools():
+        # Свой курсор: общий курсор db.query сбросит другой запрос
+        cur = pool.connection().execute(QUERIES['account_balances'])
+        tail = []
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            rows = tail + rows if tail else rows
+            # Счета последней карты могут продолжиться в следующей пачке - она оценивается вместе с ней
+            split = len(rows)
+            while split > 0 and rows[split - 1][0] == rows[-1][0]:
+                split -= 1
+            tail = rows[split:]
+            if split > 0:
+                yield _revalue_rows(rows[:split], factors)
+        if tail:
+            yield _revalue_rows(tail, factors)
+
+
+def _revalue_rows(rows: list, factors: dict):
+    if np == None:
+        values = {}
+        for card_number, account_currency, balance in rows:
+            values[card_number] = values.get(card_number, 0.0) + balance * factors[account_currency]
+        return list(values), [round(value) for value in values.values()]
+
+    data = np.array(rows, dtype=[('card', np.int64), ('currency', 'U3'), ('balance', np.int64)])
+    rates = np.zeros(len(data))
+    # Валют несколько: маска по столбцу быстрее, чем поиск курса в словаре для каждой строки
+    for account_currency, factor in factors.items():
+        rates[data['currency'] == account_currency] = factor
+    cards = data['card']
+    starts = np.flatnonzero(np.diff(cards, prepend=cards[0] - 1))  # Первая строка каждой карты
+    values = np.add.reduceat(data['balance'] * rates, starts)
+    return cards[starts], np.rint(values).astype(np.int64)
+
+
+def revaluation_total(currency: str) -> int:
+    '''Точная сумма всех балансов в валюте currency: суммы по валютам считает sqlite, курс - Decimal'''
+    table = exchange_rates.current()
+    return sum(table.convert(total, account_currency, currency)
+               for pool in all_pools()
+               for account_currency, total in pool.connection().query('balance_totals').fetchall())
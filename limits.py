@@ -0,0 +1,260 @@
+'''Лимиты снятия и частоты операций в памяти процесса.
+
+- Суточный лимит снятия по карте и валюте - скользящее окно 24 часа из часовых корзин.
+- Частота снятий по карте и по терминалу - token bucket: запас burst операций,
+  пополняется со скоростью rate операций в секунду.
+- Неверные пин-коды с одного терминала - token bucket, против подбора пин-кодов перебором карт.
+
+Проверка - O(1) без запросов к базе: сумма окна хранится готовой, корзины сдвигаются не дальше
+их числа. Состояние разбито на полосы со своими блокировками по хэшу ключа, поэтому частые
+операции одной карты не задерживают остальные. Каждые snapshot_interval секунд состояние
+сохраняется в JSON-файл (запись во временный файл и переименование) и читается при старте,
+так что перезапуск сервера не обнуляет суточные лимиты.
+'''
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import NamedTuple
+
+
+class LimitRules(NamedTuple):
+    '''Параметры лимитов. Суточные лимиты - в целых единицах валюты'''
+    daily_withdraw: dict = {'RUB': 2_000_000, 'USD': 200_000, 'EUR': 200_000}
+    card_burst: int = 10  # Снятий по карте подряд
+    card_rate: float = 1 / 30  # Дальше - одно снятие в 30 секунд
+    terminal_burst: int = 60
+    terminal_rate: float = 1.0
+    pin_burst: int = 20  # Неверных пин-кодов с терминала подряд
+    pin_rate: float = 1 / 60
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, now: float, rate: float, burst: int) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class SlidingWindow:
+    '''Сумма за последние slots * step секунд. Корзина - step секунд, устаревшие корзины обнуляются
+    при обращении; граница окна точна до одной корзины'''
+    __slots__ = ('slots', 'last', 'total')
+
+    def __init__(self, slots: int, last: int = 0, values: list | None = None):
+        self.slots = values if values != None else [0] * slots
+        self.last = last  # Номер последней корзины (время // step)
+        self.total = sum(self.slots)
+
+    def advance(self, index: int) -> None:
+        size = len(self.slots)
+        if index - self.last >= size:
+            self.slots = [0] * size
+            self.total = 0
+        else:
+            for i in range(self.last + 1, index + 1):  # Не больше size шагов
+                self.total -= self.slots[i % size]
+                self.slots[i % size] = 0
+        self.last = max(self.last, index)
+
+
+class Limiter:
+    '''Лимиты операций. По умолчанию выключен: включается configure(enabled=True)'''
+
+    STRIPES = 64
+    WINDOW_SLOTS = 24
+    WINDOW_STEP = 3600  # Секунд в корзине окна
+
+    def __init__(self, rules: LimitRules = LimitRules(), enabled: bool = False):
+        self.rules = rules
+        self.enabled = enabled
+        self._locks = [threading.Lock() for _ in range(self.STRIPES)]
+        self._buckets = {}  # (вид, ключ) -> TokenBucket
+        self._windows = {}  # (карта, валюта) -> SlidingWindow
+        self._snapshot_path = None
+        self._snapshotter = None
+        self._stop = threading.Event()
+
+    def configure(self, enabled: bool | None = None, rules: LimitRules | None = None,
+                  snapshot_path: str | None = None, snapshot_interval: float = 10.0) -> None:
+        '''snapshot_path - файл снимка: состояние читается из него сразу и сохраняется периодически'''
+        if enabled != None:
+            self.enabled = enabled
+        if rules != None:
+            self.rules = rules
+        if snapshot_path != None:
+            self.close()
+            self._snapshot_path = snapshot_path
+            self.load(snapshot_path)
+            self._stop = threading.Event()
+            self._snapshotter = threading.Thread(
+                target=self._snapshot_loop, args=(snapshot_interval,), name='limits-snapshot', daemon=True)
+            self._snapshotter.start()
+
+    def _lock(self, key) -> threading.Lock:
+        return self._locks[hash(key) % self.STRIPES]
+
+    @contextlib.contextmanager
+    def _locked(self, *keys):
+        '''Блокировки полос нескольких ключей (None пропускается), без ключей - всех полос. Берутся
+        по возрастанию номера полосы, чтобы потоки с общими полосами не ждали друг друга по кругу'''
+        stripes = sorted({hash(key) % self.STRIPES for key in keys if key != None}) if keys else range(self.STRIPES)
+        with contextlib.ExitStack() as stack:
+            for stripe in stripes:
+                stack.enter_context(self._locks[stripe])
+            yield
+
+    def _bucket_rules(self, kind: str) -> tuple:
+        '''(rate, burst) корзины вида card, terminal или pin'''
+        rules = self.rules
+        return {'card': (rules.card_rate, rules.card_burst), 'terminal': (rules.terminal_rate, rules.terminal_burst),
+                'pin': (rules.pin_rate, rules.pin_burst)}[kind]
+
+    def _take(self, key: tuple, now: float, take: bool = True) -> bool:
+        '''Взять токен из корзины key = (вид, ключ). take=False - только проверить, что токен есть'''
+        rate, burst = self._bucket_rules(key[0])
+        bucket = self._buckets.get(key)
+        if bucket == None:
+            bucket = self._buckets.setdefault(key, TokenBucket(burst, now))
+        bucket.refill(now, rate, burst)
+        if bucket.tokens < 1:
+            return False
+        if take:
+            bucket.tokens -= 1
+        return True
+
+    def withdraw(self, card_number: int, terminal: int | str | None, currency: str, amount: int) -> str | None:
+        '''Учет снятия amount целых единиц. Возвращает причину отказа или None - снятие учтено.
+        terminal - номер банкомата или другой ключ терминала (адрес подключения), None - без лимита терминала.
+        Если операция затем не выполнилась, сумму нужно вернуть refund_withdraw'''
+        if not self.enabled:
+            return None
+        rules = self.rules
+        now = time.time()
+        card_key = ('card', card_number)
+        terminal_key = ('terminal', terminal) if terminal != None else None
+        window_key = (card_number, currency)
+        # Сначала все проверки, токены и сумма берутся, только если прошли все: отказ ничего не расходует
+        with self._locked(card_key, terminal_key):
+            if terminal_key != None and not self._take(terminal_key, now, take=False):
+                return 'Превышена частота операций на банкомате, повторите позже.'
+            limit = rules.daily_withdraw.get(currency)
+            window = None
+            if limit != None:
+                window = self._windows.get(window_key)
+                if window == None:
+                    window = self._windows.setdefault(window_key, SlidingWindow(self.WINDOW_SLOTS))
+                window.advance(int(now // self.WINDOW_STEP))
+                if window.total + amount > limit:
+                    return (f'Превышен суточный лимит снятия {limit} {currency}, '
+                            f'доступно еще {max(0, limit - window.total)} {currency}.')
+            if not self._take(card_key, now, take=False):
+                return 'Превышена частота снятий по карте, повторите позже.'
+            if terminal_key != None:
+                self._take(terminal_key, now)
+            self._take(card_key, now)
+            if window != None:
+                window.slots[window.last % self.WINDOW_SLOTS] += amount
+                window.total += amount
+        return None
+
+    def refund_withdraw(self, card_number: int, currency: str, amount: int) -> None:
+        '''Возврат суммы неудавшегося снятия в суточный лимит'''
+        if not self.enabled:
+            return
+        with self._lock(('card', card_number)):
+            window = self._windows.get((card_number, currency))
+            if window == None:
+                return
+            slot = window.last % self.WINDOW_SLOTS
+            returned = min(amount, window.slots[slot])  # Корзина могла устареть - возвращаем не больше, чем в ней
+            window.slots[slot] -= returned
+            window.total -= returned
+
+    def pin_allowed(self, terminal: int | str | None) -> bool:
+        '''Можно ли вводить пин-код на терминале: не исчерпан запас неверных попыток'''
+        if not self.enabled or terminal == None:
+            return True
+        key = ('pin', terminal)
+        with self._lock(key):
+            return self._take(key, time.time(), take=False)
+
+    def pin_failed(self, terminal: int | str | None) -> None:
+        if not self.enabled or terminal == None:
+            return
+        key = ('pin', terminal)
+        with self._lock(key):
+            self._take(key, time.time())
+
+    def clear(self) -> None:
+        with self._locked():
+            self._buckets.clear()
+            self._windows.clear()
+
+    def snapshot(self) -> dict:
+        '''Состояние для сохранения. Полные корзины и пустые окна не сохраняются - они равны новым'''
+        now = time.time()
+        index = int(now // self.WINDOW_STEP)
+        buckets = []
+        for key, bucket in list(self._buckets.items()):
+            with self._lock(key):
+                rate, burst = self._bucket_rules(key[0])
+                bucket.refill(now, rate, burst)
+                if bucket.tokens >= burst:
+                    del self._buckets[key]  # Заодно освобождаем память от давно неактивных ключей
+                else:
+                    buckets.append([key[0], key[1], bucket.tokens, bucket.updated])
+        windows = []
+        for key, window in list(self._windows.items()):
+            with self._lock(('card', key[0])):
+                window.advance(index)
+                if window.total == 0:
+                    del self._windows[key]
+                else:
+                    windows.append([key[0], key[1], window.last, window.slots])
+        return {'saved_at': now, 'buckets': buckets, 'windows': windows}
+
+    def save(self, path: str) -> None:
+        data = json.dumps(self.snapshot())
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)  # Атомарная подмена: при сбое остается прежний снимок
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        with self._locked():
+            for kind, key, tokens, updated in data['buckets']:
+                self._buckets[(kind, key)] = TokenBucket(tokens, updated)
+            for card_number, currency, last, values in data['windows']:
+                self._windows[(card_number, currency)] = SlidingWindow(self.WINDOW_SLOTS, last, values)
+
+    def _snapshot_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.save(self._snapshot_path)
+            except OSError:
+                pass  # Диск недоступен - повторим на следующем шаге, лимиты продолжают работать
+
+    def close(self) -> None:
+        '''Остановка периодического сохранения и последний снимок'''
+        self._stop.set()
+        if self._snapshotter != None:
+            self._snapshotter.join()
+            self._snapshotter = None
+            self.save(self._snapshot_path)
+
+
+limiter = Limiter()
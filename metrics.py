@@ -0,0 +1,384 @@
+'''Замеры времени операций и запросов и выгрузка метрик в формате Prometheus.
+
+Включение - metrics.configure(enabled=True, ...): только тогда методы ATMEngine, консольные
+операции SQLatm, запросы, соединения и транзакции пула подменяются обертками с замерами.
+Выключенные метрики ничего не стоят: код работает с исходными функциями без единой проверки.
+
+Время копится в гистограммах с логарифмическими корзинами (8 корзин на каждое удвоение,
+погрешность не больше 12.5%), как в HdrHistogram. У каждого потока свои гистограммы и счетчики -
+запись идет без блокировок, потоки сводятся только при выгрузке.
+
+Метрики:
+    sqlatm_operation_seconds{operation}   операции ATMEngine
+    sqlatm_console_seconds{step}          консольные операции SQLatm вместе с ожиданием ввода
+    sqlatm_input_wait_seconds             ожидание ввода пользователя в консоли
+    sqlatm_query_seconds{query}           выполнение запроса реестра QUERIES (без чтения строк)
+    sqlatm_connect_seconds                открытие соединения пула
+    sqlatm_transaction_seconds            транзакция run_in_transaction вместе с повторами
+    sqlatm_commit_seconds                 commit
+    sqlatm_errors_total{operation,error}  исключения операций ATMEngine
+    sqlatm_commits_total, sqlatm_rollbacks_total, sqlatm_busy_retries_total
+    sqlatm_balance_cache_hits_total, ..._misses_total, sqlatm_balance_cache_size
+
+Выгрузка - в файл (для textfile collector node_exporter) раз в interval секунд
+и/или по HTTP: GET http://host:port/metrics.
+'''
+import functools
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter_ns
+
+import sql_query
+from atm_engine import ATMEngine
+from balance_cache import balance_cache
+from db_pool import ConnectionPool, PooledConnection
+import db_pool
+
+
+SUB_BITS = 3  # 2 ** SUB_BITS корзин на удвоение
+BUCKETS = 320  # Хватает до ~2 ** 40 нс (18 минут), дольше - в последнюю корзину
+EXPORT_OCTAVES = range(10, 37)  # Границы le при выгрузке: 2 ** k нс, от ~1 мкс до ~69 с
+
+# Имя -> (тип, метка, описание)
+METRICS = {
+    'sqlatm_operation_seconds': ('histogram', 'operation', 'Время операций ATMEngine'),
+    'sqlatm_console_seconds': ('histogram', 'step', 'Время консольных операций SQLatm вместе с ожиданием ввода'),
+    'sqlatm_input_wait_seconds': ('histogram', None, 'Ожидание ввода пользователя в консоли'),
+    'sqlatm_query_seconds': ('histogram', 'query', 'Выполнение запроса реестра QUERIES'),
+    'sqlatm_connect_seconds': ('histogram', None, 'Открытие соединения пула'),
+    'sqlatm_transaction_seconds': ('histogram', None, 'Транзакция run_in_transaction вместе с повторами'),
+    'sqlatm_commit_seconds': ('histogram', None, 'Фиксация транзакции'),
+    'sqlatm_errors_total': ('counter', 'operation', 'Исключения операций ATMEngine'),
+    'sqlatm_commits_total': ('counter', None, 'Зафиксированные транзакции'),
+    'sqlatm_rollbacks_total': ('counter', None, 'Откаченные транзакции'),
+    'sqlatm_busy_retries_total': ('counter', None, 'Повторы транзакций из-за занятой базы'),
+}
+
+# Публичные операции движка и консоли, которые оборачиваются замерами
+ENGINE_OPERATIONS = ('authenticate', 'get_balance', 'withdraw', 'withdraw_exchange', 'deposit', 'deposit_notes',
+                     'transfer', 'transfer_exchange', 'transfer_many', 'get_history')
+CONSOLE_STEPS = ('login', 'info_balance', 'withdraw_money', 'deposit_money', 'transfer_money')
+
+
+class Histogram:
+    '''Логарифмическая гистограмма целых значений (наносекунд). Корзина включает верхнюю границу и не
+    включает нижнюю, как le в Prometheus: значение, равное границе, попадает в корзину ниже нее'''
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0
+
+    def record(self, value: int) -> None:
+        index = _bucket(value - 1)
+        self.counts[index if index < BUCKETS else BUCKETS - 1] += 1
+        self.total += value
+
+    def merge(self, other: 'Histogram') -> None:
+        counts = other.counts[:]  # Копия - владелец продолжает писать в свою
+        for index, count in enumerate(counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+
+    def count_le(self, value: int) -> int:
+        '''Число значений не больше value. value должно быть степенью двойки - границей корзины'''
+        return sum(self.counts[:_bucket(value)])
+
+
+def _bucket(value: int) -> int:
+    '''Номер корзины [начало, начало + ширина): до 2 ** SUB_BITS - по одному значению, дальше - 2 ** SUB_BITS
+    корзин на удвоение'''
+    shift = value.bit_length() - SUB_BITS - 1
+    return max(value, 0) if shift <= 0 else (shift << SUB_BITS) + (value >> shift)
+
+
+class _ThreadStore:
+    '''Гистограммы и счетчики одного потока: пишет только он сам'''
+    __slots__ = ('thread', 'histograms', 'counters')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.histograms = {}  # (метрика, значение метки) -> Histogram
+        self.counters = {}  # (метрика, значения меток) -> int
+
+    def observe(self, key: tuple, value: int) -> None:
+        histogram = self.histograms.get(key)
+        if histogram == None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(value)
+
+    def inc(self, key: tuple) -> None:
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+
+class Metrics:
+    '''Метрики процесса. По умолчанию выключены: включаются configure(enabled=True)'''
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self._stores = []  # _ThreadStore живых потоков
+        self._retired = _ThreadStore(None)  # Сводка завершившихся потоков
+        self._lock = threading.Lock()  # Только для списка потоков и сводки
+        self._originals = []  # (объект, имя, исходное значение или None - атрибута не было)
+        self._path = None
+        self._writer = None
+        self._server = None
+        self._stop = threading.Event()
+
+    def configure(self, enabled: bool | None = None, path: str | None = None, interval: float = 10.0,
+                  port: int | None = None, host: str = '127.0.0.1') -> None:
+        '''path - файл, в который метрики выгружаются раз в interval секунд; port - HTTP-эндпоинт /metrics'''
+        if enabled == True and not self.enabled:
+            self._instrument()
+        elif enabled == False and self.enabled:
+            self._restore()
+        if path != None:
+            self._stop_writer()
+            self._path = path
+            self._stop = threading.Event()
+            self._writer = threading.Thread(target=self._write_loop, args=(interval,), name='metrics-writer', daemon=True)
+            self._writer.start()
+        if port != None:
+            self._stop_server()
+            self._server = ThreadingHTTPServer((host, port), _handler(self))
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+
+    def _store(self) -> _ThreadStore:
+        try:
+            return self._local.store
+        except AttributeError:
+            store = self._local.store = _ThreadStore(threading.current_thread())
+            with self._lock:
+                self._stores.append(store)
+            return store
+
+    def observe(self, metric: str, label: str | None, nanoseconds: int) -> None:
+        self._store().observe((metric, label), nanoseconds)
+
+    def inc(self, metric: str, *labels) -> None:
+        self._store().inc((metric, *labels))
+
+    def _patch(self, owner, name: str, value) -> None:
+        self._originals.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, value)
+
+    def _timed(self, func, metric: str, label: str | None, errors: bool = False):
+        '''Обертка func с замером времени. errors - считать исключения в sqlatm_errors_total'''
+        key = (metric, label)
+        store = self._store
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if errors:
+                    store().inc(('sqlatm_errors_total', label, type(error).__name__))
+                raise
+            finally:
+                store().observe(key, perf_counter_ns() - started)
+        return wrapper
+
+    def _instrument(self) -> None:
+        '''Подмена функций обертками с замерами'''
+        for name in ENGINE_OPERATIONS:
+            func = ATMEngine.__dict__[name].__func__
+            self._patch(ATMEngine, name, staticmethod(self._timed(func, 'sqlatm_operation_seconds', name, True)))
+        for name in CONSOLE_STEPS:
+            func = sql_query.SQLatm.__dict__[name].__func__
+            self._patch(sql_query.SQLatm, name, staticmethod(self._timed(func, 'sqlatm_console_seconds', name)))
+        # Глобальное имя модуля перекрывает встроенную input только в sql_query
+        self._patch(sql_query, 'input', self._timed(input, 'sqlatm_input_wait_seconds', None))
+
+        store = self._store
+        query = PooledConnection.query
+
+        def timed_query(db, name: str, params=()):
+            started = perf_counter_ns()
+            try:
+                return query(db, name, params)
+            finally:
+                store().observe(('sqlatm_query_seconds', name), perf_counter_ns() - started)
+
+        commit = PooledConnection.commit
+        rollback = PooledConnection.rollback
+
+        def timed_commit(db):
+            started = perf_counter_ns()
+            commit(db)
+            local = store()
+            local.observe(('sqlatm_commit_seconds', None), perf_counter_ns() - started)
+            local.inc(('sqlatm_commits_total',))
+
+        def counted_rollback(db):
+            rollback(db)
+            store().inc(('sqlatm_rollbacks_total',))
+
+        is_busy = db_pool._is_busy
+
+        def counted_is_busy(error) -> bool:
+            # run_in_transaction спрашивает только перед возможным повтором
+            busy = is_busy(error)
+            if busy:
+                store().inc(('sqlatm_busy_retries_total',))
+            return busy
+
+        run_in_transaction = ConnectionPool.run_in_transaction
+
+        def timed_transaction(pool, func, *args, **kwargs):
+            if pool.connection().in_transaction:  # Вложенный вызов - часть внешней транзакции
+                return run_in_transaction(pool, func, *args, **kwargs)
+            started = perf_counter_ns()
+            try:
+                return run_in_transaction(pool, func, *args, **kwargs)
+            finally:
+                store().observe(('sqlatm_transaction_seconds', None), perf_counter_ns() - started)
+
+        self._patch(PooledConnection, 'query', timed_query)
+        self._patch(PooledConnection, 'commit', timed_commit)
+        self._patch(PooledConnection, 'rollback', counted_rollback)
+        self._patch(db_pool, '_is_busy', counted_is_busy)
+        self._patch(ConnectionPool, 'run_in_transaction', timed_transaction)
+        self._patch(ConnectionPool, '_open', self._timed(ConnectionPool._open, 'sqlatm_connect_seconds', None))
+        self.enabled = True
+
+    def _restore(self) -> None:
+        '''Возврат исходных функций. Накопленные значения сохраняются'''
+        for owner, name, original in reversed(self._originals):
+            if original == None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self._originals.clear()
+        self.enabled = False
+
+    def _collect(self) -> tuple:
+        '''Сводка всех потоков: (гистограммы, счетчики). Завершившиеся потоки переносятся в общую сводку'''
+        histograms = {}
+        counters = {}
+        with self._lock:
+            alive = []
+            for store in self._stores:
+                if store.thread.is_alive():
+                    alive.append(store)
+                else:
+                    _merge(self._retired.histograms, self._retired.counters, store)
+            self._stores = alive
+            for store in [self._retired, *alive]:
+                _merge(histograms, counters, store)
+        return histograms, counters
+
+    def render(self) -> str:
+        '''Метрики в текстовом формате Prometheus'''
+        histograms, counters = self._collect()
+        lines = []
+        for metric, (kind, label_name, description) in METRICS.items():
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} {kind}')
+            if kind == 'histogram':
+                for (name, label), histogram in sorted(histograms.items(), key=_sort_key):
+                    if name != metric:
+                        continue
+                    labels = f'{label_name}="{label}",' if label_name != None else ''
+                    for octave in EXPORT_OCTAVES:
+                        lines.append(f'{metric}_bucket{{{labels}le="{2 ** octave / 1e9:.9g}"}} '
+                                     f'{histogram.count_le(2 ** octave)}')
+                    count = sum(histogram.counts)
+                    lines.append(f'{metric}_bucket{{{labels}le="+Inf"}} {count}')
+                    labels = f'{{{labels[:-1]}}}' if labels else ''
+                    lines.append(f'{metric}_sum{labels} {histogram.total / 1e9:.9g}')
+                    lines.append(f'{metric}_count{labels} {count}')
+            else:
+                for key, value in sorted(counters.items(), key=_sort_key):
+                    if key[0] != metric:
+                        continue
+                    labels = ''
+                    if label_name != None:
+                        labels = f'{{{label_name}="{key[1]}",error="{key[2]}"}}'
+                    lines.append(f'{metric}{labels} {value}')
+        cache = balance_cache.stats()
+        lines += [
+            '# HELP sqlatm_balance_cache_hits_total Попадания в кэш балансов',
+            '# TYPE sqlatm_balance_cache_hits_total counter',
+            f'sqlatm_balance_cache_hits_total {cache["hits"]}',
+            '# HELP sqlatm_balance_cache_misses_total Промахи кэша балансов',
+            '# TYPE sqlatm_balance_cache_misses_total counter',
+            f'sqlatm_balance_cache_misses_total {cache["misses"]}',
+            '# HELP sqlatm_balance_cache_size Записей в кэше балансов',
+            '# TYPE sqlatm_balance_cache_size gauge',
+            f'sqlatm_balance_cache_size {cache["size"]}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        '''Запись метрик в файл через временный файл: читатель не увидит файл наполовину записанным'''
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.render())
+        os.replace(temp_path, path)
+
+    def _write_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.write(self._path)
+            except OSError:
+                pass  # Диск недоступен - повторим на следующем шаге
+
+    def _stop_writer(self) -> None:
+        self._stop.set()
+        if self._writer != None:
+            self._writer.join()
+            self._writer = None
+            self.write(self._path)
+
+    def _stop_server(self) -> None:
+        if self._server != None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def close(self) -> None:
+        '''Остановка выгрузки: последняя запись в файл и закрытие HTTP-эндпоинта'''
+        self._stop_writer()
+        self._stop_server()
+
+
+def _merge(histograms: dict, counters: dict, store: _ThreadStore) -> None:
+    for key, histogram in list(store.histograms.items()):
+        target = histograms.get(key)
+        if target == None:
+            target = histograms[key] = Histogram()
+        target.merge(histogram)
+    for key, value in list(store.counters.items()):
+        counters[key] = counters.get(key, 0) + value
+
+
+def _sort_key(item: tuple) -> tuple:
+    return tuple(str(part) for part in item[0])
+
+
+def _handler(source: Metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = source.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Опрос Prometheus раз в несколько секунд не должен засорять вывод сервера
+
+    return MetricsHandler
+
+
+metrics = Metrics()
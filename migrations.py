@@ -0,0 +1,462 @@
+import sqlite3
+import sys
+
+
+class MigrationError(Exception):
+    '''Миграцию невозможно применить к текущим данным'''
+
+
+MIGRATIONS = []  # (версия, описание, функция) в порядке возрастания версии
+
+
+def migration(version: int, description: str):
+    '''Регистрация функции миграции схемы до указанной версии'''
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+def current_version(db: sqlite3.Connection) -> int:
+    '''Версия схемы хранится в заголовке файла базы (PRAGMA user_version)'''
+    return db.execute('PRAGMA user_version;').fetchone()[0]
+
+
+def migrate(db: sqlite3.Connection, target: int | None = None) -> list:
+    '''Применение всех недостающих миграций. Каждая миграция - отдельная транзакция.
+    Пустая база сразу получает схему версии BASELINE_VERSION, без перестроек таблиц старых версий.
+    Возвращает список примененных версий'''
+    applied = []
+    if target == None or target >= BASELINE_VERSION:
+        if _apply(db, BASELINE_VERSION, _create_baseline, lambda: not _has_table(db, 'Users_data')):
+            applied.append(BASELINE_VERSION)
+    for version, description, func in MIGRATIONS:
+        if target != None and version > target:
+            break
+        if _apply(db, version, func):
+            applied.append(version)
+    return applied
+
+
+def _apply(db: sqlite3.Connection, version: int, func, needed=lambda: True) -> bool:
+    if version <= current_version(db):
+        return False
+    if db.in_transaction:
+        db.commit()
+    db.execute('BEGIN IMMEDIATE;')  # DDL в sqlite транзакционен, при ошибке схема останется прежней
+    try:
+        # Повторная проверка под блокировкой записи: схему мог обновить другой процесс
+        if version <= current_version(db) or not needed():
+            db.rollback()
+            return False
+        func(db)
+        db.execute(f'PRAGMA user_version = {version};')
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+
+def _has_table(db: sqlite3.Connection, name: str) -> bool:
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)).fetchone() != None
+
+
+# Версия, в которой создается новая база: Users_data и Accounts миграции 5, журнал миграции 3
+BASELINE_VERSION = 5
+
+# Users_data версии 5: счета - в Accounts, пин-код - хэшем (открытый Pin_code - до перехэширования старых карт)
+USERS_COLUMNS = '''
+        UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Card_number INTEGER NOT NULL,
+        Pin_code INTEGER,
+        Pin_hash VARCHAR(255),
+        Pin_remaining_tries INTEGER NOT NULL DEFAULT 3,
+        Status VARCHAR(255) NOT NULL DEFAULT 'open'
+    '''
+
+
+def _create_baseline(db: sqlite3.Connection) -> None:
+    # Status = open, blocked; наличие счетов необязательно
+    db.execute(f'CREATE TABLE Users_data ({USERS_COLUMNS});')
+    db.execute('CREATE UNIQUE INDEX Users_data_card ON Users_data (Card_number);')
+    _transactions_journal(db)
+    _create_accounts(db)
+
+
+@migration(1, 'Уникальный индекс по номеру карты')
+def _unique_card_index(db: sqlite3.Connection) -> None:
+    # Старые базы могли накопить дубликаты из-за гонки SELECT-then-INSERT, молча удалять счета нельзя
+    duplicates = [row[0] for row in db.execute('''
+        SELECT Card_number
+        FROM Users_data
+        GROUP BY Card_number
+        HAVING COUNT(*) > 1;
+    ''')]
+    if duplicates:
+        raise MigrationError(f'В базе есть дубликаты номеров карт, требуется ручная проверка: {duplicates}')
+    db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS Users_data_card ON Users_data (Card_number);
+    ''')
+
+
+def _rebuild_users_table(db: sqlite3.Connection, columns_sql: str, select_sql: str) -> None:
+    '''Пересоздание Users_data с новым описанием столбцов. select_sql выбирает строки из Users_data_old.
+    Sqlite не умеет менять тип столбца, поэтому таблица копируется'''
+    db.execute('ALTER TABLE Users_data RENAME TO Users_data_old;')
+    db.execute('DROP INDEX IF EXISTS Users_data_card;')
+    db.execute(f'CREATE TABLE Users_data ({columns_sql});')
+    db.execute(f'INSERT INTO Users_data {select_sql};')
+    # Счетчик AUTOINCREMENT сохраняется, чтобы не выдать повторно UserID удаленных пользователей
+    db.execute('''
+        UPDATE sqlite_sequence
+        SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'Users_data_old')
+        WHERE name = 'Users_data';
+    ''')
+    db.execute('DROP TABLE Users_data_old;')
+    db.execute('CREATE UNIQUE INDEX Users_data_card ON Users_data (Card_number);')
+
+
+@migration(2, 'Балансы в целых минимальных единицах (1/10000) вместо FLOAT')
+def _integer_balances(db: sqlite3.Connection) -> None:
+    _rebuild_users_table(db, '''
+        UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Card_number INTEGER NOT NULL,
+        Pin_code INTEGER NOT NULL,
+        Pin_remaining_tries INTEGER NOT NULL DEFAULT 3,
+        Status VARCHAR(255) NOT NULL DEFAULT 'open',
+        Balance_RUB INTEGER,
+        Balance_USD INTEGER,
+        Balance_EUR INTEGER
+    ''', '''
+        SELECT UserID, Card_number, Pin_code, Pin_remaining_tries, Status,
+            CAST(ROUND(Balance_RUB * 10000) AS INTEGER),
+            CAST(ROUND(Balance_USD * 10000) AS INTEGER),
+            CAST(ROUND(Balance_EUR * 10000) AS INTEGER)
+        FROM Users_data_old
+    ''')
+
+
+@migration(3, 'Журнал операций Transactions')
+def _transactions_journal(db: sqlite3.Connection) -> None:
+    # Amount со знаком: списания отрицательные. Ts - микросекунды с начала эпохи Unix
+    db.execute('''
+        CREATE TABLE Transactions
+        (
+            TxID INTEGER PRIMARY KEY,
+            Card_number INTEGER NOT NULL,
+            Ts INTEGER NOT NULL,
+            Kind VARCHAR(32) NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Amount INTEGER NOT NULL,
+            Balance INTEGER NOT NULL,
+            Counterparty INTEGER
+        );
+    ''')
+    # TxID (rowid) неявно входит в индекс, поэтому он покрывает и сортировку по (Ts, TxID)
+    db.execute('CREATE INDEX Transactions_card_ts ON Transactions (Card_number, Ts);')
+    # Журнал только дополняется
+    db.execute('''
+        CREATE TRIGGER Transactions_no_update BEFORE UPDATE ON Transactions
+        BEGIN
+            SELECT RAISE(ABORT, 'Transactions is append-only');
+        END;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Transactions_no_delete BEFORE DELETE ON Transactions
+        BEGIN
+            SELECT RAISE(ABORT, 'Transactions is append-only');
+        END;
+    ''')
+
+
+@migration(4, 'Хэш пин-кода Pin_hash, открытый Pin_code необязателен до перехэширования')
+def _pin_hash(db: sqlite3.Connection) -> None:
+    # Сами хэши считаются онлайн пачками (pin_hash.py) - в миграции это заняло бы минуты под блокировкой
+    _rebuild_users_table(db, '''
+        UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Card_number INTEGER NOT NULL,
+        Pin_code INTEGER,
+        Pin_hash VARCHAR(255),
+        Pin_remaining_tries INTEGER NOT NULL DEFAULT 3,
+        Status VARCHAR(255) NOT NULL DEFAULT 'open',
+        Balance_RUB INTEGER,
+        Balance_USD INTEGER,
+        Balance_EUR INTEGER
+    ''', '''
+        SELECT UserID, Card_number, Pin_code, NULL, Pin_remaining_tries, Status,
+            Balance_RUB, Balance_USD, Balance_EUR
+        FROM Users_data_old
+    ''')
+
+
+@migration(5, 'Счета в отдельной таблице Accounts (карта, валюта, баланс) вместо столбцов Balance_*')
+def _accounts_table(db: sqlite3.Connection) -> None:
+    _create_accounts(db)
+    for currency in ('RUB', 'USD', 'EUR'):  # Столбцы прежней схемы, новые валюты сюда не добавляются
+        db.execute(f'''
+            INSERT INTO Accounts (Card_number, Currency, Balance)
+            SELECT Card_number, '{currency}', Balance_{currency}
+            FROM Users_data
+            WHERE Balance_{currency} IS NOT NULL;
+        ''')
+    _rebuild_users_table(db, USERS_COLUMNS, '''
+        SELECT UserID, Card_number, Pin_code, Pin_hash, Pin_remaining_tries, Status
+        FROM Users_data_old
+    ''')
+
+
+def _create_accounts(db: sqlite3.Connection) -> None:
+    # Составной первичный ключ без rowid: строки счетов одной карты лежат рядом в самом B-дереве ключа
+    db.execute('''
+        CREATE TABLE Accounts
+        (
+            Card_number INTEGER NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Balance INTEGER NOT NULL,
+            PRIMARY KEY (Card_number, Currency)
+        ) WITHOUT ROWID;
+    ''')
+
+
+@migration(6, 'Итоги для отчетов Card_totals, Currency_totals, Daily_totals, обновляемые триггерами')
+def _report_totals(db: sqlite3.Connection) -> None:
+    # Триггеры обновляют итоги в той же транзакции, что и запись, поэтому отчет не сканирует таблицы.
+    # Пересоздание Users_data (_rebuild_users_table) удаляет ее триггеры - их нужно создать заново
+    db.execute('''
+        CREATE TABLE Card_totals
+        (
+            Id INTEGER PRIMARY KEY CHECK (Id = 1),
+            Cards INTEGER NOT NULL,
+            Blocked INTEGER NOT NULL,
+            Pin_failed INTEGER NOT NULL
+        );
+    ''')
+    db.execute('''
+        INSERT INTO Card_totals (Id, Cards, Blocked, Pin_failed)
+        SELECT 1, COUNT(*), COALESCE(SUM(Status = 'blocked'), 0), COALESCE(SUM(Pin_remaining_tries < 3), 0)
+        FROM Users_data;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Card_totals_insert AFTER INSERT ON Users_data
+        BEGIN
+            UPDATE Card_totals
+            SET Cards = Cards + 1,
+                Blocked = Blocked + (NEW.Status = 'blocked'),
+                Pin_failed = Pin_failed + (NEW.Pin_remaining_tries < 3);
+        END;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Card_totals_delete AFTER DELETE ON Users_data
+        BEGIN
+            UPDATE Card_totals
+            SET Cards = Cards - 1,
+                Blocked = Blocked - (OLD.Status = 'blocked'),
+                Pin_failed = Pin_failed - (OLD.Pin_remaining_tries < 3);
+        END;
+    ''')
+    # Успешный вход без ошибок до него итогов не меняет и лишней записи не делает
+    db.execute('''
+        CREATE TRIGGER Card_totals_update AFTER UPDATE OF Status, Pin_remaining_tries ON Users_data
+        WHEN (OLD.Status = 'blocked') != (NEW.Status = 'blocked')
+            OR (OLD.Pin_remaining_tries < 3) != (NEW.Pin_remaining_tries < 3)
+        BEGIN
+            UPDATE Card_totals
+            SET Blocked = Blocked + (NEW.Status = 'blocked') - (OLD.Status = 'blocked'),
+                Pin_failed = Pin_failed + (NEW.Pin_remaining_tries < 3) - (OLD.Pin_remaining_tries < 3);
+        END;
+    ''')
+
+    db.execute('''
+        CREATE TABLE Currency_totals
+        (
+            Currency VARCHAR(3) PRIMARY KEY,
+            Accounts INTEGER NOT NULL DEFAULT 0,
+            Balance INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+    ''')
+    db.execute('''
+        INSERT INTO Currency_totals (Currency, Accounts, Balance)
+        SELECT Currency, COUNT(*), SUM(Balance)
+        FROM Accounts
+        GROUP BY Currency;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Currency_totals_insert AFTER INSERT ON Accounts
+        BEGIN
+            INSERT OR IGNORE INTO Currency_totals (Currency) VALUES (NEW.Currency);
+            UPDATE Currency_totals
+            SET Accounts = Accounts + 1, Balance = Balance + NEW.Balance
+            WHERE Currency = NEW.Currency;
+        END;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Currency_totals_delete AFTER DELETE ON Accounts
+        BEGIN
+            UPDATE Currency_totals
+            SET Accounts = Accounts - 1, Balance = Balance - OLD.Balance
+            WHERE Currency = OLD.Currency;
+        END;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Currency_totals_update AFTER UPDATE OF Balance ON Accounts
+        WHEN OLD.Currency = NEW.Currency AND OLD.Balance != NEW.Balance
+        BEGIN
+            UPDATE Currency_totals
+            SET Balance = Balance + NEW.Balance - OLD.Balance
+            WHERE Currency = NEW.Currency;
+        END;
+    ''')
+    # Валюта счета движком не меняется, но итоги не должны разойтись и при ручной правке
+    db.execute('''
+        CREATE TRIGGER Currency_totals_move AFTER UPDATE OF Currency ON Accounts
+        WHEN OLD.Currency != NEW.Currency
+        BEGIN
+            UPDATE Currency_totals
+            SET Accounts = Accounts - 1, Balance = Balance - OLD.Balance
+            WHERE Currency = OLD.Currency;
+            INSERT OR IGNORE INTO Currency_totals (Currency) VALUES (NEW.Currency);
+            UPDATE Currency_totals
+            SET Accounts = Accounts + 1, Balance = Balance + NEW.Balance
+            WHERE Currency = NEW.Currency;
+        END;
+    ''')
+
+    # Обороты за сутки (UTC) по виду операции и валюте. Журнал только дополняется - хватает триггера вставки
+    db.execute('''
+        CREATE TABLE Daily_totals
+        (
+            Day INTEGER NOT NULL,
+            Kind VARCHAR(32) NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Operations INTEGER NOT NULL DEFAULT 0,
+            Amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (Day, Kind, Currency)
+        ) WITHOUT ROWID;
+    ''')
+    db.execute('''
+        INSERT INTO Daily_totals (Day, Kind, Currency, Operations, Amount)
+        SELECT Ts / 86400000000, Kind, Currency, COUNT(*), SUM(Amount)
+        FROM Transactions
+        GROUP BY Ts / 86400000000, Kind, Currency;
+    ''')
+    db.execute('''
+        CREATE TRIGGER Daily_totals_insert AFTER INSERT ON Transactions
+        BEGIN
+            INSERT OR IGNORE INTO Daily_totals (Day, Kind, Currency)
+            VALUES (NEW.Ts / 86400000000, NEW.Kind, NEW.Currency);
+            UPDATE Daily_totals
+            SET Operations = Operations + 1, Amount = Amount + NEW.Amount
+            WHERE Day = NEW.Ts / 86400000000 AND Kind = NEW.Kind AND Currency = NEW.Currency;
+        END;
+    ''')
+
+
+@migration(7, 'Кассеты банкоматов Cassettes: число купюр каждого номинала')
+def _cassettes(db: sqlite3.Connection) -> None:
+    # Note - номинал в целых единицах валюты. Купюры банкомата в одной валюте лежат рядом по ключу
+    db.execute('''
+        CREATE TABLE Cassettes
+        (
+            Atm_id INTEGER NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Note INTEGER NOT NULL,
+            Count INTEGER NOT NULL CHECK (Count >= 0),
+            PRIMARY KEY (Atm_id, Currency, Note)
+        ) WITHOUT ROWID;
+    ''')
+
+
+@migration(8, 'Внесения наличных Deposits: повтор внесения с тем же Deposit_id не зачисляет деньги дважды')
+def _deposits(db: sqlite3.Connection) -> None:
+    # Notes - JSON {номинал: число купюр}, Balance - баланс после зачисления, его возвращает повтор
+    db.execute('''
+        CREATE TABLE Deposits
+        (
+            Deposit_id VARCHAR(64) PRIMARY KEY,
+            Card_number INTEGER NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Amount INTEGER NOT NULL,
+            Notes TEXT NOT NULL,
+            Balance INTEGER NOT NULL,
+            Ts INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+
+
+@migration(9, 'Переводы между шардами: Outgoing_transfers у отправителя, Incoming_transfers у получателя')
+def _shard_transfers(db: sqlite3.Connection) -> None:
+    # Перевод между базами - сага: списание с записью Outgoing_transfers (pending), зачисление с записью
+    # Incoming_transfers, затем pending -> done. Незавершенные переводы доводит ATMEngine.recover_transfers
+    db.execute('''
+        CREATE TABLE Outgoing_transfers
+        (
+            Transfer_id VARCHAR(64) PRIMARY KEY,
+            Card_number INTEGER NOT NULL,
+            Recipient_card INTEGER NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Amount INTEGER NOT NULL,
+            To_currency VARCHAR(3) NOT NULL,
+            Credited INTEGER NOT NULL,
+            State VARCHAR(16) NOT NULL DEFAULT 'pending',  -- pending, done, refunded
+            Ts INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+    # Восстановлению нужны только незавершенные переводы - индекс не растет вместе с историей
+    db.execute('''
+        CREATE INDEX Outgoing_transfers_pending ON Outgoing_transfers (Ts) WHERE State = 'pending';
+    ''')
+    # State: credited - зачислено, rejected - зачислить нельзя, отправителю возвращаются деньги.
+    # Строка есть в обоих случаях, поэтому повтор не зачислит перевод второй раз и не зачислит отклоненный
+    db.execute('''
+        CREATE TABLE Incoming_transfers
+        (
+            Transfer_id VARCHAR(64) PRIMARY KEY,
+            Card_number INTEGER NOT NULL,
+            State VARCHAR(16) NOT NULL,
+            Ts INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+
+
+@migration(10, 'Выдачи наличных по картам других шардов: Cash_withdrawals у кассет, Card_withdrawals у карты')
+def _shard_withdrawals(db: sqlite3.Connection) -> None:
+    # Выдача по карте другого шарда - сага, как перевод: купюры из кассет с записью Cash_withdrawals (pending),
+    # списание с записью Card_withdrawals, затем pending -> done или возврат купюр в кассеты.
+    # Незавершенные выдачи доводит ATMEngine.recover_transfers
+    db.execute('''
+        CREATE TABLE Cash_withdrawals
+        (
+            Withdrawal_id VARCHAR(64) PRIMARY KEY,
+            Atm_id INTEGER NOT NULL,
+            Currency VARCHAR(3) NOT NULL,
+            Notes TEXT NOT NULL,
+            Card_number INTEGER NOT NULL,
+            State VARCHAR(16) NOT NULL DEFAULT 'pending',  -- pending, done, returned
+            Ts INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+    db.execute('''
+        CREATE INDEX Cash_withdrawals_pending ON Cash_withdrawals (Ts) WHERE State = 'pending';
+    ''')
+    # State: debited - деньги списаны, cancelled - выдача отменена до списания, списывать по ней нельзя.
+    # Первая записанная строка решает исход выдачи, поэтому списание и отмена не выполнятся обе
+    db.execute('''
+        CREATE TABLE Card_withdrawals
+        (
+            Withdrawal_id VARCHAR(64) PRIMARY KEY,
+            Card_number INTEGER NOT NULL,
+            State VARCHAR(16) NOT NULL,
+            Ts INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+
+
+if __name__ == '__main__':
+    # Обновление существующего файла базы: python migrations.py [atm.db]
+    path = sys.argv[1] if len(sys.argv) > 1 else 'atm.db'
+    with sqlite3.connect(path) as connection:
+        before = current_version(connection)
+        versions = migrate(connection)
+        print(f'{path}: версия схемы {before} -> {current_version(connection)}, применено миграций: {len(versions)}')
@@ -0,0 +1,178 @@
+'''Хранение пин-кодов в виде соленого хэша PBKDF2-HMAC-SHA256.
+
+Строка хэша: pbkdf2_sha256$<итерации>$<соль hex>$<хэш hex>. Число итераций - настраиваемая
+стоимость входа: хэш со старым числом итераций пересчитывается при следующем успешном входе.
+Вычисления можно вынести в пул процессов, чтобы проверка не занимала потоки сервера.
+
+Перехэширование открытых пин-кодов существующей базы без остановки:
+    python pin_hash.py [atm.db] [--batch 500] [--iterations 50000] [--workers N]
+'''
+import argparse
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from db_pool import configure, get_pool
+from migrations import migrate
+from queries import QUERIES
+
+
+ALGORITHM = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 50_000  # ~25 мс на ядро
+SALT_BYTES = 16
+
+
+def _pbkdf2(pin: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac('sha256', pin.encode(), salt, iterations)
+
+
+def _encode(pin: str, iterations: int) -> str:
+    salt = os.urandom(SALT_BYTES)
+    return f'{ALGORITHM}${iterations}${salt.hex()}${_pbkdf2(pin, salt, iterations).hex()}'
+
+
+def _check(pin: str, pin_hash: str) -> bool:
+    algorithm, iterations, salt, digest = pin_hash.split('$')
+    if algorithm != ALGORITHM:
+        raise ValueError(f'Неизвестный алгоритм хэша пин-кода: {algorithm}')
+    return hmac.compare_digest(_pbkdf2(pin, bytes.fromhex(salt), int(iterations)), bytes.fromhex(digest))
+
+
+def iterations_of(pin_hash: str) -> int:
+    return int(pin_hash.split('$')[1])
+
+
+def is_pin_hash(value) -> bool:
+    '''Строка в формате хэша пин-кода - для данных, пришедших извне'''
+    return isinstance(value, str) and re.fullmatch(
+        rf'{ALGORITHM}\$[1-9]\d*\$[0-9a-f]+\$[0-9a-f]{{64}}', value) != None
+
+
+class PinHasher:
+    '''Хэширование и проверка пин-кодов с кэшем успешных проверок.
+
+    workers=0 - вычисления в вызывающем потоке, иначе - в пуле из workers процессов.
+    Кэш хранит не пин-коды, а HMAC пары (хэш, пин-код) на секретном ключе процесса,
+    поэтому из памяти пин-код не восстановить. Неверные пин-коды не кэшируются
+    '''
+
+    def __init__(self, iterations: int = DEFAULT_ITERATIONS, workers: int = 0, cache_size: int = 10000):
+        self.iterations = iterations
+        self.workers = workers
+        self.cache_size = cache_size
+        self._executor = None
+        self._cache = OrderedDict()
+        self._cache_key = os.urandom(32)
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.verifications = 0
+
+    def configure(self, iterations: int | None = None, workers: int | None = None) -> None:
+        '''Смена стоимости хэша и числа процессов. Действующий пул процессов закрывается'''
+        if iterations != None:
+            self.iterations = iterations
+        if workers != None:
+            self.close()
+            self.workers = workers
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor == None:
+                # spawn: дочерние процессы не наследуют потоки и соединения с базой родителя
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _call(self, func, *args):
+        if self.workers == 0:
+            return func(*args)
+        return self._pool().submit(func, *args).result()
+
+    def hash(self, pin: str) -> str:
+        return self._call(_encode, pin, self.iterations)
+
+    def hash_many(self, pins: list) -> list:
+        '''Хэши для пачки пин-кодов. В пуле процессов считаются параллельно'''
+        if self.workers == 0:
+            return [_encode(pin, self.iterations) for pin in pins]
+        return list(self._pool().map(_encode, pins, [self.iterations] * len(pins),
+                                       chunksize=max(len(pins) // (self.workers * 4), 1)))
+
+    def verify(self, pin: str, pin_hash: str) -> bool:
+        key = hmac.digest(self._cache_key, f'{pin_hash}\0{pin}'.encode(), 'sha256')
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return True
+            self.verifications += 1
+        if not self._call(_check, pin, pin_hash):
+            return False
+        with self._lock:
+            self._cache[key] = True
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def needs_rehash(self, pin_hash: str) -> bool:
+        return iterations_of(pin_hash) != self.iterations
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor != None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+pin_hasher = PinHasher()
+
+
+def rehash_pins(batch_size: int = 500) -> int:
+    '''Перенос открытых пин-кодов в Pin_hash пачками. Возвращает число обработанных карт.
+
+    Хэши считаются вне транзакции, запись пачки - одна короткая транзакция, поэтому банкомат
+    продолжает работать во время миграции. Строка обновляется, только если пин-код не изменился
+    '''
+    total = 0
+    last_id = -1
+    while True:
+        rows = get_pool().connection().query('pins_to_rehash', (last_id, batch_size)).fetchall()
+        if not rows:
+            return total
+        hashes = pin_hasher.hash_many([str(pin_code) for _, pin_code in rows])
+        get_pool().run_in_transaction(
+            lambda db: db.executemany(QUERIES['rehash_pin'], [
+                (pin_hash, user_id, pin_code) for (user_id, pin_code), pin_hash in zip(rows, hashes)]))
+        total += len(rows)
+        last_id = rows[-1][0]
+        print(f'Перехэшировано пин-кодов: {total}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Перехэширование открытых пин-кодов')
+    parser.add_argument('db', nargs='?', default='atm.db')
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    configure(args.db, concurrent=True)
+    migrate(get_pool().connection())  # Нужен столбец Pin_hash
+    pin_hasher.configure(args.iterations, args.workers)
+    try:
+        print(f'{args.db}: готово, карт: {rehash_pins(args.batch)}')
+    finally:
+        pin_hasher.close()
+        get_pool().close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+'''Реестр SQL-запросов движка.
+
+Каждый запрос описан один раз и выполняется по имени: db.query('balance_by_card', (card,)).
+Один и тот же текст запроса на долгоживущем соединении пула компилируется sqlite один раз
+и дальше берется из кэша подготовленных выражений соединения.
+'''
+
+QUERIES = {
+    'card_exists': '''
+        SELECT 1
+        FROM Users_data
+        WHERE Card_number = ?;
+    ''',
+    # Строка карты и ее счета одним запросом: по строке на счет, (NULL, NULL) - счетов нет
+    'login': '''
+        SELECT Users_data.Status, Users_data.Pin_code, Users_data.Pin_hash, Users_data.Pin_remaining_tries,
+            Accounts.Currency, Accounts.Balance
+        FROM Users_data
+        LEFT JOIN Accounts ON Accounts.Card_number = Users_data.Card_number
+        WHERE Users_data.Card_number = ?;
+    ''',
+    'pin_success': '''
+        UPDATE Users_data
+        SET Pin_remaining_tries = 3
+        WHERE Card_number = ? AND Status != 'blocked'
+        RETURNING Pin_remaining_tries;
+    ''',
+    # В SET справа используются значения строки до обновления
+    'pin_failure': '''
+        UPDATE Users_data
+        SET Pin_remaining_tries = Pin_remaining_tries - 1,
+            Status = CASE WHEN Pin_remaining_tries <= 1 THEN 'blocked' ELSE Status END
+        WHERE Card_number = ? AND Status != 'blocked'
+        RETURNING Pin_remaining_tries;
+    ''',
+    'set_pin_hash': '''
+        UPDATE Users_data
+        SET Pin_hash = ?, Pin_code = NULL
+        WHERE Card_number = ?;
+    ''',
+    'pins_to_rehash': '''
+        SELECT UserID, Pin_code
+        FROM Users_data
+        WHERE UserID > ? AND Pin_hash IS NULL
+        ORDER BY UserID
+        LIMIT ?;
+    ''',
+    # Пин-код мог смениться, пока считался хэш - такая строка пропускается
+    'rehash_pin': '''
+        UPDATE Users_data
+        SET Pin_hash = ?, Pin_code = NULL
+        WHERE UserID = ? AND Pin_hash IS NULL AND Pin_code = ?;
+    ''',
+    # Нет строк - нет карты, одна строка (NULL, NULL) - у карты нет счетов
+    'balance_by_card': '''
+        SELECT Accounts.Currency, Accounts.Balance
+        FROM Users_data
+        LEFT JOIN Accounts ON Accounts.Card_number = Users_data.Card_number
+        WHERE Users_data.Card_number = ?;
+    ''',
+    'insert_user': '''
+        INSERT INTO Users_data (Card_number, Pin_hash)
+        VALUES (?, ?)
+        ON CONFLICT (Card_number) DO NOTHING;
+    ''',
+    # Перенос карты из снимка другой базы вместе с состоянием пин-кода
+    'import_user': '''
+        INSERT INTO Users_data (Card_number, Pin_hash, Pin_remaining_tries, Status)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (Card_number) DO NOTHING;
+    ''',
+    'insert_account': '''
+        INSERT INTO Accounts (Card_number, Currency, Balance)
+        VALUES (?, ?, ?)
+        ON CONFLICT (Card_number, Currency) DO NOTHING;
+    ''',
+    'existing_cards': '''
+        SELECT Card_number
+        FROM Users_data
+        WHERE Card_number IN (SELECT value FROM json_each(?));
+    ''',
+    # Строки идут по уникальному индексу номера карты, счета карты - подряд, без сортировки в памяти
+    # Открытый Pin_code нужен только картам без хэша: выгрузка хэширует его, в файл он не попадает
+    'export_users': '''
+        SELECT Users_data.Card_number, Users_data.Pin_code, Users_data.Pin_hash, Users_data.Pin_remaining_tries,
+            Users_data.Status, Accounts.Currency, Accounts.Balance
+        FROM Users_data
+        LEFT JOIN Accounts ON Accounts.Card_number = Users_data.Card_number
+        ORDER BY Users_data.Card_number;
+    ''',
+    'journal_insert': '''
+        INSERT INTO Transactions (Card_number, Ts, Kind, Currency, Amount, Balance, Counterparty)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+    ''',
+    'history_page': '''
+        SELECT TxID, Ts, Kind, Currency, Amount, Balance, Counterparty
+        FROM Transactions
+        WHERE Card_number = ? AND (Ts, TxID) > (?, ?)
+        ORDER BY Ts, TxID
+        LIMIT ?;
+    ''',
+    # Счета - таблица с составным первичным ключом (Card_number, Currency), поиск счета - один проход по ключу
+    'account': '''
+        SELECT Balance
+        FROM Accounts
+        WHERE Card_number = ? AND Currency = ?;
+    ''',
+    'pair_accounts': '''
+        SELECT Card_number, Balance
+        FROM Accounts
+        WHERE Card_number IN (?, ?) AND Currency = ?;
+    ''',
+    # Относительное условное обновление: проверка баланса и запись - один оператор
+    'debit': '''
+        UPDATE Accounts
+        SET Balance = Balance - ?
+        WHERE Card_number = ? AND Currency = ? AND Balance >= ?
+        RETURNING Balance;
+    ''',
+    'credit': '''
+        UPDATE Accounts
+        SET Balance = Balance + ?
+        WHERE Card_number = ? AND Currency = ?
+        RETURNING Balance;
+    ''',
+    # Все счета в порядке первичного ключа: счета одной карты идут подряд, ORDER BY не сортирует
+    'account_balances': '''
+        SELECT Card_number, Currency, Balance
+        FROM Accounts
+        ORDER BY Card_number, Currency;
+    ''',
+    'balance_totals': '''
+        SELECT Currency, SUM(Balance)
+        FROM Accounts
+        GROUP BY Currency;
+    ''',
+    # Отчеты: итоги, которые поддерживают триггеры (миграция 6), и полный просмотр таблиц для их проверки
+    'report_cards': '''
+        SELECT Cards, Blocked, Pin_failed
+        FROM Card_totals;
+    ''',
+    'report_currencies': '''
+        SELECT Currency, Accounts, Balance
+        FROM Currency_totals
+        WHERE Accounts > 0
+        ORDER BY Currency;
+    ''',
+    'report_day': '''
+        SELECT Kind, Currency, Operations, Amount
+        FROM Daily_totals
+        WHERE Day = ?
+        ORDER BY Kind, Currency;
+    ''',
+    'scan_cards': '''
+        SELECT COUNT(*), COALESCE(SUM(Status = 'blocked'), 0), COALESCE(SUM(Pin_remaining_tries < 3), 0)
+        FROM Users_data;
+    ''',
+    'scan_currencies': '''
+        SELECT Currency, COUNT(*), SUM(Balance)
+        FROM Accounts
+        GROUP BY Currency
+        ORDER BY Currency;
+    ''',
+    # Ts в микросекундах, сутки - по UTC
+    'scan_day': '''
+        SELECT Kind, Currency, COUNT(*), SUM(Amount)
+        FROM Transactions
+        WHERE Ts >= ? * 86400000000 AND Ts < (? + 1) * 86400000000
+        GROUP BY Kind, Currency
+        ORDER BY Kind, Currency;
+    ''',
+    # Кассеты банкомата (миграция 7)
+    'cassettes': '''
+        SELECT Note, Count
+        FROM Cassettes
+        WHERE Atm_id = ? AND Currency = ?;
+    ''',
+    'atm_cassettes': '''
+        SELECT Currency, Note, Count
+        FROM Cassettes
+        WHERE Atm_id = ?
+        ORDER BY Currency, Note DESC;
+    ''',
+    'load_cassette': '''
+        INSERT INTO Cassettes (Atm_id, Currency, Note, Count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (Atm_id, Currency, Note) DO UPDATE SET Count = excluded.Count;
+    ''',
+    'take_notes': '''
+        UPDATE Cassettes
+        SET Count = Count - ?
+        WHERE Atm_id = ? AND Currency = ? AND Note = ?;
+    ''',
+    # Внесения наличных (миграция 8)
+    'deposit_by_id': '''
+        SELECT Card_number, Currency, Amount, Notes, Balance
+        FROM Deposits
+        WHERE Deposit_id = ?;
+    ''',
+    'deposit_insert': '''
+        INSERT INTO Deposits (Deposit_id, Card_number, Currency, Amount, Notes, Balance, Ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+    ''',
+    # Переводы между шардами (миграция 9)
+    'outgoing_insert': '''
+        INSERT INTO Outgoing_transfers (Transfer_id, Card_number, Recipient_card, Currency, Amount,
+                                        To_currency, Credited, Ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+    ''',
+    # Смена состояния только из pending: завершение и возврат не выполнятся дважды
+    'outgoing_finish': '''
+        UPDATE Outgoing_transfers
+        SET State = ?
+        WHERE Transfer_id = ? AND State = 'pending'
+        RETURNING Card_number, Recipient_card, Currency, Amount;
+    ''',
+    'outgoing_pending': '''
+        SELECT Transfer_id, Card_number, Recipient_card, Currency, Amount, To_currency, Credited
+        FROM Outgoing_transfers
+        WHERE State = 'pending' AND Ts < ?
+        ORDER BY Ts;
+    ''',
+    'incoming_by_id': '''
+        SELECT State
+        FROM Incoming_transfers
+        WHERE Transfer_id = ?;
+    ''',
+    'incoming_insert': '''
+        INSERT INTO Incoming_transfers (Transfer_id, Card_number, State, Ts)
+        VALUES (?, ?, ?, ?);
+    ''',
+    # Выдачи наличных по картам других шардов (миграция 10)
+    'cash_withdrawal_insert': '''
+        INSERT INTO Cash_withdrawals (Withdrawal_id, Atm_id, Currency, Notes, Card_number, Ts)
+        VALUES (?, ?, ?, ?, ?, ?);
+    ''',
+    'cash_withdrawal_finish': '''
+        UPDATE Cash_withdrawals
+        SET State = ?
+        WHERE Withdrawal_id = ? AND State = 'pending'
+        RETURNING Atm_id, Currency, Notes;
+    ''',
+    'cash_withdrawal_pending': '''
+        SELECT Withdrawal_id, Card_number
+        FROM Cash_withdrawals
+        WHERE State = 'pending' AND Ts < ?
+        ORDER BY Ts;
+    ''',
+    'card_withdrawal_by_id': '''
+        SELECT State
+        FROM Card_withdrawals
+        WHERE Withdrawal_id = ?;
+    ''',
+    'card_withdrawal_insert': '''
+        INSERT INTO Card_withdrawals (Withdrawal_id, Card_number, State, Ts)
+        VALUES (?, ?, ?, ?);
+    ''',
+}
@@ -0,0 +1,148 @@
+'''Отчет на конец дня по итогам, которые поддерживают триггеры базы (миграция 6).
+
+daily_report() читает несколько строк таблиц итогов и не зависит от размера базы.
+verify_report() считает те же значения полным просмотром таблиц и сравнивает с итогами -
+для ночной проверки, в WAL-режиме банкомат продолжает работать во время нее.
+    python reports.py [--db atm.db | --shards shards.json] [--day 2024-01-31] [--verify]
+'''
+import argparse
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime, timezone
+from typing import NamedTuple
+
+from atm_engine import format_amount
+from db_pool import all_pools, close_all
+import shards
+from sql_query import SQLatm
+
+
+EPOCH = date(1970, 1, 1)
+
+
+class CurrencyTotal(NamedTuple):
+    accounts: int
+    balance: int  # Сумма балансов в минимальных единицах
+
+
+class DayTotal(NamedTuple):
+    kind: str  # withdraw, deposit, transfer_out, transfer_in
+    currency: str
+    operations: int
+    amount: int  # Со знаком, как в журнале: списания отрицательные
+
+
+class DailyReport(NamedTuple):
+    day: date
+    cards: int
+    blocked_cards: int
+    pin_failed_cards: int  # Карты, у которых Pin_remaining_tries < 3, включая заблокированные
+    currencies: dict  # Валюта -> CurrencyTotal
+    operations: list  # DayTotal за сутки day
+
+
+@contextmanager
+def _read_transaction(pool):
+    '''Соединение потока в транзакции чтения: все запросы отчета видят один и тот же срез базы'''
+    db = pool.connection()
+    if db.in_transaction:
+        yield db
+        return
+    db.execute('BEGIN;')  # Отложенная транзакция: блокировка записи не берется
+    try:
+        yield db
+    finally:
+        db.commit()
+
+
+@contextmanager
+def _snapshot():
+    '''Срезы всех баз. При шардировании срезы берутся по очереди: перевод между шардами,
+    который выполняется в этот момент, может попасть в отчет только списанием'''
+    with ExitStack() as stack:
+        yield [stack.enter_context(_read_transaction(pool)) for pool in all_pools()]
+
+
+def _build_report(day: date, queries: tuple) -> DailyReport:
+    '''Отчет по запросам (карты, валюты, обороты за сутки)'''
+    day = day if day != None else datetime.now(timezone.utc).date()
+    number = (day - EPOCH).days  # Номер суток UTC - ключ Daily_totals
+    cards_query, currencies_query, day_query = queries
+    params = (number,) if day_query == 'report_day' else (number, number)
+    cards = [0, 0, 0]
+    currencies = {}
+    operations = {}
+    with _snapshot() as dbs:
+        for db in dbs:  # Итоги шардов складываются
+            cards = [total + value for total, value in zip(cards, db.query(cards_query).fetchone())]
+            for currency, accounts, balance in db.query(currencies_query).fetchall():
+                total = currencies.get(currency, CurrencyTotal(0, 0))
+                currencies[currency] = CurrencyTotal(total.accounts + accounts, total.balance + balance)
+            for kind, currency, count, amount in db.query(day_query, params).fetchall():
+                total = operations.get((kind, currency), (0, 0))
+                operations[(kind, currency)] = (total[0] + count, total[1] + amount)
+    return DailyReport(day, *cards, dict(sorted(currencies.items())),
+                       [DayTotal(*key, *operations[key]) for key in sorted(operations)])
+
+
+def daily_report(day: date | None = None) -> DailyReport:
+    '''Итоги по картам и валютам на текущий момент и обороты за сутки day (по умолчанию - сегодня, UTC)'''
+    return _build_report(day, ('report_cards', 'report_currencies', 'report_day'))
+
+
+def verify_report(day: date | None = None) -> list:
+    '''Сверка итогов с полным просмотром таблиц. Возвращает список расхождений, пустой - итоги верны'''
+    with _snapshot():  # Итоги и таблицы - из одного среза, иначе параллельная операция даст ложное расхождение
+        report = daily_report(day)
+        scanned = _build_report(report.day, ('scan_cards', 'scan_currencies', 'scan_day'))
+    mismatches = []
+    for field in ('cards', 'blocked_cards', 'pin_failed_cards'):
+        if getattr(report, field) != getattr(scanned, field):
+            mismatches.append(f'{field}: итоги {getattr(report, field)}, таблицы {getattr(scanned, field)}')
+    for currency in sorted(report.currencies.keys() | scanned.currencies.keys()):
+        if report.currencies.get(currency) != scanned.currencies.get(currency):
+            mismatches.append(f'{currency}: итоги {report.currencies.get(currency)}, '
+                              f'таблицы {scanned.currencies.get(currency)}')
+    if report.operations != scanned.operations:
+        mismatches.append(f'обороты за {report.day}: итоги {report.operations}, журнал {scanned.operations}')
+    return mismatches
+
+
+def print_report(report: DailyReport) -> None:
+    print(f'Отчет за {report.day} (UTC)')
+    print(f'Карт: {report.cards}, заблокировано: {report.blocked_cards}, '
+          f'с неудачными попытками ввода пин-кода: {report.pin_failed_cards}')
+    for currency, total in report.currencies.items():
+        print(f'  {currency}: счетов {total.accounts}, сумма {format_amount(total.balance)} {currency}')
+    print('Обороты за сутки:' if report.operations else 'Операций за сутки не было')
+    for total in report.operations:
+        sign = '-' if total.amount < 0 else ''
+        print(f'  {total.kind} {total.currency}: операций {total.operations}, '
+              f'сумма {sign}{format_amount(abs(total.amount))} {total.currency}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Отчет на конец дня')
+    parser.add_argument('--db', default='atm.db')
+    parser.add_argument('--shards', help='карта шардов (shards.py) вместо одной базы --db')
+    parser.add_argument('--day', type=date.fromisoformat, help='сутки UTC, по умолчанию сегодня')
+    parser.add_argument('--verify', action='store_true', help='сверить итоги с полным просмотром таблиц')
+    args = parser.parse_args()
+
+    if args.shards != None:
+        shards.configure(args.shards, recover=False)
+    else:
+        SQLatm.configure_db(args.db, concurrent=True)
+    SQLatm.create_table()  # Итоги появляются миграцией
+    try:
+        print_report(daily_report(args.day))
+        if args.verify:
+            mismatches = verify_report(args.day)
+            print('Сверка: итоги совпадают с таблицами' if not mismatches else 'Сверка: РАСХОЖДЕНИЯ')
+            for mismatch in mismatches:
+                print(f'  {mismatch}')
+    finally:
+        close_all()
+
+
+if __name__ == '__main__':
+    main()
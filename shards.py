@@ -0,0 +1,401 @@
+'''Хранение карт в нескольких файлах sqlite (шардах) по номеру карты.
+
+Карта шардов - JSON-файл рядом с базами:
+    {"scheme": "hash", "shards": ["atm-0.db", "atm-1.db"], "bounds": [[0, 0], [2048, 1]]}
+Ключ карты - номер карты (scheme "range") или номер слота 0..4095 по мультипликативному хэшу номера
+(scheme "hash": соседние номера карт расходятся по разным шардам). bounds - начала диапазонов ключей
+и их шарды по возрастанию: ключ принадлежит последнему диапазону, начало которого не больше него.
+Пути шардов - относительно файла карты. Шард 0 - основная база: в ней кассеты банкоматов
+и все, что не относится к картам. Каждый шард - обычная база со всей схемой (migrations.py),
+со своим журналом и итогами отчетов; отчеты и выгрузки складывают шарды.
+
+Все данные карты - в ее шарде, операция с одной картой - транзакция одного файла. Запись в разные
+файлы не ждет общей блокировки, поэтому запись масштабируется числом шардов. Перевод между шардами -
+сага с журналом (ATMEngine.transfer): списание с записью Outgoing_transfers, зачисление с записью
+Incoming_transfers, завершение; незавершенные переводы доводит ATMEngine.recover_transfers.
+Так же устроена выдача наличных по карте другого шарда: купюры из кассет основной базы с записью
+Cash_withdrawals, списание в шарде карты с записью Card_withdrawals, завершение.
+
+Перераспределение карт (rebalance, move) выполняется при остановленных банкоматах:
+1. В карту записывается цель ("next") - пока она там, банкоматы с этой картой шардов не запускаются.
+2. Каждая база-получатель копирует свои новые карты из прежних шардов (ATTACH), по транзакции на пару баз.
+3. Сохраняется новая карта - точка фиксации.
+4. Из каждой базы удаляются карты, которые ей больше не принадлежат.
+Прерванное на любом шаге перераспределение продолжается повторным запуском (rebalance --resume):
+копирование сначала удаляет из получателя остатки прерванной попытки.
+
+    python shards.py init shards.json --shards 4 [--scheme hash|range]
+    python shards.py status shards.json
+    python shards.py rebalance shards.json --shards 8 [--scheme range] | --resume
+    python shards.py move shards.json 5000 5999 2
+    python shards.py recover shards.json
+'''
+import argparse
+import json
+import os
+import sqlite3
+from bisect import bisect_right
+
+from atm_engine import ATMEngine
+from db_pool import ConnectionPool, all_pools, close_all, configure_router
+from sql_query import SQLatm
+
+
+HASH_SLOTS = 4096  # Слоты схемы hash: старшие 12 бит 32-битного мультипликативного хэша
+CARD_SPACE = (1000, 10000)  # Номера карт для равномерной нарезки схемы range
+# Таблицы с данными карт: (таблица, столбец автоинкремента). Автоинкремент при переносе выдается заново,
+# а его порядок сохраняется - журнал карты остается в прежней последовательности
+CARD_TABLES = (
+    ('Users_data', 'UserID'),
+    ('Accounts', None),
+    ('Transactions', 'TxID'),
+    ('Deposits', None),
+    ('Outgoing_transfers', None),
+    ('Incoming_transfers', None),
+    ('Card_withdrawals', None),
+)
+
+
+class ShardMapError(Exception):
+    '''Некорректная карта шардов или перераспределение, которое нельзя выполнить'''
+
+
+class ShardMap:
+    '''Номер карты -> номер шарда: диапазоны ключей карты по возрастанию'''
+
+    def __init__(self, shards: list, scheme: str = 'hash', bounds: list | None = None):
+        if scheme not in ('hash', 'range'):
+            raise ShardMapError(f'Неизвестная схема шардирования: {scheme}')
+        if not shards:
+            raise ShardMapError('Нужен хотя бы один шард')
+        self.shards = list(shards)
+        self.scheme = scheme
+        self.bounds = [tuple(bound) for bound in bounds] if bounds != None else self._even_bounds()
+        lows = [low for low, _ in self.bounds]
+        if not lows or lows[0] != 0 or lows != sorted(set(lows)):
+            raise ShardMapError('Диапазоны должны начинаться с 0 и идти по возрастанию без повторов')
+        if any(not 0 <= shard < len(self.shards) for _, shard in self.bounds):
+            raise ShardMapError('Диапазон ссылается на несуществующий шард')
+        self._lows = lows
+        self._owners = [shard for _, shard in self.bounds]
+        self.next = None  # Цель незавершенного перераспределения
+
+    def _even_bounds(self) -> list:
+        '''Равные доли пространства ключей: слотов хэша или номеров карт CARD_SPACE'''
+        count = len(self.shards)
+        if self.scheme == 'hash':
+            return [(i * HASH_SLOTS // count, i) for i in range(count)]
+        low, high = CARD_SPACE
+        return [(0, 0)] + [(low + i * (high - low) // count, i) for i in range(1, count)]
+
+    def key(self, card_number: int) -> int:
+        if self.scheme == 'range':
+            return card_number
+        # Мультипликативный хэш Кнута: старшие биты произведения зависят от всех битов номера
+        return ((card_number * 2654435761) & 0xFFFFFFFF) >> 20
+
+    def shard_of(self, card_number: int) -> int:
+        return self.shard_of_key(self.key(card_number))
+
+    def moved(self, low: int, high: int, shard: int, path: str | None = None) -> 'ShardMap':
+        '''Новая карта, в которой ключи low..high включительно принадлежат shard.
+        path - файл нового шарда, тогда shard должен быть равен len(shards)'''
+        shards = list(self.shards)
+        if path != None:
+            if shard != len(shards) or path in shards:
+                raise ShardMapError(f'Новый шард должен получить номер {len(shards)} и новый файл')
+            shards.append(path)
+        if not 0 <= low <= high:
+            raise ShardMapError('Некорректный диапазон ключей')
+        bounds = [bound for bound in self.bounds if bound[0] < low]
+        bounds.append((low, shard))
+        bounds.append((high + 1, self.shard_of_key(high + 1)))  # Остаток диапазона, в который попал high
+        bounds += [bound for bound in self.bounds if bound[0] > high + 1]
+        merged = []
+        for bound in bounds:
+            if not merged or merged[-1][1] != bound[1]:  # Соседние диапазоны одного шарда сливаются
+                merged.append(bound)
+        return ShardMap(shards, self.scheme, merged)
+
+    def shard_of_key(self, key: int) -> int:
+        return self._owners[bisect_right(self._lows, key) - 1]
+
+    def to_dict(self) -> dict:
+        data = {'scheme': self.scheme, 'shards': self.shards, 'bounds': [list(bound) for bound in self.bounds]}
+        if self.next != None:
+            data['next'] = self.next.to_dict()
+        return data
+
+    @staticmethod
+    def from_dict(data: dict) -> 'ShardMap':
+        shard_map = ShardMap(data['shards'], data.get('scheme', 'hash'), data.get('bounds'))
+        if data.get('next') != None:
+            shard_map.next = ShardMap.from_dict(data['next'])
+        return shard_map
+
+    def save(self, path: str) -> None:
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)  # Атомарная подмена: при сбое остается прежняя карта
+
+    @staticmethod
+    def load(path: str) -> 'ShardMap':
+        try:
+            with open(path, encoding='utf-8') as file:
+                return ShardMap.from_dict(json.load(file))
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            raise ShardMapError(f'Не удалось прочитать карту шардов {path}: {error}') from error
+
+
+def shard_paths(map_path: str, shard_map: ShardMap) -> list:
+    '''Пути файлов шардов: относительные пути карты - от ее каталога'''
+    base = os.path.dirname(os.path.abspath(map_path))
+    return [os.path.join(base, path) for path in shard_map.shards]
+
+
+class ShardRouter:
+    '''Пулы соединений шардов и выбор пула по номеру карты (db_pool.get_pool(card_number))'''
+
+    def __init__(self, shard_map: ShardMap, paths: list, max_connections: int = 8, **kwargs):
+        self.map = shard_map
+        self.pools = [ConnectionPool(path, max_connections, **kwargs) for path in paths]
+
+    def pool(self, card_number: int) -> ConnectionPool:
+        return self.pools[self.map.shard_of(card_number)]
+
+
+def configure(map_path: str, max_connections: int = 8, concurrent: bool = True,
+              recover: bool = True) -> ShardRouter:
+    '''Работа с шардами по карте map_path вместо одной базы. recover - довести переводы и выдачи,
+    прерванные прошлым запуском (они висят в Outgoing_transfers и Cash_withdrawals)'''
+    shard_map = ShardMap.load(map_path)
+    if shard_map.next != None:
+        raise ShardMapError(f'Перераспределение карт не завершено: python shards.py rebalance {map_path} --resume')
+    router = ShardRouter(shard_map, shard_paths(map_path, shard_map), max_connections, concurrent=concurrent)
+    configure_router(router)
+    SQLatm.create_table()  # Схема и миграции каждого шарда
+    if recover:
+        ATMEngine.recover_transfers(min_age=0)
+    return router
+
+
+def _owner_function(shard_map: ShardMap, paths: list):
+    '''Функция sqlite: номер карты -> путь файла шарда по карте shard_map'''
+    return lambda card_number: paths[shard_map.shard_of(card_number)]
+
+
+def _columns(db, table: str, skip: str | None) -> str:
+    return ', '.join(row[1] for row in db.execute(f'PRAGMA table_info({table});') if row[1] != skip)
+
+
+def _delete_cards(db, condition: str, params: tuple) -> int:
+    '''Удаление строк карт, для которых выполняется condition (SQL по Card_number), внутри транзакции.
+    Итоги карт и счетов уменьшают триггеры удаления, обороты за сутки - вычитаются здесь:
+    у журнала нет триггера удаления, он только дополняется, и удаление запрещено триггером'''
+    db.execute(f'''
+        UPDATE Daily_totals
+        SET Operations = Daily_totals.Operations - moved.Operations, Amount = Daily_totals.Amount - moved.Amount
+        FROM (
+            SELECT Ts / 86400000000 AS Day, Kind, Currency, COUNT(*) AS Operations, SUM(Amount) AS Amount
+            FROM Transactions
+            WHERE {condition}
+            GROUP BY 1, 2, 3
+        ) AS moved
+        WHERE Daily_totals.Day = moved.Day AND Daily_totals.Kind = moved.Kind
+            AND Daily_totals.Currency = moved.Currency;
+    ''', params)
+    db.execute('DELETE FROM Daily_totals WHERE Operations = 0;')
+    trigger_sql = db.execute("SELECT sql FROM sqlite_master WHERE name = 'Transactions_no_delete';").fetchone()[0]
+    db.execute('DROP TRIGGER Transactions_no_delete;')
+    cards = 0
+    for table, _ in reversed(CARD_TABLES):
+        cur = db.execute(f'DELETE FROM {table} WHERE {condition};', params)
+        if table == 'Users_data':
+            cards = cur.rowcount
+    db.execute(trigger_sql)  # DDL в той же транзакции: запрет удаления возвращается вместе с commit
+    return cards
+
+
+def _copy_phase(old_map: ShardMap, old_paths: list, new_map: ShardMap, new_paths: list) -> dict:
+    '''Копирование карт в новые шарды. Возвращает {(откуда, куда): число карт}'''
+    moved = {}
+    for target in new_paths:
+        db = sqlite3.connect(target, isolation_level=None)
+        try:
+            db.create_function('old_shard', 1, _owner_function(old_map, old_paths), deterministic=True)
+            db.create_function('new_shard', 1, _owner_function(new_map, new_paths), deterministic=True)
+            db.execute('BEGIN IMMEDIATE;')
+            # Остатки прерванной попытки: в получателе законны только его карты по прежней карте шардов
+            _delete_cards(db, 'old_shard(Card_number) != ?', (target,))
+            db.execute('COMMIT;')
+            for source in old_paths:
+                if source == target:
+                    continue
+                db.execute('ATTACH DATABASE ? AS source;', (source,))
+                try:
+                    db.execute('BEGIN IMMEDIATE;')
+                    for table, skip in CARD_TABLES:
+                        columns = _columns(db, table, skip)
+                        order = f'ORDER BY {skip}' if skip != None else ''
+                        cur = db.execute(f'''
+                            INSERT INTO main.{table} ({columns})
+                            SELECT {columns}
+                            FROM source.{table}
+                            WHERE old_shard(Card_number) = ? AND new_shard(Card_number) = ?
+                            {order};
+                        ''', (source, target))
+                        if table == 'Users_data' and cur.rowcount:
+                            moved[(source, target)] = cur.rowcount
+                    db.execute('COMMIT;')
+                finally:
+                    if db.in_transaction:
+                        db.execute('ROLLBACK;')
+                    db.execute('DETACH DATABASE source;')
+        finally:
+            db.close()
+    return moved
+
+
+def _cleanup_phase(new_map: ShardMap, new_paths: list, paths: list) -> dict:
+    '''Удаление из баз paths карт, которые по новой карте шардов хранятся в другой базе'''
+    removed = {}
+    for path in paths:
+        db = sqlite3.connect(path, isolation_level=None)
+        try:
+            db.create_function('new_shard', 1, _owner_function(new_map, new_paths), deterministic=True)
+            db.execute('BEGIN IMMEDIATE;')
+            removed[path] = _delete_cards(db, 'new_shard(Card_number) != ?', (path,))
+            db.execute('COMMIT;')
+        finally:
+            if db.in_transaction:
+                db.execute('ROLLBACK;')
+            db.close()
+    return removed
+
+
+def rebalance(map_path: str, new_map: ShardMap | None = None) -> dict:
+    '''Перераспределение карт по new_map при остановленных банкоматах. new_map=None - продолжение
+    прерванного перераспределения. Возвращает {'moved': {(откуда, куда): карт}, 'removed': {база: карт}}'''
+    current = ShardMap.load(map_path)
+    if current.next != None:
+        if new_map != None and new_map.to_dict() != current.next.to_dict():
+            raise ShardMapError('Не завершено перераспределение к другой карте шардов, сначала --resume')
+        new_map = current.next
+        current.next = None
+    elif new_map == None:
+        new_map = current  # Перераспределение уже зафиксировано - остается удалить перенесенные карты
+    if new_map.shards[0] != current.shards[0]:
+        raise ShardMapError('Основная база (шард 0) не меняется: в ней кассеты банкоматов')
+    old_paths = shard_paths(map_path, current)
+    new_paths = shard_paths(map_path, new_map)
+
+    # Схема новых баз и завершение переводов: сага переводов опирается на прежнюю карту шардов
+    configure_router(ShardRouter(new_map, new_paths))
+    SQLatm.create_table()
+    configure_router(ShardRouter(current, old_paths))
+    try:
+        SQLatm.create_table()
+        ATMEngine.recover_transfers(min_age=0)
+        pending = sum(pool.connection().execute('''
+            SELECT (SELECT COUNT(*) FROM Outgoing_transfers WHERE State = 'pending')
+                + (SELECT COUNT(*) FROM Cash_withdrawals WHERE State = 'pending');
+        ''').fetchone()[0] for pool in all_pools())
+    finally:
+        close_all()
+    if pending:
+        raise ShardMapError(f'Незавершенных операций между шардами: {pending}, перераспределение невозможно')
+
+    if current.to_dict() != new_map.to_dict():
+        current.next = new_map
+        current.save(map_path)  # С этого момента банкоматы с этой картой не запускаются
+    moved = _copy_phase(current, old_paths, new_map, new_paths)
+    new_map.save(map_path)  # Точка фиксации: дальше карты читаются из новых шардов
+    removed = _cleanup_phase(new_map, new_paths, list(dict.fromkeys(new_paths + old_paths)))
+    return {'moved': moved, 'removed': removed}
+
+
+
+def _resized(shard_map: ShardMap, count: int, scheme: str, prefix: str) -> ShardMap:
+    '''Карта из count шардов с равными долями ключей: прежние файлы сохраняются, новые - prefix-N.db'''
+    shards = shard_map.shards[:count]
+    shards += [f'{prefix}-{i}.db' for i in range(len(shards), count)]
+    return ShardMap(shards, scheme)
+
+
+def status(map_path: str) -> None:
+    shard_map = ShardMap.load(map_path)
+    paths = shard_paths(map_path, shard_map)
+    print(f'{map_path}: схема {shard_map.scheme}, шардов {len(paths)}'
+          + (' - НЕ ЗАВЕРШЕНО перераспределение' if shard_map.next != None else ''))
+    ends = [low for low, _ in shard_map.bounds[1:]] + [None]
+    for index, path in enumerate(paths):
+        ranges = ', '.join(f'{low}..{end - 1 if end != None else ""}'
+                           for (low, shard), end in zip(shard_map.bounds, ends) if shard == index)
+        cards = '-'
+        if os.path.exists(path):
+            db = sqlite3.connect(path)
+            try:
+                cards = db.execute('SELECT Cards FROM Card_totals;').fetchone()[0]
+            except sqlite3.Error:
+                pass  # База еще без схемы
+            finally:
+                db.close()
+        print(f'  {index}: {shard_map.shards[index]}, карт {cards}, ключи {ranges or "нет"}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Карта шардов и перераспределение карт между базами')
+    parser.add_argument('command', choices=('init', 'status', 'rebalance', 'move', 'recover'))
+    parser.add_argument('map', help='файл карты шардов')
+    parser.add_argument('range', nargs='*', type=int, help='move: НАЧАЛО КОНЕЦ ШАРД - ключи карт включительно')
+    parser.add_argument('--shards', type=int, help='init, rebalance: число шардов')
+    parser.add_argument('--scheme', choices=('hash', 'range'), help='по умолчанию - схема текущей карты или hash')
+    parser.add_argument('--prefix', default='atm', help='имя файлов новых шардов: ПРЕФИКС-N.db')
+    parser.add_argument('--db', help='init: существующая база, она станет шардом 0')
+    parser.add_argument('--path', help='move: файл нового шарда')
+    parser.add_argument('--resume', action='store_true', help='rebalance: продолжить прерванное перераспределение')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'status':
+            status(args.map)
+            return
+        if args.command == 'recover':
+            configure(args.map, recover=False)
+            try:
+                print(f'Доведено переводов и выдач между шардами: {ATMEngine.recover_transfers(min_age=0)}')
+            finally:
+                close_all()
+            return
+        if args.command == 'init':
+            if os.path.exists(args.map):
+                raise ShardMapError(f'Карта шардов {args.map} уже существует')
+            # Новая карта - одна основная база, остальные шарды заполняет обычное перераспределение
+            ShardMap([args.db or f'{args.prefix}-0.db'], args.scheme or 'hash').save(args.map)
+            new_map = _resized(ShardMap.load(args.map), args.shards or 1, args.scheme or 'hash', args.prefix)
+        elif args.command == 'rebalance':
+            current = ShardMap.load(args.map)
+            new_map = None
+            if not args.resume:
+                if args.shards == None:
+                    parser.error('нужно --shards или --resume')
+                new_map = _resized(current, args.shards, args.scheme or current.scheme, args.prefix)
+        else:
+            if len(args.range) != 3:
+                parser.error('move: нужны НАЧАЛО КОНЕЦ ШАРД')
+            low, high, shard = args.range
+            new_map = ShardMap.load(args.map).moved(low, high, shard, args.path)
+        result = rebalance(args.map, new_map)
+    except ShardMapError as error:
+        print(f'ОШИБКА. {error}')
+        return
+    for (source, target), cards in result['moved'].items():
+        print(f'{os.path.basename(source)} -> {os.path.basename(target)}: карт {cards}')
+    status(args.map)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,20 @@
-import sqlite3
+import csv
+import json
+import uuid
+from decimal import Decimal, InvalidOperation
+from itertools import chain, repeat
 from types import NoneType
 
+from atm_engine import (ATMEngine, ATMError, CardBlockedError, CardNotFoundError, CURRENCY_RULES, ExchangeResult,
+                        LimitExceededError, MINOR_UNITS, WrongPinError, format_amount, parse_amount, to_minor)
+from balance_cache import balance_cache
+from cash import count_notes, format_notes
+from currencies import CURRENCIES, DEPOSIT_NOTES
+from db_pool import all_pools, configure, get_pool
+from migrations import migrate
+from pin_hash import is_pin_hash, pin_hasher
+from queries import QUERIES
+
 
 def check_correct_int(digit: str) -> bool:
     '''Маленькая проверка на корректность введенного числа'''
@@ -24,859 +38,574 @@ def check_digit_card(digit_card: str) -> bool:
     return False
 
 
+def user_accounts(card_number: int, *balances) -> list:
+    '''Строки для запроса insert_account. balances - по порядку CURRENCIES, None - счета в валюте нет'''
+    # Числа округляются до .4 - точность хранения балансов
+    return [(card_number, currency, to_minor(balance))
+            for currency, balance in zip(CURRENCIES, balances) if balance != None]
+
+
+def validate_user(card_number: int, pin_code: int | None, *balances: int | float | Decimal | None,
+                  pin_hash: str | None = None) -> str | None:
+    '''Проверка данных пользователя перед добавлением. balances - по порядку CURRENCIES.
+    pin_hash - готовый хэш пин-кода из снимка базы, тогда pin_code не указывается.
+    Возвращает описание ошибки или None'''
+    if pin_hash != None:
+        if pin_code != None or not is_pin_hash(pin_hash):
+            return 'на этапе проверки хэша пин-кода'
+        pin_code = 1000  # Значение пин-кода не проверяется, он известен только по хэшу
+    # Проверка на типы данных
+    if not all((
+        isinstance(card_number, (int)),
+        isinstance(pin_code, (int)),
+        len(balances) <= len(CURRENCIES),
+        *(isinstance(balance, (int, float, Decimal, NoneType)) for balance in balances),
+    )):
+        return 'на этапе проверки типов данных'
+
+    # Проверка на корректный размер значений
+    if not all((
+        1000 <= card_number <= 9999,
+        1000 <= pin_code <= 9999,
+        # Важно, что сначала проверка на None, иначе ошибка при условии
+        *(balance == None or 0 <= balance <= 1e12 for balance in balances),
+    )):
+        return 'на этапе проверки значений'
+    return None
+
+
+def csv_value(value: str | None, convert):
+    '''Пустая ячейка CSV - отсутствие счета. Некорректное значение остается строкой и не пройдет проверку типов'''
+    if value == None or value == '':
+        return None
+    try:
+        return convert(value)
+    except (ValueError, InvalidOperation):
+        return value
+
+
+def read_users_csv(file):
+    '''Потоковое чтение пользователей из CSV с заголовком Card_number, Pin_code, Balance_RUB, Balance_USD, ...
+    (столбец Balance_<валюта> для каждой валюты CURRENCIES, отсутствующий столбец - нет счетов в валюте)'''
+    for row in csv.DictReader(file):
+        yield (
+            csv_value(row.get('Card_number'), int),
+            csv_value(row.get('Pin_code'), int),
+            # Decimal - без потерь точности на пути в базу
+            *(csv_value(row.get(f'Balance_{currency}'), Decimal) for currency in CURRENCIES),
+        )
+
+
+CARD_STATUSES = ('open', 'blocked')
+
+
+def validate_record(record: tuple) -> str | None:
+    '''Проверка записи (card_number, pin_code, pin_hash, tries, status, *balances) перед загрузкой.
+    tries и status - состояние карты из снимка базы, None - как у новой карты. Возвращает описание ошибки или None'''
+    card_number, pin_code, pin_hash, tries, status, *balances = record
+    if tries != None and not (isinstance(tries, int) and 0 <= tries <= 3):
+        return 'на этапе проверки числа попыток ввода пин-кода'
+    if status != None and status not in CARD_STATUSES:
+        return 'на этапе проверки статуса карты'
+    return validate_user(card_number, pin_code, *balances, pin_hash=pin_hash)
+
+
+def insert_users_chunk(chunk: list) -> tuple:
+    '''Проверка и вставка пачки записей [(номер строки, запись), ...], запись - как в validate_record.
+    При шардировании пачка делится по базам карт, каждая часть - одна транзакция.
+    Возвращает (добавлено, [(номер строки, номер карты, причина), ...])'''
+    errors = []
+    valid = []
+    seen = set()  # Дубликаты внутри самой пачки, с прежними пачками - через базу
+    for row_number, record in chunk:
+        error = validate_record(record)
+        if error != None:
+            errors.append((row_number, record[0], error))
+        elif record[0] in seen:
+            errors.append((row_number, record[0], 'дубликат номера карты в загружаемых данных'))
+        else:
+            seen.add(record[0])
+            valid.append((row_number, record))
+
+    groups = {}
+    for row_number, record in valid:
+        groups.setdefault(get_pool(record[0]), []).append((row_number, record))
+    inserted = 0
+    for pool, shard_valid in groups.items():
+        # Один запрос на всю часть вместо SELECT на каждую карту. Хэши пин-кодов - только новым картам
+        # и до транзакции, чтобы не держать блокировку записи (параллельно, если у pin_hasher пул процессов)
+        existing = _existing_cards(pool.connection(), shard_valid)
+        new_records = [record for _, record in shard_valid if record[0] not in existing]
+        plain = [record for record in new_records if record[2] == None]
+        hashes = dict(zip((record[0] for record in plain), pin_hasher.hash_many([str(record[1]) for record in plain])))
+        raced = set()
+        if new_records:
+            # Транзакция может повториться, поэтому ошибки и счетчик меняются только после нее
+            raced, count = pool.run_in_transaction(_insert_records, new_records, hashes)
+            inserted += count
+        for row_number, record in shard_valid:
+            if record[0] in existing or record[0] in raced:
+                errors.append((row_number, record[0], 'пользователь с таким номером карты уже существует'))
+    return inserted, errors
+
+
+def _existing_cards(db, records: list) -> set:
+    cur = db.query('existing_cards', (json.dumps([record[0] for record in records]),))
+    return {row[0] for row in cur.fetchall()}
+
+
+def _insert_records(db, records: list, hashes: dict) -> tuple:
+    # Карты, добавленные параллельной загрузкой после проверки, не вставляются и попадают в отчет
+    raced = _existing_cards(db, records)
+    records = [record for record in records if record[0] not in raced]
+    cur = db.executemany(QUERIES['import_user'], [
+        (card_number, pin_hash or hashes[card_number], 3 if tries == None else tries, status or 'open')
+        for card_number, _, pin_hash, tries, status, *_ in records])
+    db.executemany(QUERIES['insert_account'], [
+        account for record in records for account in user_accounts(record[0], *record[5:])])
+    return raced, cur.rowcount
+
+
+# Пункты меню выбора валюты: номер и название
+CURRENCY_MENU = tuple((str(number), currency) for number, currency in enumerate(CURRENCIES, start=1))
+
+
+def choose_currency(choice: str, available) -> str | None:
+    '''Валюта по вводу пользователя (номер или название) среди доступных, None - недоступная валюта'''
+    for number, currency in CURRENCY_MENU:
+        if currency in available and choice in (number, currency, currency.lower()):
+            return currency
+    return None
+
+
+def note_events(text: str, currency: str):
+    '''Поток событий (валюта, номинал) из ввода "1000 1000 500" или "1000x2 500", None - некорректный ввод'''
+    bundles = []
+    for token in text.split():
+        note, _, number = token.lower().partition('x')
+        if not check_correct_int(note) or (number != '' and not check_correct_int(number)):
+            return None
+        bundles.append(((currency, int(note)), int(number or 1)))
+    if not bundles:
+        return None
+    return chain.from_iterable(repeat(event, number) for event, number in bundles)
+
+
+def back_to_menu() -> None:
+    print('--> возвращение в главное меню')
+    print()
+
+
 class SQLatm:
+    atm_id = None  # Номер банкомата: купюры выдаются из его кассет. None - кассеты не учитываются
+
+    @staticmethod
+    def configure_db(db_path: str = 'atm.db', max_connections: int = 8, concurrent: bool = False) -> None:
+        '''Настройка пути к базе и размера пула соединений.
+        concurrent=True - WAL-режим для работы нескольких терминалов с одной базой'''
+        configure(db_path, max_connections, concurrent=concurrent)
+
 
     @staticmethod
     def create_table():
-        '''Создание таблицы Users_data'''
-        with sqlite3.connect('atm.db') as db:  # Данный способ позволяет не использовать commit
-            cur = db.cursor()
-            # Наличие счета необязательно
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS Users_data
-            (
-                UserID INTEGER PRIMARY KEY AUTOINCREMENT,
-                Card_number INTEGER NOT NULL,
-                Pin_code INTEGER NOT NULL,
-                Pin_remaining_tries INTEGER NOT NULL DEFAULT 3,
-                Status VARCHAR(255) NOT NULL DEFAULT 'open',
-                Balance_RUB FLOAT,
-                Balance_USD FLOAT,
-                Balance_EUR FLOAT
-            );
-            ''')
-            # Status = open, blocked
+        '''Создание таблиц новой базы или обновление схемы старой (migrations.py). При шардировании - в каждом шарде'''
+        for pool in all_pools():
+            migrate(pool.connection())
 
 
     @staticmethod
     def clear_table():
         '''Очистка таблицы Users_data'''
-        with sqlite3.connect('atm.db') as db:  # Данный способ позволяет не использовать commit
-            cur = db.cursor()
-            cur.execute('''DELETE FROM Users_data''')
+        for pool in all_pools():
+            with pool.connection() as db:  # Данный способ позволяет не использовать commit
+                cur = db.cursor()
+                cur.execute('''DELETE FROM Accounts''')
+                cur.execute('''DELETE FROM Users_data''')
+        balance_cache.clear()  # Свои записи не меняют data_version соединения, сбрасываем явно
 
 
     @staticmethod
-    def insert_user(
-        card_number: int,
-        pin_code: int,
-        balance_RUB: int | float | None = None,
-        balance_USD: int | float | None = None,
-        balance_EUR: int | float | None = None,
-        ) -> None:
-        '''Создание нового пользователя'''
-
-        # Проверка на типы данных
-        if all((
-            isinstance(card_number, (int)),
-            isinstance(pin_code, (int)),
-            isinstance(balance_RUB, (int, float, NoneType)),
-            isinstance(balance_USD, (int, float, NoneType)),
-            isinstance(balance_EUR, (int, float, NoneType)),
-        )):
-            pass
-        else:
-            print(f'ОШИБКА ДАННЫХ пользователя с номером карты {card_number} на этапе проверки типов данных.')
-            return
-
-        # Проверка на корректный размер значений
-        if all((
-            1000 <= card_number <= 9999,
-            1000 <= pin_code <= 9999,
-            balance_RUB == None or 0 <= balance_RUB <= 1e12,  # Важно, что сначала проверка на None, иначе ошибка при условии
-            balance_USD == None or 0 <= balance_USD <= 1e12,
-            balance_EUR == None or 0 <= balance_EUR <= 1e12,
-        )):
-            pass
-        else:
-            print(f'ОШИБКА ДАННЫХ пользователя с номером карты {card_number} на этапе проверки значений.')
+    def insert_user(card_number: int, pin_code: int, *balances: int | float | Decimal | None) -> None:
+        '''Создание нового пользователя. balances - начальные балансы по порядку CURRENCIES (RUB, USD, EUR),
+        None - счета в валюте нет'''
+        error = validate_user(card_number, pin_code, *balances)
+        if error != None:
+            print(f'ОШИБКА ДАННЫХ пользователя с номером карты {card_number} {error}.')
             return
 
-        user_data = (card_number, pin_code, balance_RUB, balance_USD, balance_EUR,)  # Пакуем в кортеж
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            # Проверка на наличие пользователя с таким номером карты в базе данных
-            cur.execute('''
-                SELECT Card_number
-                FROM Users_data
-                WHERE Card_number = ?;
-            ''', (card_number,))  # Запятая в конце, этож кортежем быть должно!
-            result_select = cur.fetchone()
-
-            # Если пользователя нет и возвращается None - тогда создается в базе новый
-            if result_select == None:
-                user_data = (card_number, pin_code, balance_RUB, balance_USD, balance_EUR,)  # Пакуем данные в кортеж
-
-                # Числа округляются при вставке до .4 для дальнейшего удобства в работе с ними при обмене
-                cur.execute('''
-                    INSERT INTO Users_data (Card_number, Pin_code, Balance_RUB, Balance_USD, Balance_EUR)
-                    VALUES (?, ?, ROUND(?, 4), ROUND(?, 4), ROUND(?, 4));
-                ''', user_data)
+        # Пин-код хранится только в виде соленого хэша
+        pin_hash = pin_hasher.hash(str(pin_code))
+        with get_pool(card_number).connection() as db:
+            # Уникальный индекс по номеру карты сам отсекает дубликаты, отдельный SELECT не нужен
+            cur = db.query('insert_user', (card_number, pin_hash))
+            if cur.rowcount == 1:
+                db.executemany(QUERIES['insert_account'], user_accounts(card_number, *balances))
                 print(f'Новый пользователь с номером карты {card_number} добавлен в базу данных.')
             else:
                 print(f'Пользователь с номером карты {card_number} уже существует.')
 
 
     @staticmethod
-    def input_card(card_number):
-        '''Проверка наличия карты в БД'''
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            cur.execute('''
-                SELECT Card_number
-                FROM Users_data
-                WHERE Card_number = ?;
-            ''', (card_number,))
-            result_card = cur.fetchone()
-            if result_card == None:
-                print('ОШИБКА. Введен неизвестный номер карты.')
-                print()
-                return False
-            else:
-                return True
+    def insert_users_bulk(users, chunk_size: int = 5000) -> dict:
+        '''Пакетное добавление пользователей.
+
+        users - итерируемый набор кортежей (card_number, pin_code, balance_RUB, balance_USD, balance_EUR),
+        балансы по порядку CURRENCIES, или открытый CSV-файл с заголовком из тех же колонок (Card_number, Pin_code, Balance_RUB, ...).
+        Каждая пачка из chunk_size строк проверяется и вставляется одной транзакцией.
+        Возвращает отчет {'inserted': число, 'errors': [(номер строки, номер карты, причина), ...]}
+        '''
+        if hasattr(users, 'read'):
+            users = read_users_csv(users)
+
+        report = {'inserted': 0, 'errors': []}
+        chunk = []
+        for row_number, user in enumerate(users, start=1):
+            user = tuple(user)
+            chunk.append((row_number, (*user[:2], None, None, None, *user[2:])))  # Новая карта: без хэша и состояния
+            if len(chunk) >= chunk_size:
+                SQLatm._insert_chunk(chunk, report)
+                chunk = []
+        if chunk:
+            SQLatm._insert_chunk(chunk, report)
+        return report
 
 
     @staticmethod
-    def input_code(card_number):
-        '''Ввод и проверка пин-кода c 3 попытками'''
-
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            cur.execute('''
-                SELECT Status
-                FROM Users_data
-                WHERE Card_number = ?;
-            ''', (card_number,))
-            result_status = cur.fetchone()
-            status = result_status[0]
-            if status == 'blocked':
-                print('КАРТА ЗАБЛОКИРОВАНА. Пожалуйста, обратитесь в отделение банка для разблокировки.')
-                return False
-            else:
-                cur.execute('''
-                    SELECT Pin_code, Pin_remaining_tries
-                    FROM Users_data
-                    WHERE Card_number = ?;
-                ''', (card_number,))
-                result_pin_and_tries = cur.fetchone()
-                pin = result_pin_and_tries[0]
-                tries = result_pin_and_tries[1]
-
-                input_pin = input(f'Введите пин-код: ')
-
-                if input_pin == str(pin):
-                    # При правильном вводе пин-кода попытки обновляются
-                    refresh_tries = 3
-                    cur.execute('''
-                        UPDATE Users_data
-                        SET Pin_remaining_tries = ?
-                        WHERE Card_number = ?;
-                    ''', (refresh_tries, card_number))
-                    return True
-                else:
-                    tries -= 1
-                    if tries > 1:
-                        cur.execute('''
-                            UPDATE Users_data
-                            SET Pin_remaining_tries = ?
-                            WHERE Card_number = ?;
-                        ''', (tries, card_number))
-                        print('ОШИБКА. Введен некорректный пин-код.')
-                        print(f'Осталось {tries} попытки, после чего карта заблокируется.')
-                        return
-                    elif tries == 1:
-                        cur.execute('''
-                            UPDATE Users_data
-                            SET Pin_remaining_tries = ?
-                            WHERE Card_number = ?;
-                        ''', (tries, card_number))
-                        print('ОШИБКА. Введен некорректный пин-код.')
-                        print(f'Осталась {tries} попытка, после чего карта заблокируется.')
-                        return
-                    elif tries == 0:
-                        cur.execute('''
-                            UPDATE Users_data
-                            SET Pin_remaining_tries = ?, Status = 'blocked'
-                            WHERE Card_number = ?;
-                        ''', (tries, card_number))
-                        print('ОШИБКА. Введен некорректный пин-код.')
-                        print(f'Осталось {tries} попыток, карта была автоматически заблокирована.')
-                        print('Пожалуйста, обратитесь в отделение банка для разблокировки.')
-                        return False
+    def _insert_chunk(chunk: list, report: dict) -> None:
+        inserted, errors = insert_users_chunk(chunk)
+        report['inserted'] += inserted
+        report['errors'].extend(errors)
+
+
+    @staticmethod
+    def login(card_number):
+        '''Ввод и проверка пин-кода c 3 попытками. Возвращает Session при успешном входе,
+        False - вход по карте невозможен, None - пин-код нужно ввести повторно'''
+        input_pin = input(f'Введите пин-код: ')
+        try:
+            return ATMEngine.authenticate(card_number, input_pin, SQLatm.atm_id)
+        except CardNotFoundError:
+            print('ОШИБКА. Введен неизвестный номер карты.')
+            print()
+            return False
+        except CardBlockedError:
+            print('КАРТА ЗАБЛОКИРОВАНА. Пожалуйста, обратитесь в отделение банка для разблокировки.')
+            return False
+        except LimitExceededError as error:
+            print(f'ОШИБКА. {error}')
+            print()
+            return False
+        except WrongPinError as error:
+            tries = error.tries_left
+            print('ОШИБКА. Введен некорректный пин-код.')
+            if tries > 1:
+                print(f'Осталось {tries} попытки, после чего карта заблокируется.')
+                return
+            elif tries == 1:
+                print(f'Осталась {tries} попытка, после чего карта заблокируется.')
+                return
+            print(f'Осталось {tries} попыток, карта была автоматически заблокирована.')
+            print('Пожалуйста, обратитесь в отделение банка для разблокировки.')
+            return False
 
 
     @staticmethod
-    def info_balance(card_number):
+    def info_balance(session):
         '''Вывод на экран баланса карты'''
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            cur.execute('''
-                SELECT Balance_RUB, Balance_USD, Balance_EUR
-                FROM Users_data
-                WHERE Card_number = ?;
-            ''', (card_number,))
-            result_info_balance = cur.fetchone()
-            balance_rub = result_info_balance[0]
-            balance_usd = result_info_balance[1]
-            balance_eur = result_info_balance[2]
-            res = ''  # Формируем результрующую строку для вывода баланса
-            if balance_rub != None:
-                res += f'{balance_rub} RUB'
-            if balance_usd != None:
-                res += f' | {balance_usd} USD'
-            if balance_eur != None:
-                res += f' | {balance_eur} EUR'
-            print(f'Баланс Вашей карты: {res}')
-            print('--------------------')
+        balance = session.balance
+        # Формируем результрующую строку для вывода баланса
+        res = ' | '.join(f'{format_amount(balance[currency])} {currency}'
+                         for currency in CURRENCIES if currency in balance)
+        print(f'Баланс Вашей карты: {res}')
+        print('--------------------')
 
 
     @staticmethod
     def get_user_balance(card_number):
-        '''Получение значения баланса карты'''
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            cur.execute('''
-                SELECT Balance_RUB, Balance_USD, Balance_EUR
-                FROM Users_data
-                WHERE Card_number = ?;
-            ''', (card_number,))
-            result_info_balance = cur.fetchone()
-            return result_info_balance
+        '''Получение значения баланса карты, None - карты нет'''
+        try:
+            return ATMEngine.get_balance(card_number)
+        except CardNotFoundError:
+            return None
 
 
     @staticmethod
-    def withdraw_money(card_number):
+    def withdraw_money(session):
         '''Снятие денежных средств с баланса карты'''
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            balance = SQLatm.get_user_balance(card_number)
-            balance_rub = balance[0]
-            balance_usd = balance[1]
-            balance_eur = balance[2]
-            rub_yes = False  # Переменные для проверки доступности данной валюты для пользователя
-            usd_yes = False
-            eur_yes = False
-
-            if ((balance_rub == None or balance_rub < 50)
-                and (balance_usd == None or balance_usd < 5)
-                and (balance_eur == None or balance_eur < 5)):
-                print('Функционал снятия недоступен по причине отсутствия достаточных средств на карте.')
+        balance = session.balance
+        # Доступны валюты, в которых на балансе хватает хотя бы на минимальную сумму снятия
+        # Балансы переводятся в целые единицы валюты - выдаются только целые купюры
+        available = {currency: value // MINOR_UNITS for currency, value in balance.items()
+                     if value >= CURRENCY_RULES[currency].withdraw_min * MINOR_UNITS}
+        if not available:
+            print('Функционал снятия недоступен по причине отсутствия достаточных средств на карте.')
+            print()
+            return False
+
+        while True:
+            print('Вам доступны для снятия следующие валюты: ')
+            for number, currency in CURRENCY_MENU:
+                if currency in available:
+                    rules = CURRENCY_RULES[currency]
+                    maximum = available[currency] // rules.withdraw_note * rules.withdraw_note
+                    print(f'{number}. {currency} в размере не менее {rules.withdraw_min} {currency} '
+                          f'и не более {maximum} {currency}')  # Нет купюр для выдачи меньшей суммы
+            # Нумерация пусть будет уникальной в списке, не стал привязывать к выводу. Может 1 и 3 быть
+
+            choice_currency = input('\nКакую валюту желаете снять? Введите номер или название валюты: ')
+            if choice_currency == '00':
+                back_to_menu()
+                return
+
+            currency = choose_currency(choice_currency, available)
+            if currency == None:
+                print('ОШИБКА. Недоступная валюта.')
                 print()
-                return False
+                continue
+            SQLatm._withdraw_currency(session, currency, available[currency])
+            return
 
-            while True:
-                print('Вам доступны для снятия следующие валюты: ')
-                if balance_rub != None and balance_rub >= 50:
-                    print(f'1. RUB в размере не менее 50 RUB и не более {int(balance_rub // 50 * 50)} RUB')  # Нет для выдачи меньше 50 купюры
-                    rub_yes = True  # Чтобы без отображения нельзя было выбрать данную валюту
-                if balance_usd != None and balance_usd >= 5:
-                    print(f'2. USD в размере не менее 5 USD и не более {int(balance_usd // 5 * 5)} USD')  # Нет для выдачи меньше 5 купюры
-                    usd_yes = True  # Чтобы без отображения нельзя было выбрать данную валюту
-                if balance_eur != None and balance_eur >= 5:
-                    print(f'3. EUR в размере не менее 5 EUR и не более {int(balance_eur // 5 * 5)} EUR')  # Нет для выдачи меньше 5 купюры
-                    eur_yes = True  # Чтобы без отображения нельзя было выбрать данную валюту
-                # Нумерация пусть будет уникальной в списке, не стал привязывать к выводу. Может 1 и 3 быть
-
-                choice_currency = input('\nКакую валюту желаете снять? Введите номер или название валюты: ')
-                if choice_currency == '00':
-                    print('--> возвращение в главное меню')
-                    print()
-                    return
 
-                if rub_yes and (choice_currency in ['1', 'RUB', 'rub']):  # Снятие для рубля
-                    print('\nВы выбрали RUB')
-                    print('(!) Допускается снятие не менее 50 RUB и не более 1000000 RUB за операцию.')
-                    while True:
-                        desired_withdraw = input('Введите сумму (целое число), которую желаете снять: ')
-                        if desired_withdraw == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if check_correct_int(desired_withdraw):
-                            desired_withdraw = int(desired_withdraw)
-                        else:
-                            print('ОШИБКА. Некорректный ввод суммы')
-                            print()
-                            continue
-
-                        rounded_withdraw = (desired_withdraw // 50 * 50)  # Округленное число с учетом выдачи
-
-                        if desired_withdraw < 50 or desired_withdraw > 1000000:
-                            print('ОШИБКА. Некорректная сумма снятия.')
-                            print('(!) Допускается снятие не менее 50 RUB и не более 1000000 RUB за операцию.')
-                            print()
-
-                        elif desired_withdraw > (balance_rub // 50 * 50):
-                            print('На балансе недостаточно средств для снятия данной суммы.')
-                            print(f'Ваша максимальная сумма для снятия: {int(balance_rub // 50 * 50)} RUB')
-                            print()
-
-                        elif desired_withdraw != rounded_withdraw:  # Если требует округления - спрашиваем, согласен ли пользователь
-                            print(f'Желаемая сумма для снятия {desired_withdraw} RUB была округлена до {rounded_withdraw} RUB')
-                            print('в связи с отсутствием купюр номиналом менее 50 RUB для выдачи.')
-                            print(f'Желаете снять {rounded_withdraw} RUB?')
-                            choice = input('Введите 1 или YES для согласия. Или любую цифру, сообщение для отмены операции: ')
-                            if choice in ['1', 'YES', 'yes']:
-                                new_balance_rub = balance_rub - rounded_withdraw
-                                cur.execute('''
-                                    UPDATE Users_data
-                                    SET Balance_RUB = ?
-                                    WHERE Card_number = ?;
-                                ''', (new_balance_rub, card_number))
-                                db.commit()
-                                print(f'Снятие {rounded_withdraw} RUB успешно!')
-                                SQLatm.info_balance(card_number)
-                                return
-                            else:
-                                print('Операция отменена.')
-                                return
-
-                        elif desired_withdraw == rounded_withdraw:
-                            new_balance_rub = balance_rub - rounded_withdraw
-                            cur.execute('''
-                                UPDATE Users_data
-                                SET Balance_RUB = ?
-                                WHERE Card_number = ?;
-                            ''', (new_balance_rub, card_number))
-                            db.commit()
-                            print(f'Снятие {rounded_withdraw} RUB успешно!')
-                            SQLatm.info_balance(card_number)
-                            return
-
-
-                if usd_yes and (choice_currency in ['2', 'USD', 'usd']):  # Снятие для доллара
-                    print('\nВы выбрали USD')
-                    print('(!) Допускается снятие не менее 5 USD и не более 100000 USD за операцию.')
-                    while True:
-                        desired_withdraw = input('Введите сумму (целое число), которую желаете снять: ')
-                        if desired_withdraw == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if check_correct_int(desired_withdraw):
-                            desired_withdraw = int(desired_withdraw)
-                        else:
-                            print('ОШИБКА. Некорректный ввод суммы')
-                            print()
-                            continue
-
-                        rounded_withdraw = (desired_withdraw // 5 * 5)  # Округленное число с учетом выдачи
-
-                        if desired_withdraw < 5 or desired_withdraw > 100000:
-                            print('ОШИБКА. Некорректная сумма снятия.')
-                            print('(!) Допускается снятие не менее 5 USD и не более 100000 USD за операцию.')
-                            print()
-
-                        elif desired_withdraw > (balance_usd // 5 * 5):
-                            print('На балансе недостаточно средств для снятия данной суммы.')
-                            print(f'Ваша максимальная сумма для снятия: {int(balance_usd // 5 * 5)} USD')
-                            print()
-
-                        elif desired_withdraw != rounded_withdraw:  # Если требует округления - спрашиваем, согласен ли пользователь
-                            print(f'Желаемая сумма для снятия {desired_withdraw} USD была округлена до {rounded_withdraw} USD')
-                            print('в связи с отсутствием купюр номиналом менее 5 USD для выдачи.')
-                            print(f'Желаете снять {rounded_withdraw} USD?')
-                            choice = input('Введите 1 или YES для согласия. Или любую цифру, сообщение для отмены операции: ')
-                            if choice in ['1', 'YES', 'yes']:
-                                new_balance_usd = balance_usd - rounded_withdraw
-                                cur.execute('''
-                                    UPDATE Users_data
-                                    SET Balance_USD = ?
-                                    WHERE Card_number = ?;
-                                ''', (new_balance_usd, card_number))
-                                db.commit()
-                                print(f'Снятие {rounded_withdraw} USD успешно!')
-                                SQLatm.info_balance(card_number)
-                                return
-                            else:
-                                print('Операция отменена.')
-                                return
-
-                        elif desired_withdraw == rounded_withdraw:
-                            new_balance_usd = balance_usd - rounded_withdraw
-                            cur.execute('''
-                                UPDATE Users_data
-                                SET Balance_USD = ?
-                                WHERE Card_number = ?;
-                            ''', (new_balance_usd, card_number))
-                            db.commit()
-                            print(f'Снятие {rounded_withdraw} USD успешно!')
-                            SQLatm.info_balance(card_number)
-                            return
-
-
-                if eur_yes and (choice_currency in ['3', 'EUR', 'eur']):  # Снятие для евро
-                    print('\nВы выбрали EUR')
-                    print('(!) Допускается снятие не менее 5 EUR и не более 100000 EUR за операцию.')
-                    while True:
-                        desired_withdraw = input('Введите сумму (целое число), которую желаете снять: ')
-                        if desired_withdraw == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if check_correct_int(desired_withdraw):
-                            desired_withdraw = int(desired_withdraw)
-                        else:
-                            print('ОШИБКА. Некорректный ввод суммы')
-                            print()
-                            continue
-
-                        rounded_withdraw = (desired_withdraw // 5 * 5)  # Округленное число с учетом выдачи
-
-                        if desired_withdraw < 5 or desired_withdraw > 100000:
-                            print('ОШИБКА. Некорректная сумма снятия.')
-                            print('(!) Допускается снятие не менее 5 EUR и не более 100000 EUR за операцию.')
-                            print()
-
-                        elif desired_withdraw > (balance_eur // 5 * 5):
-                            print('На балансе недостаточно средств для снятия данной суммы.')
-                            print(f'Ваша максимальная сумма для снятия: {int(balance_eur // 5 * 5)} EUR')
-                            print()
-
-                        elif desired_withdraw != rounded_withdraw:  # Если требует округления - спрашиваем, согласен ли пользователь
-                            print(f'Желаемая сумма для снятия {desired_withdraw} EUR была округлена до {rounded_withdraw} EUR')
-                            print('В связи с отсутствием купюр номиналом менее 5 EUR для выдачи.')
-                            print(f'Желаете снять {rounded_withdraw} EUR?')
-                            choice = input('Введите 1 или YES для согласия. Или любую цифру, сообщение для отмены операции: ')
-                            if choice in ['1', 'YES', 'yes']:
-                                new_balance_eur = balance_eur - rounded_withdraw
-                                cur.execute('''
-                                    UPDATE Users_data
-                                    SET Balance_EUR = ?
-                                    WHERE Card_number = ?;
-                                ''', (new_balance_eur, card_number))
-                                db.commit()
-                                print(f'Снятие {rounded_withdraw} EUR успешно!')
-                                SQLatm.info_balance(card_number)
-                                return
-                            else:
-                                print('Операция отменена.')
-                                return
-
-                        elif desired_withdraw == rounded_withdraw:
-                            new_balance_eur = balance_eur - rounded_withdraw
-                            cur.execute('''
-                                UPDATE Users_data
-                                SET Balance_EUR = ?
-                                WHERE Card_number = ?;
-                            ''', (new_balance_eur, card_number))
-                            db.commit()
-                            print(f'Снятие {rounded_withdraw} EUR успешно!')
-                            SQLatm.info_balance(card_number)
-                            return
+    @staticmethod
+    def _withdraw_currency(session, currency: str, balance: int) -> None:
+        '''Ввод суммы снятия в выбранной валюте. balance - в целых единицах валюты'''
+        rules = CURRENCY_RULES[currency]
+        note = rules.withdraw_note
+        limits = (f'(!) Допускается снятие не менее {rules.withdraw_min} {currency} '
+                  f'и не более {rules.withdraw_max} {currency} за операцию.')
+        print(f'\nВы выбрали {currency}')
+        print(limits)
+        while True:
+            desired_withdraw = input('Введите сумму (целое число), которую желаете снять: ')
+            if desired_withdraw == '00':
+                back_to_menu()
+                return
+
+            if check_correct_int(desired_withdraw):
+                desired_withdraw = int(desired_withdraw)
+            else:
+                print('ОШИБКА. Некорректный ввод суммы')
+                print()
+                continue
+
+            rounded_withdraw = (desired_withdraw // note * note)  # Округленное число с учетом выдачи
+
+            if desired_withdraw < rules.withdraw_min or desired_withdraw > rules.withdraw_max:
+                print('ОШИБКА. Некорректная сумма снятия.')
+                print(limits)
+                print()
 
+            elif desired_withdraw > (balance // note * note):
+                print('На балансе недостаточно средств для снятия данной суммы.')
+                print(f'Ваша максимальная сумма для снятия: {balance // note * note} {currency}')
+                print()
+
+            elif desired_withdraw != rounded_withdraw:  # Если требует округления - спрашиваем, согласен ли пользователь
+                print(f'Желаемая сумма для снятия {desired_withdraw} {currency} была округлена до {rounded_withdraw} {currency}')
+                print(f'в связи с отсутствием купюр номиналом менее {note} {currency} для выдачи.')
+                print(f'Желаете снять {rounded_withdraw} {currency}?')
+                choice = input('Введите 1 или YES для согласия. Или любую цифру, сообщение для отмены операции: ')
+                if choice in ['1', 'YES', 'yes']:
+                    SQLatm._run_operation(ATMEngine.withdraw, 'Снятие', session, currency,
+                                          rounded_withdraw * MINOR_UNITS, SQLatm.atm_id)
                 else:
-                    print('ОШИБКА. Недоступная валюта.')
-                    print()
-                    continue
+                    print('Операция отменена.')
+                return
+
+            else:
+                SQLatm._run_operation(ATMEngine.withdraw, 'Снятие', session, currency,
+                                          rounded_withdraw * MINOR_UNITS, SQLatm.atm_id)
+                return
 
 
     @staticmethod
-    def deposit_money(card_number):
+    def _run_operation(operation, title: str, session, *args) -> bool:
+        '''Выполнение операции движка с выводом результата или ошибки'''
+        try:
+            result = operation(session.card_number, *args)
+        except ATMError as error:
+            # Баланс мог измениться с другого терминала, пока пользователь вводил сумму
+            print(f'ОШИБКА. {error}')
+            print()
+            return False
+        session.apply(result)
+        print(f'{title} {format_amount(result.amount)} {result.currency} успешно!')
+        if isinstance(result, ExchangeResult) and result.to_currency != result.currency:
+            print(f'По курсу обмена: {format_amount(result.to_amount)} {result.to_currency}')
+        if result.notes:
+            print(f'Купюры: {format_notes(result.notes)}')
+        SQLatm.info_balance(session)
+        return True
+
+
+    @staticmethod
+    def deposit_money(session):
         '''Внесение денежных средств на баланс карты'''
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            balance = SQLatm.get_user_balance(card_number)
-            balance_rub = balance[0]
-            balance_usd = balance[1]
-            balance_eur = balance[2]
-            rub_yes = False  # Переменные для проверки доступности данной валюты для пользователя
-            usd_yes = False
-            eur_yes = False
-
-            if (balance_rub == None and balance_usd == None and balance_eur == None):
-                print('Функционал внесения средств недоступен по причине отсутствия счета на карте. Обратитесь в банк.')
+        balance = session.balance
+        available = list(balance)
+        if not available:
+            print('Функционал внесения средств недоступен по причине отсутствия счета на карте. Обратитесь в банк.')
+            print()
+            return
+
+        while True:
+            print('Для внесения Вам доступны следующие валюты:')
+            for number, currency in CURRENCY_MENU:
+                if currency in available:
+                    print(f'{number}. {currency}')
+            print('\nКакую валюту Вы желаете внести? Введите цифру или название валюты')
+
+            choice_deposit = input(': ')
+            if choice_deposit == '00':
+                back_to_menu()
+                return
+
+            currency = choose_currency(choice_deposit, available)
+            if currency == None:
+                print('ОШИБКА. Недоступная валюта.')
                 print()
+                continue
+            SQLatm._deposit_currency(session, currency)
+            return
+
+
+    @staticmethod
+    def _deposit_currency(session, currency: str) -> None:
+        '''Прием купюр в выбранной валюте: номиналы вводятся так, как их распознал бы модуль приема'''
+        rules = CURRENCY_RULES[currency]
+        print(f'\nВНЕСЕНИЕ {currency}')
+        print(f'(!) Сумма вносимых средств не может быть менее {rules.deposit_min} {currency} '
+              f'и более {rules.deposit_max} {currency}')
+        print(f'(!) Банкомат принимает купюры номиналом {", ".join(map(str, sorted(DEPOSIT_NOTES[currency])))} '
+              f'{currency}')
+        while True:
+            inserted = input('Вставьте купюры - введите номиналы через пробел, например 1000 1000 500 или 1000x2 500: ')
+            if inserted == '00':
+                back_to_menu()
                 return
 
-            while True:
-                print('Для внесения Вам доступны следующие валюты:')
-                if balance_rub != None:
-                    print('1. RUB')
-                    rub_yes = True
-                if balance_usd != None:
-                    print('2. USD')
-                    usd_yes = True
-                if balance_eur != None:
-                    print('3. EUR')
-                    eur_yes = True
-                print('\nКакую валюту Вы желаете внести? Введите цифру или название валюты')
-
-                choice_deposit = input(': ')
-                if choice_deposit == '00':
-                    print('--> возвращение в главное меню')
-                    print()
-                    return
+            events = note_events(inserted, currency)
+            if events == None:
+                print('ОШИБКА. Некорректный ввод купюр')
+                print()
+                continue
 
-                if rub_yes and (choice_deposit in ['1', 'RUB', 'rub']):
-                    print('\nВНЕСЕНИЕ RUB')
-                    print('(!) Сумма вносимых средств не может быть менее 10 RUB и более 1000000 RUB')
-                    print('(!) Банкомат принимает только купюры номиналом от 10 RUB')
-                    while True:
-                        rub_deposit = input('Введите сумму внесения средств (целое число): ')
-                        if rub_deposit == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if check_correct_int(rub_deposit):
-                            rub_deposit = int(rub_deposit)
-                        else:
-                            print('ОШИБКА. Некорректный ввод суммы')
-                            print()
-                            continue
-
-                        if 10 <= rub_deposit <= 1000000:
-                            if rub_deposit == (rub_deposit // 10 * 10):  # Корректные купюры
-                                cur.execute('''
-                                    UPDATE Users_data
-                                    SET Balance_RUB = Balance_RUB + ?
-                                    WHERE Card_number = ?;
-                                ''', (rub_deposit, card_number))
-                                db.commit()
-                                print(f'Внесение {rub_deposit} RUB успешно!')
-                                SQLatm.info_balance(card_number)
-                                return
-                            elif rub_deposit != (rub_deposit // 10 * 10):
-                                print('ОШИБКА внесения средств. Банкомат не принимают купюры номиналом менее 10 RUB.')
-                                print(f'*Попробуйте внести {rub_deposit // 10 * 10}')
-                                print()
-                                continue
-                        else:
-                            print('ОШИБКА. Недопустимая сумма.')
-                            print()
-
-
-                if usd_yes and (choice_deposit in ['2', 'USD', 'usd']):
-                    print('\nВНЕСЕНИЕ USD')
-                    print('(!) Сумма вносимых средств не может быть менее 5 USD и более 100000 USD')
-                    print('(!) Банкомат принимает только купюры номиналом от 5 USD')
-                    while True:
-                        usd_deposit = input('Введите сумму внесения средств (целое число): ')
-                        if usd_deposit == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if check_correct_int(usd_deposit):
-                            usd_deposit = int(usd_deposit)
-                        else:
-                            print('ОШИБКА. Некорректный ввод суммы')
-                            print()
-                            continue
-
-                        if 5 <= usd_deposit <= 100000:
-                            if usd_deposit == (usd_deposit // 5 * 5):  # Корректные купюры
-                                cur.execute('''
-                                    UPDATE Users_data
-                                    SET Balance_USD = Balance_USD + ?
-                                    WHERE Card_number = ?;
-                                ''', (usd_deposit, card_number))
-                                db.commit()
-                                print(f'Внесение {usd_deposit} USD успешно!')
-                                SQLatm.info_balance(card_number)
-                                return
-                            elif usd_deposit != (usd_deposit // 5 * 5):
-                                print('ОШИБКА внесения средств. Банкомат не принимают купюры номиналом менее 5 USD')
-                                print(f'*Попробуйте внести {usd_deposit // 5 * 5}')
-                                print()
-                                continue
-                        else:
-                            print('ОШИБКА. Недопустимая сумма.')
-                            print()
-
-
-                if eur_yes and (choice_deposit in ['3', 'EUR', 'eur']):
-                    print('\nВНЕСЕНИЕ EUR')
-                    print('(!) Сумма вносимых средств не может быть менее 5 EUR и более 100000 EUR')
-                    print('(!) Банкомат принимает только купюры номиналом от 5 EUR')
-                    while True:
-                        eur_deposit = input('Введите сумму внесения средств (целое число): ')
-                        if eur_deposit == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if check_correct_int(eur_deposit):
-                            eur_deposit = int(eur_deposit)
-                        else:
-                            print('ОШИБКА. Некорректный ввод суммы')
-                            print()
-                            continue
-
-                        if 5 <= eur_deposit <= 100000:
-                            if eur_deposit == (eur_deposit // 5 * 5):  # Корректные купюры
-                                cur.execute('''
-                                    UPDATE Users_data
-                                    SET Balance_EUR = Balance_EUR + ?
-                                    WHERE Card_number = ?;
-                                ''', (eur_deposit, card_number))
-                                db.commit()
-                                print(f'Внесение {eur_deposit} EUR успешно!')
-                                SQLatm.info_balance(card_number)
-                                return
-                            elif eur_deposit != (eur_deposit // 5 * 5):
-                                print('ОШИБКА внесения средств. Банкомат не принимают купюры номиналом менее 5 EUR')
-                                print(f'*Попробуйте внести {eur_deposit // 5 * 5}')
-                                print()
-                                continue
-                        else:
-                            print('ОШИБКА. Недопустимая сумма.')
-                            print()
-                else:
-                    print('ОШИБКА. Недоступная валюта.')
-                    print()
-                    continue
+            count = count_notes(events, currency)
+            if count.rejected:
+                print('Купюры не приняты и возвращены: ' + ', '.join(
+                    f'{note} {note_currency} x {number}' for (note_currency, note), number in count.rejected.items()))
+            if not count.notes:
+                print()
+                continue
+            # Идентификатор создается до зачисления: повтор после сбоя связи не зачислит деньги дважды
+            SQLatm._run_operation(ATMEngine.deposit_notes, 'Внесение', session, str(uuid.uuid4()), count)
+            return
 
 
     @staticmethod
-    def transfer_money(card_number):
+    def transfer_money(session):
         '''Перевод денег на карту другого пользователя'''
-        with sqlite3.connect('atm.db') as db:
-            cur = db.cursor()
-            print('ВАЛЮТНЫЙ ПЕРЕВОД')
-            print('(!) Поддерживаются любые суммы, но не менее 0.0001 или')
-            while True:
+        print('ВАЛЮТНЫЙ ПЕРЕВОД')
+        print('(!) Поддерживаются любые суммы, но не менее 0.0001 или')
+        while True:
 
-                recipient_card = input('Введите номер карты, на которую желаете осуществить перевод: ')
-                if recipient_card == '00':
-                    print('--> возвращение в главное меню')
-                    print()
+            recipient_card = input('Введите номер карты, на которую желаете осуществить перевод: ')
+            if recipient_card == '00':
+                back_to_menu()
+                return
+
+            if check_digit_card(recipient_card):
+                recipient_card = int(recipient_card)
+            else:
+                print('ОШИБКА. Некорректный номер карты')
+                print()
+                continue
+
+            if recipient_card == session.card_number:
+                print('ОШИБКА. Невозможно осуществить перевод самому себе.')
+                print()
+                continue
+
+            recipient_balance = SQLatm.get_user_balance(recipient_card)
+            if recipient_balance == None:
+                print('ОШИБКА. Пользователя с данным номером карты не существует.')
+                print()
+                continue
+
+            # Если у получателя нет счета в валюте перевода, сумма зачисляется в другой его валюте по курсу
+            recipient_currencies = [currency for currency in CURRENCIES if currency in recipient_balance]
+            balance = session.balance
+            available = {currency: value for currency, value in balance.items() if value > 0}
+            if not available or not recipient_currencies:
+                print('К сожалению, перевод невозможен по причине отсутствия у получателя счетов.')
+                print('Или по причине отсутствия денег на вашем счете.')
+                print()
+                return
+
+            while True:
+                print('Для перевода получателю доступны следующие валюты: ')
+                for number, currency in CURRENCY_MENU:
+                    if currency in available:
+                        print(f'{number}. {currency} в размере не более {format_amount(available[currency])} {currency}')
+                print('\nКакую валюту Вы желаете перевести? Введите цифру или название валюты')
+                choice_cur_transfer = input(': ')
+                if choice_cur_transfer == '00':
+                    back_to_menu()
                     return
 
-                if check_digit_card(recipient_card):
-                    recipient_card = int(recipient_card)
-                else:
-                    print('ОШИБКА. Некорректный номер карты')
+                currency = choose_currency(choice_cur_transfer, available)
+                if currency == None:
+                    print('ОШИБКА. Недоступная валюта')
                     print()
                     continue
+                to_currency = currency if currency in recipient_currencies else recipient_currencies[0]
+                if to_currency != currency:
+                    try:
+                        rate = ATMEngine.rates().rate(currency, to_currency)
+                    except ATMError as error:
+                        print(f'ОШИБКА. {error}')
+                        print()
+                        return
+                    print(f'(!) У получателя нет счета в {currency}. Перевод будет зачислен в {to_currency} '
+                          f'по курсу 1 {currency} = {rate:.4f} {to_currency}')
+                SQLatm._transfer_currency(session, recipient_card, currency, available[currency], to_currency)
+                return
 
-                if recipient_card == card_number:
-                    print('ОШИБКА. Невозможно осуществить перевод самому себе.')
-                    print()
 
-                elif SQLatm.get_user_balance(recipient_card) == None:
-                    print('ОШИБКА. Пользователя с данным номером карты не существует.')
-                    print()
+    @staticmethod
+    def _transfer_currency(session, recipient_card: int, currency: str, balance: int, to_currency: str) -> None:
+        '''Ввод суммы перевода в выбранной валюте. balance - в минимальных единицах'''
+        print(f'\nВы выбрали {currency}')
+        while True:
+            desired_transfer = input('Введите сумму, которую желаете перевести: ')
+            if desired_transfer == '00':
+                back_to_menu()
+                return
 
-                elif SQLatm.get_user_balance(recipient_card) != None:
-                    # Необходимо убедиться, что у получателя и отправителя есть счета в валюте, что перевод возможен
-                    recipient_user_balance = SQLatm.get_user_balance(recipient_card)
-                    r_balance_rub = recipient_user_balance[0]
-                    r_balance_usd = recipient_user_balance[1]
-                    r_balance_eur = recipient_user_balance[2]
-
-                    user_balance = SQLatm.get_user_balance(card_number)
-                    balance_rub = user_balance[0]
-                    balance_usd = user_balance[1]
-                    balance_eur = user_balance[2]
-
-                    rub_transfer = False
-                    usd_transfer = False
-                    eur_transfer = False
-
-                    if balance_rub != None and balance_rub > 0 and r_balance_rub != None:
-                        rub_transfer = True  # Рублевый перевод между пользователями возможен
-                    if balance_usd != None and balance_usd > 0 and r_balance_usd != None:
-                        usd_transfer = True
-                    if balance_eur != None and balance_eur > 0 and r_balance_eur != None:
-                        eur_transfer = True
-
-                    if rub_transfer == False and usd_transfer == False and eur_transfer == False:
-                        print('К сожалению, перевод невозможен по причине отсутствия у получателя счетов в вашей валюте.')
-                        print('Или по причине отсутствия денег на вашем счете.')
-                        print()
-                        return
+            try:
+                desired_transfer = parse_amount(desired_transfer)  # Точно, без float
+            except ATMError as error:
+                print(f'ОШИБКА. {error}')
+                print()
+                continue
 
-                    while True:
-                        print('Для перевода получателю доступны следующие валюты: ')
-                        if rub_transfer:
-                            print(f'1. RUB в размере не более {balance_rub} RUB')
-                        if usd_transfer:
-                            print(f'2. USD в размере не более {balance_usd} USD')
-                        if eur_transfer:
-                            print(f'3. EUR в размере не более {balance_eur} EUR')
-                        print('\nКакую валюту Вы желаете перевести? Введите цифру или название валюты')
-                        choice_cur_transfer = input(': ')
-                        if choice_cur_transfer == '00':
-                            print('--> возвращение в главное меню')
-                            print()
-                            return
-
-                        if rub_transfer and (choice_cur_transfer in ['1', 'RUB', 'rub']):
-                            print('\nВы выбрали RUB')
-                            while True:
-                                desired_transfer = input('Введите сумму, которую желаете перевести: ')
-                                if desired_transfer == '00':
-                                    print('--> возвращение в главное меню')
-                                    print()
-                                    return
-
-                                for el in desired_transfer:
-                                    if el.isdigit() or el == '.':
-                                        pass
-                                    else:
-                                        print('ОШИБКА. Некорректная сумма')
-                                        print()
-
-                                try:
-                                    desired_transfer = float(desired_transfer)
-                                except:
-                                    print('ОШИБКА. Некорректная сумма')
-                                    print()
-                                    continue
-
-                                if desired_transfer % 1 < 0.0001:
-                                    print('ОШИБКА. Некорректное значение, после точки не может быть более 4 цифр')
-                                    continue
-
-                                if desired_transfer < 0.0001:
-                                    print('ОШИБКА. Сумма перевода не может быть меньше 0.0001.')
-                                    print()
-
-                                elif desired_transfer > balance_rub:
-                                    print('На балансе недостаточно средств для перевода данной суммы.')
-                                    print(f'Ваша максимальная сумма для перевода: {balance_rub} RUB')
-                                    print()
-
-                                else:
-                                    # Снимаем средства со счета отправителя
-                                    cur.execute('''
-                                        UPDATE Users_data
-                                        SET Balance_RUB = Balance_RUB - ?
-                                        WHERE Card_number = ?;
-                                    ''', (desired_transfer, card_number))
-                                    # Зачисляем средства на счет получателя
-                                    cur.execute('''
-                                        UPDATE Users_data
-                                        SET Balance_RUB = Balance_RUB + ?
-                                        WHERE Card_number = ?;
-                                    ''', (desired_transfer, recipient_card))
-                                    db.commit()
-                                    print(f'Перевод {desired_transfer} RUB успешно!')
-                                    SQLatm.info_balance(card_number)
-                                    return
-
-
-                        if usd_transfer and (choice_cur_transfer in ['2', 'USD', 'usd']):
-                            print('\nВы выбрали USD')
-                            while True:
-                                desired_transfer = input('Введите сумму, которую желаете перевести: ')
-                                if desired_transfer == '00':
-                                    print('--> возвращение в главное меню')
-                                    print()
-                                    return
-
-                                for el in desired_transfer:
-                                    if el.isdigit() or el == '.':
-                                        pass
-                                    else:
-                                        print('ОШИБКА. Некорректная сумма')
-                                        print()
-
-                                try:
-                                    desired_transfer = float(desired_transfer)
-                                except:
-                                    print('ОШИБКА. Некорректная сумма')
-                                    print()
-                                    continue
-
-                                if desired_transfer % 1 < 0.0001:
-                                    print('ОШИБКА. Некорректное значение, после точки не может быть более 4 цифр')
-                                    continue
-
-                                if desired_transfer < 0.0001:
-                                    print('ОШИБКА. Сумма перевода не может быть меньше 0.0001.')
-                                    print()
-
-                                elif desired_transfer > balance_usd:
-                                    print('На балансе недостаточно средств для перевода данной суммы.')
-                                    print(f'Ваша максимальная сумма для перевода: {balance_usd} USD')
-                                    print()
-
-                                else:
-                                    # Снимаем средства со счета отправителя
-                                    cur.execute('''
-                                        UPDATE Users_data
-                                        SET Balance_USD = Balance_USD - ?
-                                        WHERE Card_number = ?;
-                                    ''', (desired_transfer, card_number))
-                                    # Зачисляем средства на счет получателя
-                                    cur.execute('''
-                                        UPDATE Users_data
-                                        SET Balance_USD = Balance_USD + ?
-                                        WHERE Card_number = ?;
-                                    ''', (desired_transfer, recipient_card))
-                                    db.commit()
-                                    print(f'Перевод {desired_transfer} USD успешно!')
-                                    SQLatm.info_balance(card_number)
-                                    return
-
-                        if eur_transfer and (choice_cur_transfer in ['3', 'EUR', 'eur']):
-                            print('\nВы выбрали EUR')
-                            while True:
-                                desired_transfer = input('Введите сумму, которую желаете перевести: ')
-                                if desired_transfer == '00':
-                                    print('--> возвращение в главное меню')
-                                    print()
-                                    return
-
-                                for el in desired_transfer:
-                                    if el.isdigit() or el == '.':
-                                        pass
-                                    else:
-                                        print('ОШИБКА. Некорректная сумма')
-                                        print()
-
-                                try:
-                                    desired_transfer = float(desired_transfer)
-                                except:
-                                    print('ОШИБКА. Некорректная сумма')
-                                    print()
-                                    continue
-
-                                if desired_transfer % 1 < 0.0001:
-                                    print('ОШИБКА. Некорректное значение, после точки не может быть более 4 цифр')
-                                    continue
-
-                                if desired_transfer < 0.0001:
-                                    print('ОШИБКА. Сумма перевода не может быть меньше 0.0001.')
-                                    print()
-
-                                elif desired_transfer > balance_eur:
-                                    print('На балансе недостаточно средств для перевода данной суммы.')
-                                    print(f'Ваша максимальная сумма для перевода: {balance_eur} EUR')
-                                    print()
-
-                                else:
-                                    # Снимаем средства со счета отправителя
-                                    cur.execute('''
-                                        UPDATE Users_data
-                                        SET Balance_EUR = Balance_EUR - ?
-                                        WHERE Card_number = ?;
-                                    ''', (desired_transfer, card_number))
-                                    # Зачисляем средства на счет получателя
-                                    cur.execute('''
-                                        UPDATE Users_data
-                                        SET Balance_EUR = Balance_EUR + ?
-                                        WHERE Card_number = ?;
-                                    ''', (desired_transfer, recipient_card))
-                                    db.commit()
-                                    print(f'Перевод {desired_transfer} EUR успешно!')
-                                    SQLatm.info_balance(card_number)
-                                    return
-
-                        else:
-                            print('ОШИБКА. Недоступная валюта')
-                            print()
-                            continue
+            if desired_transfer < 1:
+                print('ОШИБКА. Сумма перевода не может быть меньше 0.0001.')
+                print()
+
+            elif desired_transfer > balance:
+                print('На балансе недостаточно средств для перевода данной суммы.')
+                print(f'Ваша максимальная сумма для перевода: {format_amount(balance)} {currency}')
+                print()
+
+            else:
+                SQLatm._run_operation(ATMEngine.transfer_exchange, 'Перевод', session, recipient_card, currency,
+                                      to_currency, desired_transfer)
+                return
 
 
     @staticmethod
-    def input_operation(card_number):
+    def input_operation(session):
         print('\nДобро пожаловать в ATM Script!')
         print('(!) Для возвращения с любого этапа операции в главное меню введите 00')
         print()
@@ -890,13 +619,13 @@ class SQLatm:
                               ': ')
             print()
             if operation == '1':
-                SQLatm.info_balance(card_number)
+                SQLatm.info_balance(session)
             elif operation == '2':
-                SQLatm.withdraw_money(card_number)
+                SQLatm.withdraw_money(session)
             elif operation == '3':
-                SQLatm.deposit_money(card_number)
+                SQLatm.deposit_money(session)
             elif operation == '4':
-                SQLatm.transfer_money(card_number)
+                SQLatm.transfer_money(session)
             elif operation == '0':
                 print('Завершение работы. До скорых встреч!')
                 break
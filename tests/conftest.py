@@ -0,0 +1,31 @@
+'''Общие фикстуры: временная база в каталоге теста и сброс состояния процесса между тестами.
+
+Запуск из корня репозитория: python -m pytest -q
+'''
+import pytest
+
+from balance_cache import balance_cache
+from db_pool import close_all
+from limits import limiter
+from pin_hash import pin_hasher
+from sql_query import SQLatm
+
+
+@pytest.fixture(autouse=True)
+def fast_pins():
+    '''Пин-коды хэшируются в процессе теста и дешево: стоимость KDF здесь не проверяется'''
+    pin_hasher.configure(1000, workers=0)
+    yield
+    pin_hasher.clear()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    '''Новая база в WAL-режиме, как у сервера. После теста пулы закрываются, кэш и лимиты сбрасываются'''
+    path = str(tmp_path / 'atm.db')
+    SQLatm.configure_db(path, concurrent=True)
+    SQLatm.create_table()
+    yield path
+    close_all()
+    balance_cache.clear()
+    limiter.clear()
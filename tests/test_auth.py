@@ -0,0 +1,37 @@
+import pytest
+
+from atm_engine import ATMEngine, CardBlockedError, CardNotFoundError, MINOR_UNITS, WrongPinError
+from sql_query import SQLatm
+
+
+@pytest.fixture
+def card(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 100, None, 5)])
+    return 1000
+
+
+def test_session_carries_balance(card):
+    session = ATMEngine.authenticate(card, '1111')
+    assert session.card_number == card
+    assert session.balance == {'RUB': 100 * MINOR_UNITS, 'EUR': 5 * MINOR_UNITS}  # Счета в USD нет
+    session.apply(ATMEngine.deposit(card, 'RUB', 50 * MINOR_UNITS))
+    assert session.balance['RUB'] == 150 * MINOR_UNITS
+
+
+def test_unknown_card(db_path):
+    with pytest.raises(CardNotFoundError):
+        ATMEngine.authenticate(9999, '1111')
+
+
+def test_wrong_pins_block_card(card):
+    for tries_left in (2, 1):
+        with pytest.raises(WrongPinError) as error:
+            ATMEngine.authenticate(card, '0000')
+        assert error.value.tries_left == tries_left
+    ATMEngine.authenticate(card, '1111')  # Верный пин-код восстанавливает попытки
+    for tries_left in (2, 1, 0):
+        with pytest.raises(WrongPinError) as error:
+            ATMEngine.authenticate(card, '0000')
+        assert error.value.tries_left == tries_left
+    with pytest.raises(CardBlockedError):
+        ATMEngine.authenticate(card, '1111')
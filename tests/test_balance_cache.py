@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+
+import balance_cache as cache_module
+from atm_engine import ATMEngine, MINOR_UNITS
+from balance_cache import BalanceCache, balance_cache
+from db_pool import PooledConnection, get_pool
+from sql_query import SQLatm
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_read_through_and_invalidation(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 100, None, None)])
+    hits = balance_cache.hits
+    assert ATMEngine.get_balance(1000)['RUB'] == 100 * MINOR_UNITS
+    assert ATMEngine.get_balance(1000)['RUB'] == 100 * MINOR_UNITS
+    assert balance_cache.hits == hits + 1
+
+    ATMEngine.deposit(1000, 'RUB', 50 * MINOR_UNITS)
+    assert ATMEngine.get_balance(1000)['RUB'] == 150 * MINOR_UNITS
+
+
+def test_write_in_other_thread_invalidates_card_only(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 100, None, None), (1001, 1111, 200, None, None)])
+    assert ATMEngine.get_balance(1000) == {'RUB': 100 * MINOR_UNITS}
+    assert ATMEngine.get_balance(1001) == {'RUB': 200 * MINOR_UNITS}
+    clears = balance_cache.clears
+
+    thread = threading.Thread(target=ATMEngine.deposit, args=(1000, 'RUB', 50 * MINOR_UNITS))
+    thread.start()
+    thread.join()
+
+    hits = balance_cache.hits
+    assert ATMEngine.get_balance(1000) == {'RUB': 150 * MINOR_UNITS}
+    assert ATMEngine.get_balance(1001) == {'RUB': 200 * MINOR_UNITS}
+    assert balance_cache.hits == hits + 1  # Вторая карта осталась в кэше
+    assert balance_cache.clears == clears
+
+
+def test_write_from_other_process_clears_cache(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 100, None, None)])
+    assert ATMEngine.get_balance(1000)['RUB'] == 100 * MINOR_UNITS
+    clears = balance_cache.clears
+
+    # Отдельное соединение sqlite - как запись другого процесса, о которой кэш не знает
+    db = sqlite3.connect(db_path)
+    with db:
+        db.execute("UPDATE Accounts SET Balance = Balance + ? WHERE Card_number = 1000 AND Currency = 'RUB';",
+                   (MINOR_UNITS,))
+    db.close()
+
+    assert ATMEngine.get_balance(1000)['RUB'] == 101 * MINOR_UNITS
+    assert balance_cache.clears == clears + 1
+
+
+def test_lru_and_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, 'time', clock)
+    cache = BalanceCache(max_size=2, ttl=5.0)
+    db = sqlite3.connect(':memory:')
+    loads = []
+
+    def loader(card_number):
+        loads.append(card_number)
+        return card_number * 10
+
+    for card_number in (1, 2, 1, 3):  # 3 вытесняет 2: карта 1 использовалась позже
+        assert cache.get(db, card_number, loader) == card_number * 10
+    assert loads == [1, 2, 3]
+    cache.get(db, 2, loader)
+    assert loads == [1, 2, 3, 2]
+
+    clock.now += 5.0
+    cache.get(db, 2, loader)
+    assert loads[-1] == 2 and len(loads) == 5
+    db.close()
+
+
+def test_commit_counts_from_many_threads(db_path):
+    started, finished = PooledConnection.commit_counts()
+
+    def commit_many():
+        db = get_pool().connection()
+        for _ in range(200):
+            db.commit()
+
+    threads = [threading.Thread(target=commit_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert PooledConnection.commit_counts() == (started + 1600, finished + 1600)
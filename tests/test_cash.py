@@ -0,0 +1,42 @@
+import itertools
+import random
+
+from cash import dispense
+
+
+def brute_force(amount: int, stock: dict) -> bool:
+    '''Можно ли собрать amount из stock полным перебором числа купюр каждого номинала'''
+    notes = list(stock)
+    for counts in itertools.product(*(range(stock[note] + 1) for note in notes)):
+        if sum(note * count for note, count in zip(notes, counts)) == amount:
+            return True
+    return False
+
+
+def check(amount: int, stock: dict, result: dict | None) -> None:
+    assert (result != None) == brute_force(amount, stock), (amount, stock, result)
+    if result != None:
+        assert sum(note * count for note, count in result.items()) == amount
+        assert all(0 < count <= stock[note] for note, count in result.items())
+
+
+def test_greedy_dead_end():
+    # Жадно 500 + 0 * 200 и остаток 100 не собрать, а 3 * 200 - можно
+    assert dispense(600, {500: 1, 200: 3}) == {200: 3}
+    assert dispense(600, {500: 1, 200: 2}) == None
+
+
+def test_dispense_matches_brute_force():
+    rnd = random.Random(1)
+    denominations = (5000, 2000, 1000, 500, 200, 100, 50, 30, 20, 7)
+    for _ in range(400):
+        stock = {note: rnd.randrange(4) for note in rnd.sample(denominations, rnd.randrange(1, 5))}
+        total = sum(note * count for note, count in stock.items())
+        for amount in {0, total, total + 1, *(rnd.randrange(total + 2) for _ in range(5))}:
+            check(amount, stock, dispense(amount, stock))
+
+
+def test_dispense_rejects_negative_and_empty():
+    assert dispense(-100, {100: 5}) == None
+    assert dispense(100, {100: 0}) == None
+    assert dispense(0, {}) == {}
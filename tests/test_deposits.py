@@ -0,0 +1,43 @@
+import pytest
+
+from atm_engine import ATMEngine, DepositConflictError, InvalidAmountError, MINOR_UNITS
+from cash import count_notes
+from sql_query import SQLatm
+
+
+CARD = 1000
+
+
+@pytest.fixture
+def card(db_path):
+    SQLatm.insert_users_bulk([(CARD, 1111, 100, None, None)])
+    return CARD
+
+
+def test_repeated_deposit_credits_once(card):
+    count = count_notes([('RUB', 1000), ('RUB', 500), ('RUB', 500), ('USD', 100), ('RUB', 3)], 'RUB')
+    assert count.notes == {1000: 1, 500: 2} and count.rejected == {('USD', 100): 1, ('RUB', 3): 1}
+
+    first = ATMEngine.deposit_notes(card, 'dep-1', count)
+    assert first.amount == 2000 * MINOR_UNITS and first.balance == 2100 * MINOR_UNITS
+    repeated = ATMEngine.deposit_notes(card, 'dep-1', count)
+    assert repeated == first
+    assert ATMEngine.get_balance(card) == {'RUB': 2100 * MINOR_UNITS}
+    assert [entry.kind for entry in ATMEngine.get_history(card).entries].count('deposit') == 1
+
+    # Новый идентификатор - новое внесение
+    ATMEngine.deposit_notes(card, 'dep-2', count)
+    assert ATMEngine.get_balance(card) == {'RUB': 4100 * MINOR_UNITS}
+
+
+def test_same_id_with_other_data_conflicts(card):
+    ATMEngine.deposit_notes(card, 'dep-1', count_notes([('RUB', 1000)], 'RUB'))
+    with pytest.raises(DepositConflictError):
+        ATMEngine.deposit_notes(card, 'dep-1', count_notes([('RUB', 500), ('RUB', 500)], 'RUB'))
+    assert ATMEngine.get_balance(card) == {'RUB': 1100 * MINOR_UNITS}
+
+
+def test_empty_deposit_rejected(card):
+    with pytest.raises(InvalidAmountError):
+        ATMEngine.deposit_notes(card, 'dep-1', count_notes([('USD', 100)], 'RUB'))
+    assert ATMEngine.get_balance(card) == {'RUB': 100 * MINOR_UNITS}
@@ -0,0 +1,101 @@
+import json
+import os
+from decimal import Decimal
+
+import pytest
+
+import exchange
+from atm_engine import ATMEngine, ExchangeUnavailableError, MINOR_UNITS
+from exchange import ExchangeRates, RateTableError, exchange_rates, parse_rates, revaluation_total, revalue_accounts
+from sql_query import SQLatm
+
+
+def write_rates(path, usd: str, eur: str = '100', stamp: int = 0) -> None:
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'base': 'RUB', 'rates': {'RUB': '1', 'USD': usd, 'EUR': eur}}, file)
+    # Время изменения задается явно: два файла за одну миллисекунду отличались бы только размером
+    os.utime(path, ns=(stamp, stamp))
+
+
+@pytest.fixture
+def rates(tmp_path):
+    path = str(tmp_path / 'rates.json')
+    write_rates(path, '92.5', stamp=1)
+    exchange_rates.configure(path, check_interval=0)
+    yield path
+    exchange_rates.configure('rates.json')
+
+
+@pytest.mark.parametrize('text', [
+    'not json',
+    '{"base": "RUB", "rates": {"RUB": "1", "USD": "92.5"}}',
+    '{"base": "RUB", "rates": {"RUB": "1", "USD": "-1", "EUR": "100"}}',
+    '{"base": "USD", "rates": {"RUB": "1", "USD": "92.5", "EUR": "100"}}',
+])
+def test_invalid_rate_files(text):
+    with pytest.raises(RateTableError):
+        parse_rates(text)
+
+
+def test_convert_rounds_in_favour_of_bank():
+    table = parse_rates('{"base": "RUB", "rates": {"RUB": "1", "USD": "3", "EUR": "100"}}')
+    assert table.rate('USD', 'RUB') == Decimal(3)
+    assert table.convert(10, 'RUB', 'USD') == 3
+    assert table.convert(10, 'RUB', 'USD', round_up=True) == 4
+    assert table.convert(MINOR_UNITS, 'USD', 'RUB') == 3 * MINOR_UNITS
+
+
+def test_hot_swap_keeps_taken_table(rates):
+    table = exchange_rates.current()
+    write_rates(rates, '95', stamp=2)
+    assert exchange_rates.current().rates['USD'] == Decimal(95)
+    assert table.rates['USD'] == Decimal('92.5')  # Таблица, взятая операцией, не меняется
+
+    with open(rates, 'w', encoding='utf-8') as file:
+        file.write('{"base": "RUB"')
+    os.utime(rates, ns=(3, 3))
+    assert exchange_rates.current().rates['USD'] == Decimal(95)
+    assert exchange_rates.last_error != None
+
+
+def test_missing_file_disables_exchange(db_path, tmp_path):
+    exchange_rates.configure(str(tmp_path / 'missing.json'), check_interval=0)
+    with pytest.raises(ExchangeUnavailableError):
+        ATMEngine.transfer_exchange(1000, 1001, 'RUB', 'USD', MINOR_UNITS)
+    exchange_rates.configure('rates.json')
+
+
+def test_check_interval_limits_file_checks(tmp_path):
+    path = str(tmp_path / 'rates.json')
+    write_rates(path, '92.5', stamp=1)
+    rates = ExchangeRates(path, check_interval=3600)
+    assert rates.current().rates['USD'] == Decimal('92.5')
+    write_rates(path, '95', stamp=2)
+    assert rates.current().rates['USD'] == Decimal('92.5')
+
+
+def test_transfer_exchange(db_path, rates):
+    SQLatm.insert_users_bulk([(1000, 1111, 1000, None, None), (1001, 2222, None, 0, None)])
+    result = ATMEngine.transfer_exchange(1000, 1001, 'RUB', 'USD', 100 * MINOR_UNITS)
+    assert result.to_amount == 100 * MINOR_UNITS * 10 // 925  # 1.081 USD, округление вниз
+    assert ATMEngine.get_balance(1000)['RUB'] == 900 * MINOR_UNITS
+    assert ATMEngine.get_balance(1001)['USD'] == result.to_amount
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_revaluation(db_path, rates, monkeypatch, vectorized):
+    if not vectorized:
+        monkeypatch.setattr(exchange, 'np', None)
+    elif exchange.np == None:
+        pytest.skip('numpy не установлен')
+    SQLatm.insert_users_bulk([(card_number, 1111, card_number, card_number % 7 or None, 1 if card_number % 2 else None)
+                              for card_number in range(1000, 1250)])
+    for chunk_size in (1, 2, 7, 64):  # Счета одной карты попадают на границу пачки
+        estimates = {}
+        for cards, values in revalue_accounts('RUB', chunk_size=chunk_size):
+            assert not set(int(card) for card in cards) & set(estimates)
+            estimates.update(zip((int(card) for card in cards), (int(value) for value in values)))
+        assert len(estimates) == 250
+        assert estimates[1003] == (1003 + 2 * 92.5 + 100) * MINOR_UNITS
+        assert estimates[1008] == 1008 * MINOR_UNITS
+        assert abs(sum(estimates.values()) - revaluation_total('RUB')) <= 250
@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from sql_query import SQLatm
+
+
+@pytest.fixture
+def cards(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 1000, None, None), (1001, 2222, 0, None, None)])
+    return 1000, 1001
+
+
+def test_operations_are_journaled(cards):
+    card, recipient = cards
+    ATMEngine.deposit(card, 'RUB', 100 * MINOR_UNITS)
+    ATMEngine.withdraw(card, 'RUB', 50 * MINOR_UNITS)
+    ATMEngine.transfer(card, recipient, 'RUB', 25 * MINOR_UNITS)
+    page = ATMEngine.get_history(card)
+    assert [(entry.kind, entry.amount, entry.balance, entry.counterparty) for entry in page.entries] == [
+        ('deposit', 100 * MINOR_UNITS, 1100 * MINOR_UNITS, None),
+        ('withdraw', -50 * MINOR_UNITS, 1050 * MINOR_UNITS, None),
+        ('transfer_out', -25 * MINOR_UNITS, 1025 * MINOR_UNITS, recipient),
+    ]
+    assert page.next_since == None
+    assert [(entry.kind, entry.balance) for entry in ATMEngine.get_history(recipient).entries] == [
+        ('transfer_in', 25 * MINOR_UNITS)]
+
+
+def test_failed_operation_is_not_journaled(cards):
+    card, _ = cards
+    with pytest.raises(Exception):
+        ATMEngine.withdraw(card, 'RUB', 5000 * MINOR_UNITS)
+    assert ATMEngine.get_history(card).entries == []
+
+
+def test_pages_cover_history_once(cards):
+    card, _ = cards
+    for _ in range(23):
+        ATMEngine.deposit(card, 'RUB', 10 * MINOR_UNITS)
+    seen = []
+    since = None
+    while True:
+        page = ATMEngine.get_history(card, since, limit=5)
+        seen.extend(page.entries)
+        if page.next_since == None:
+            break
+        since = page.next_since
+    assert len(seen) == 23 and len({entry.tx_id for entry in seen}) == 23
+    assert [entry.balance for entry in seen] == [(1000 + 10 * i) * MINOR_UNITS for i in range(1, 24)]
+    # Время в микросекундах - записи не раньше него
+    assert ATMEngine.get_history(card, seen[10].ts).entries[0].ts == seen[10].ts
+
+
+def test_journal_is_append_only(db_path, cards):
+    ATMEngine.deposit(cards[0], 'RUB', 100 * MINOR_UNITS)
+    db = sqlite3.connect(db_path)
+    with pytest.raises(sqlite3.IntegrityError, match='append-only'):
+        db.execute('UPDATE Transactions SET Amount = 0;')
+    with pytest.raises(sqlite3.IntegrityError, match='append-only'):
+        db.execute('DELETE FROM Transactions;')
+    db.close()
@@ -0,0 +1,99 @@
+import pytest
+
+import limits
+from limits import Limiter, LimitRules
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1_700_000_000.0)
+    monkeypatch.setattr(limits, 'time', clock)
+    return clock
+
+
+def make_limiter(**rules) -> Limiter:
+    return Limiter(LimitRules(**{'card_burst': 100, 'terminal_burst': 100, **rules}), enabled=True)
+
+
+def test_disabled_limiter_allows_everything(clock):
+    limiter = Limiter(LimitRules(card_burst=0, daily_withdraw={'RUB': 0}))
+    assert limiter.withdraw(1000, 1, 'RUB', 100) == None
+    assert limiter.pin_allowed(1)
+
+
+def test_terminal_bucket_burst_and_refill(clock):
+    limiter = make_limiter(terminal_burst=3, terminal_rate=0.5)
+    assert [limiter.withdraw(1000 + i, 'peer:10.0.0.1', 'RUB', 100) for i in range(3)] == [None] * 3
+    assert 'банкомате' in limiter.withdraw(1003, 'peer:10.0.0.1', 'RUB', 100)
+    assert limiter.withdraw(1003, 'peer:10.0.0.2', 'RUB', 100) == None  # Другой терминал - своя корзина
+    clock.now += 1.9
+    assert limiter.withdraw(1004, 'peer:10.0.0.1', 'RUB', 100) != None
+    clock.now += 0.1
+    assert limiter.withdraw(1004, 'peer:10.0.0.1', 'RUB', 100) == None
+
+
+def test_card_bucket_ignores_missing_terminal(clock):
+    limiter = make_limiter(card_burst=2, card_rate=1 / 30)
+    assert limiter.withdraw(1000, None, 'RUB', 100) == None
+    assert limiter.withdraw(1000, None, 'RUB', 100) == None
+    assert 'по карте' in limiter.withdraw(1000, None, 'RUB', 100)
+    assert limiter.withdraw(1001, None, 'RUB', 100) == None
+    clock.now += 30
+    assert limiter.withdraw(1000, None, 'RUB', 100) == None
+
+
+def test_daily_window_and_refund(clock):
+    limiter = make_limiter(daily_withdraw={'RUB': 1000})
+    assert limiter.withdraw(1000, 1, 'RUB', 600) == None
+    assert 'доступно еще 400 RUB' in limiter.withdraw(1000, 1, 'RUB', 500)
+    limiter.refund_withdraw(1000, 'RUB', 600)
+    assert limiter.withdraw(1000, 1, 'RUB', 1000) == None
+    assert limiter.withdraw(1000, 1, 'USD', 10 ** 6) == None  # Лимита в валюте нет
+    clock.now += 23 * 3600
+    assert limiter.withdraw(1000, 1, 'RUB', 1) != None
+    clock.now += 3600
+    assert limiter.withdraw(1000, 1, 'RUB', 1000) == None
+
+
+def test_rejected_withdraw_takes_no_tokens(clock):
+    limiter = make_limiter(terminal_burst=1, card_burst=1, daily_withdraw={'RUB': 1000})
+    # Отказ по суточному лимиту и по частоте карты не расходует токен терминала
+    assert 'суточный лимит' in limiter.withdraw(1000, 1, 'RUB', 5000)
+    assert limiter.withdraw(1000, 2, 'RUB', 100) == None
+    assert 'по карте' in limiter.withdraw(1000, 1, 'RUB', 100)
+    # Отказ по частоте терминала не расходует ни токен, ни суточный лимит карты
+    assert limiter.withdraw(1001, 1, 'RUB', 1000) == None
+    assert 'банкомате' in limiter.withdraw(1002, 1, 'RUB', 1000)
+    assert limiter.withdraw(1002, 3, 'RUB', 1000) == None
+
+
+def test_pin_bucket(clock):
+    limiter = make_limiter(pin_burst=2, pin_rate=1 / 60)
+    for _ in range(2):
+        assert limiter.pin_allowed('peer:unix')
+        limiter.pin_failed('peer:unix')
+    assert not limiter.pin_allowed('peer:unix')
+    assert limiter.pin_allowed(None)
+    clock.now += 60
+    assert limiter.pin_allowed('peer:unix')
+
+
+def test_snapshot_round_trip(clock, tmp_path):
+    path = str(tmp_path / 'limits.json')
+    limiter = make_limiter(terminal_burst=1, daily_withdraw={'RUB': 1000})
+    assert limiter.withdraw(1000, 'peer:127.0.0.1', 'RUB', 700) == None
+    limiter.save(path)
+
+    restored = make_limiter(terminal_burst=1, daily_withdraw={'RUB': 1000})
+    restored.load(path)
+    assert restored.snapshot() == limiter.snapshot()
+    assert restored.withdraw(1001, 'peer:127.0.0.1', 'RUB', 1) != None
+    assert 'доступно еще 300 RUB' in restored.withdraw(1000, 5, 'RUB', 400)
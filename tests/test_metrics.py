@@ -0,0 +1,42 @@
+import random
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from metrics import EXPORT_OCTAVES, Histogram, Metrics
+from sql_query import SQLatm
+
+
+def test_le_buckets_include_bound():
+    rnd = random.Random(1)
+    values = [2 ** octave + delta for octave in range(0, 40) for delta in (-1, 0, 1)]
+    values += [rnd.randrange(1, 2 ** 38) for _ in range(2000)]
+    histogram = Histogram()
+    for value in values:
+        histogram.record(value)
+    assert histogram.total == sum(values)
+    for octave in range(0, 38):
+        bound = 2 ** octave
+        assert histogram.count_le(bound) == sum(value <= bound for value in values), bound
+
+
+def test_render_counts_operations(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 1000, None, None)])
+    metrics = Metrics()
+    metrics.configure(enabled=True)
+    try:
+        for _ in range(3):
+            ATMEngine.deposit(1000, 'RUB', 10 * MINOR_UNITS)
+        try:
+            ATMEngine.withdraw(1000, 'RUB', 5000 * MINOR_UNITS)
+        except Exception:
+            pass
+    finally:
+        metrics.configure(enabled=False)
+    ATMEngine.deposit(1000, 'RUB', 10 * MINOR_UNITS)  # Исходные функции вернулись - не считается
+
+    lines = metrics.render().splitlines()
+    assert 'sqlatm_operation_seconds_count{operation="deposit"} 3' in lines
+    assert 'sqlatm_errors_total{operation="withdraw",error="InsufficientFundsError"} 1' in lines
+    buckets = [int(line.rsplit(' ', 1)[1]) for line in lines
+               if line.startswith('sqlatm_operation_seconds_bucket{operation="deposit"')]
+    assert len(buckets) == len(EXPORT_OCTAVES) + 1
+    assert buckets == sorted(buckets) and buckets[-1] == 3  # Корзины le накопительные
@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+
+from atm_engine import ATMEngine, MINOR_UNITS
+from migrations import BASELINE_VERSION, MIGRATIONS, MigrationError, current_version, migrate
+from sql_query import SQLatm
+
+
+# Users_data версии 0 - до миграций: балансы FLOAT
+LEGACY_USERS = '''
+    CREATE TABLE Users_data
+    (
+        UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Card_number INTEGER NOT NULL,
+        Pin_code INTEGER NOT NULL,
+        Pin_remaining_tries INTEGER NOT NULL DEFAULT 3,
+        Status VARCHAR(255) NOT NULL DEFAULT 'open',
+        Balance_RUB FLOAT,
+        Balance_USD FLOAT,
+        Balance_EUR FLOAT
+    );
+'''
+LEGACY_ROWS = [
+    (1000, 1111, 3, 'open', 100.5, None, None),
+    (1001, 2222, 1, 'open', 0.0001, 12.34, None),
+    (1002, 3333, 0, 'blocked', None, None, 999999999.9999),
+    (1003, 4444, 3, 'open', 0.1 + 0.2, 0.0, 1e-05),  # Хвосты FLOAT округляются до 4 знаков
+]
+
+
+def legacy_db(path: str, rows: list = LEGACY_ROWS) -> None:
+    db = sqlite3.connect(path)
+    with db:
+        db.execute(LEGACY_USERS)
+        db.executemany('''
+            INSERT INTO Users_data (Card_number, Pin_code, Pin_remaining_tries, Status,
+                                    Balance_RUB, Balance_USD, Balance_EUR)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+        ''', rows)
+    db.close()
+
+
+def schema(db: sqlite3.Connection) -> dict:
+    '''Столбцы таблиц и состав индексов, без текста DDL: он у разных путей создания отличается пробелами'''
+    result = {}
+    for kind, name in db.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%';"):
+        pragma = 'table_info' if kind == 'table' else 'index_xinfo' if kind == 'index' else None
+        result[name] = (kind, pragma and db.execute(f'PRAGMA {pragma}({name});').fetchall())
+    return result
+
+
+def test_legacy_rows_survive_all_migrations(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    legacy_db(path)
+    SQLatm.configure_db(path)
+    SQLatm.create_table()
+
+    db = sqlite3.connect(path)
+    assert current_version(db) == MIGRATIONS[-1][0]
+    accounts = set(db.execute('SELECT Card_number, Currency, Balance FROM Accounts;'))
+    assert accounts == {(card_number, currency, round(balance * MINOR_UNITS))
+                        for card_number, _, _, _, *balances in LEGACY_ROWS
+                        for currency, balance in zip(('RUB', 'USD', 'EUR'), balances) if balance != None}
+    assert set(db.execute('SELECT Card_number, Pin_code, Pin_remaining_tries, Status FROM Users_data;')) == {
+        row[:4] for row in LEGACY_ROWS}
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("INSERT INTO Users_data (Card_number, Pin_code) VALUES (1000, 1);")
+    db.close()
+
+    # Пин-код еще не перехэширован: вход по открытому пин-коду, баланс - из Accounts
+    session = ATMEngine.authenticate(1000, '1111')
+    assert session.balance == {'RUB': 1_005_000}
+
+
+def test_duplicate_cards_stop_migration(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    legacy_db(path, LEGACY_ROWS + [(1000, 9999, 3, 'open', 1.0, None, None)])
+    db = sqlite3.connect(path)
+    with pytest.raises(MigrationError, match='1000'):
+        migrate(db)
+    assert current_version(db) == 0
+    assert db.execute('SELECT COUNT(*) FROM Users_data;').fetchone()[0] == len(LEGACY_ROWS) + 1
+    db.close()
+
+
+def test_new_database_matches_migrated_legacy_schema(tmp_path):
+    legacy_db(str(tmp_path / 'legacy.db'))
+    legacy = sqlite3.connect(tmp_path / 'legacy.db')
+    fresh = sqlite3.connect(tmp_path / 'fresh.db')
+    migrate(legacy)
+    # Новая база не перестраивает Users_data старых версий: сразу базовая схема и миграции после нее
+    applied = migrate(fresh)
+    assert applied[0] == BASELINE_VERSION and all(version > BASELINE_VERSION for version in applied[1:])
+    assert current_version(fresh) == current_version(legacy)
+    assert schema(fresh) == schema(legacy)
+    assert migrate(fresh) == [] and migrate(legacy) == []
+    legacy.close()
+    fresh.close()
+
+
+def test_bulk_insert_skips_existing_cards(db_path):
+    report = SQLatm.insert_users_bulk([(1000, 1111, 10, None, None), (1000, 2222, 20, None, None)])
+    assert report['inserted'] == 1 and len(report['errors']) == 1
@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from atm_engine import ATMEngine, WrongPinError
+from pin_hash import PinHasher, iterations_of, pin_hasher, rehash_pins
+from sql_query import SQLatm
+
+
+def stored(db_path: str, card_number: int) -> tuple:
+    db = sqlite3.connect(db_path)
+    row = db.execute('SELECT Pin_code, Pin_hash FROM Users_data WHERE Card_number = ?;', (card_number,)).fetchone()
+    db.close()
+    return row
+
+
+def test_hash_and_verify():
+    hasher = PinHasher(iterations=1000)
+    first, second = hasher.hash('1111'), hasher.hash('1111')
+    assert first != second  # Соль у каждого хэша своя
+    assert first.startswith('pbkdf2_sha256$1000$') and iterations_of(first) == 1000
+    assert hasher.verify('1111', first) and hasher.verify('1111', second)
+    assert not hasher.verify('1112', first)
+    assert '1111' not in first
+
+
+def test_verify_cache_keeps_only_correct_pins():
+    hasher = PinHasher(iterations=1000)
+    pin_hash = hasher.hash('1111')
+    assert hasher.verify('1111', pin_hash) and hasher.verify('1111', pin_hash)
+    assert (hasher.verifications, hasher.cache_hits) == (1, 1)
+    assert not hasher.verify('0000', pin_hash) and not hasher.verify('0000', pin_hash)
+    assert (hasher.verifications, hasher.cache_hits) == (3, 1)
+
+
+def test_process_pool_hashes():
+    hasher = PinHasher(iterations=1000, workers=2)
+    try:
+        hashes = hasher.hash_many([str(pin) for pin in range(1000, 1010)])
+        assert all(hasher.verify(str(pin), pin_hash) for pin, pin_hash in zip(range(1000, 1010), hashes))
+    finally:
+        hasher.close()
+
+
+def test_new_cards_store_only_hash(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 100, None, None)])
+    pin_code, pin_hash = stored(db_path, 1000)
+    assert pin_code == None and pin_hasher.verify('1111', pin_hash)
+
+
+def test_login_rehashes_with_new_cost(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 100, None, None)])
+    pin_hasher.configure(2000)
+    ATMEngine.authenticate(1000, '1111')
+    assert iterations_of(stored(db_path, 1000)[1]) == 2000
+    with pytest.raises(WrongPinError):
+        ATMEngine.authenticate(1000, '2222')
+    assert iterations_of(stored(db_path, 1000)[1]) == 2000
+
+
+def test_plain_pins_are_rehashed_online(db_path):
+    # Карты, перенесенные миграцией 4: открытый пин-код, хэша еще нет
+    db = sqlite3.connect(db_path)
+    with db:
+        db.executemany('INSERT INTO Users_data (Card_number, Pin_code) VALUES (?, ?);',
+                       [(card_number, card_number + 1) for card_number in range(1000, 1012)])
+    db.close()
+
+    ATMEngine.authenticate(1000, '1001')  # Вход по открытому пин-коду сразу сохраняет хэш
+    assert stored(db_path, 1000)[0] == None
+    assert rehash_pins(batch_size=5) == 11
+    assert rehash_pins() == 0
+    for card_number in range(1000, 1012):
+        pin_code, pin_hash = stored(db_path, card_number)
+        assert pin_code == None and pin_hasher.verify(str(card_number + 1), pin_hash)
+    ATMEngine.authenticate(1011, '1012')
@@ -0,0 +1,64 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from atm_engine import ATMEngine, MINOR_UNITS, WrongPinError
+from reports import CurrencyTotal, DayTotal, daily_report, verify_report
+from sql_query import SQLatm
+
+
+@pytest.fixture
+def cards(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 1000, 10, None), (1001, 2222, 0, None, None), (1002, 3333, 500, 5, 7)])
+    return 1000, 1001, 1002
+
+
+def test_empty_database(db_path):
+    report = daily_report()
+    assert (report.cards, report.blocked_cards, report.pin_failed_cards) == (0, 0, 0)
+    assert report.currencies == {} and report.operations == []
+    assert verify_report() == []
+
+
+def test_totals_follow_operations(cards):
+    card, recipient, other = cards
+    ATMEngine.deposit(card, 'RUB', 100 * MINOR_UNITS)
+    ATMEngine.withdraw(card, 'RUB', 50 * MINOR_UNITS)
+    ATMEngine.withdraw(other, 'USD', 5 * MINOR_UNITS)
+    ATMEngine.transfer(card, recipient, 'RUB', 25 * MINOR_UNITS)
+    for _ in range(3):
+        with pytest.raises(Exception):
+            ATMEngine.authenticate(other, '0000')  # Третья ошибка блокирует карту
+    with pytest.raises(WrongPinError):
+        ATMEngine.authenticate(recipient, '0000')
+
+    report = daily_report()
+    assert (report.cards, report.blocked_cards, report.pin_failed_cards) == (3, 1, 2)
+    assert report.currencies == {
+        'EUR': CurrencyTotal(1, 7 * MINOR_UNITS),
+        'RUB': CurrencyTotal(3, 1550 * MINOR_UNITS),
+        'USD': CurrencyTotal(2, 10 * MINOR_UNITS),
+    }
+    assert report.operations == [
+        DayTotal('deposit', 'RUB', 1, 100 * MINOR_UNITS),
+        DayTotal('transfer_in', 'RUB', 1, 25 * MINOR_UNITS),
+        DayTotal('transfer_out', 'RUB', 1, -25 * MINOR_UNITS),
+        DayTotal('withdraw', 'RUB', 1, -50 * MINOR_UNITS),
+        DayTotal('withdraw', 'USD', 1, -5 * MINOR_UNITS),
+    ]
+    assert daily_report(report.day - timedelta(days=1)).operations == []
+    assert verify_report() == []
+
+
+def test_verify_finds_totals_changed_behind_triggers(db_path, cards):
+    ATMEngine.deposit(cards[0], 'RUB', 100 * MINOR_UNITS)
+    db = sqlite3.connect(db_path)
+    db.execute("UPDATE Currency_totals SET Balance = Balance + 1 WHERE Currency = 'RUB';")
+    db.execute('UPDATE Card_totals SET Cards = Cards + 1;')
+    db.commit()
+    db.close()
+    mismatches = verify_report()
+    assert len(mismatches) == 2
+    assert mismatches[0].startswith('cards:') and mismatches[1].startswith('RUB:')
+    assert verify_report(date(2000, 1, 1)) == mismatches  # Обороты другого дня совпадают
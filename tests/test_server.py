@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from atm_engine import ATMEngine
+from atm_server import ATMServer
+from sql_query import SQLatm
+
+
+def exchange(requests: list) -> list:
+    '''Запросы одного терминала по TCP к серверу на свободном порту. Возвращает ответы по порядку'''
+    async def run():
+        server = ATMServer(workers=2)
+        listener = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        responses = []
+        for request in requests:
+            line = request if isinstance(request, bytes) else json.dumps(request).encode()
+            writer.write(line + b'\n')
+            await writer.drain()
+            responses.append(json.loads(await reader.readline()))
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+        server.executor.shutdown()
+        return responses
+    return asyncio.run(run())
+
+
+def test_session_flow(db_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 1000, None, None), (1001, 2222, 0, None, None)])
+    responses = exchange([
+        {'op': 'balance'},
+        {'op': 'card', 'card': 9999},
+        {'op': 'pin', 'pin': '1111'},
+        {'op': 'card', 'card': 1000},
+        {'op': 'pin', 'pin': '0000'},
+        {'op': 'pin', 'pin': '1111'},
+        {'op': 'withdraw', 'currency': 'RUB', 'amount': 300},
+        {'op': 'deposit', 'currency': 'RUB', 'amount': 100},
+        {'op': 'transfer', 'to': 1001, 'currency': 'RUB', 'amount': '200.25'},
+        {'op': 'withdraw', 'currency': 'RUB', 'amount': 5000},
+        {'op': 'balance'},
+    ])
+    assert [response['ok'] for response in responses] == [False, True, False, True, False, True, True, True, True,
+                                                          False, True]
+    assert responses[0]['error'] == 'ProtocolError'
+    assert responses[2]['error'] == 'CardNotFoundError'  # Карта проверяется вместе с пин-кодом
+    assert responses[4]['error'] == 'WrongPinError' and responses[4]['tries_left'] == 2
+    assert responses[8]['amount'] == '200.25'
+    assert responses[9]['error'] == 'InsufficientFundsError'
+    assert responses[10]['balance']['RUB'] == '599.75'
+
+
+def test_bad_requests_keep_session_open(db_path):
+    responses = exchange([b'not json', b'[1, 2]', {'op': 'nope'}, {'op': 'card'}, {'op': 'card', 'card': 'x'}])
+    assert [response['error'] for response in responses] == ['ProtocolError'] * 5
+
+
+def test_storage_error_keeps_session_open(db_path, monkeypatch):
+    SQLatm.insert_users_bulk([(1000, 1111, 1000, None, None)])
+
+    def locked(card_number, pin, *terminal):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(ATMEngine, 'authenticate', locked)
+    responses = exchange([{'op': 'card', 'card': 1000}, {'op': 'pin', 'pin': '1111'}, {'op': 'balance'}])
+    assert responses[1] == {'ok': False, 'error': 'StorageError', 'message': 'database is locked'}
+    assert responses[2]['error'] == 'ProtocolError'
+
+
+def test_sigterm_stops_server(tmp_path):
+    path = str(tmp_path / 'atm.db')
+    snapshot = str(tmp_path / 'limits.json')
+    process = subprocess.Popen([sys.executable, '-u', 'atm_server.py', '--db', path, '--port', '0',
+                                '--limits-snapshot', snapshot],
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=subprocess.PIPE, text=True)
+    try:
+        assert process.stdout.readline().startswith('ATM server')
+        process.terminate()
+        assert process.wait(timeout=10) == 0
+    finally:
+        process.kill()
+        process.stdout.close()
+    assert os.path.exists(snapshot)  # Снимок лимитов сохранен при штатной остановке
+    # Сервер создал схему при старте
+    db = sqlite3.connect(path)
+    assert db.execute('PRAGMA user_version;').fetchone()[0] > 0
+    db.close()
@@ -0,0 +1,149 @@
+import logging
+import uuid
+
+import pytest
+
+from atm_engine import ATMEngine, CashUnavailableError, InsufficientFundsError, MINOR_UNITS
+from balance_cache import balance_cache
+from cash import cassettes, load_cassettes
+from db_pool import all_pools, close_all, get_pool
+import shards
+from shards import ShardMap
+from sql_query import SQLatm
+
+
+CARDS = range(1000, 1040)
+
+
+@pytest.fixture
+def shard_map(tmp_path):
+    map_path = str(tmp_path / 'shards.json')
+    ShardMap([f'atm-{i}.db' for i in range(2)], 'hash').save(map_path)
+    shards.configure(map_path, recover=False)
+    SQLatm.insert_users_bulk([(card, 1111, 1000, None, None) for card in CARDS])
+    yield ShardMap.load(map_path)
+    close_all()
+    balance_cache.clear()
+
+
+def cross_pair(shard_map: ShardMap) -> tuple:
+    return next((a, b) for a in CARDS for b in CARDS if shard_map.shard_of(a) != shard_map.shard_of(b))
+
+
+def total() -> int:
+    return sum(pool.connection().execute('SELECT COALESCE(SUM(Balance), 0) FROM Accounts;').fetchone()[0]
+               for pool in all_pools())
+
+
+def pending() -> int:
+    return sum(pool.connection().execute(
+        "SELECT COUNT(*) FROM Outgoing_transfers WHERE State = 'pending';").fetchone()[0] for pool in all_pools())
+
+
+def withdrawal_states() -> list:
+    return get_pool().connection().execute('SELECT State FROM Cash_withdrawals ORDER BY Ts;').fetchall()
+
+
+def test_cross_shard_transfer(shard_map):
+    sender, recipient = cross_pair(shard_map)
+    before = total()
+    result = ATMEngine.transfer(sender, recipient, 'RUB', 10 * MINOR_UNITS)
+    assert result.balance == 990 * MINOR_UNITS
+    assert ATMEngine.get_balance(recipient) == {'RUB': 1010 * MINOR_UNITS}
+    assert total() == before and pending() == 0
+
+
+def test_recover_after_crash_between_steps(shard_map):
+    sender, recipient = cross_pair(shard_map)
+    before = total()
+    # Процесс упал после списания: деньги висят в Outgoing_transfers отправителя
+    get_pool(sender).run_in_transaction(ATMEngine._send_transfer, uuid.uuid4().hex, sender, recipient,
+                                        'RUB', 7 * MINOR_UNITS, 'RUB', 7 * MINOR_UNITS)
+    assert total() == before - 7 * MINOR_UNITS and pending() == 1
+
+    assert ATMEngine.recover_transfers(min_age=0) == 1
+    assert total() == before and pending() == 0
+    assert ATMEngine.get_balance(recipient) == {'RUB': 1007 * MINOR_UNITS}
+    assert ATMEngine.recover_transfers(min_age=0) == 0
+
+
+def test_refund_when_recipient_account_disappears(shard_map):
+    sender, recipient = cross_pair(shard_map)
+    get_pool(sender).run_in_transaction(ATMEngine._send_transfer, uuid.uuid4().hex, sender, recipient,
+                                        'RUB', 3 * MINOR_UNITS, 'RUB', 3 * MINOR_UNITS)
+    with get_pool(recipient).connection() as db:
+        db.execute("DELETE FROM Accounts WHERE Card_number = ? AND Currency = 'RUB';", (recipient,))
+
+    assert ATMEngine.recover_transfers(min_age=0) == 1
+    assert ATMEngine.get_balance(sender) == {'RUB': 1000 * MINOR_UNITS}
+    assert [entry.kind for entry in ATMEngine.get_history(sender).entries][-2:] == ['transfer_out', 'transfer_refund']
+    assert pending() == 0
+    # Повтор шага 2 не зачисляет: отказ записан в Incoming_transfers получателя
+    assert ATMEngine.recover_transfers(min_age=0) == 0
+
+
+def test_failed_refund_does_not_stop_recovery(shard_map, caplog):
+    senders = [card for card in CARDS if shard_map.shard_of(card) == 0][:2]
+    recipients = [card for card in CARDS if shard_map.shard_of(card) == 1][:2]
+    transfer_ids = [uuid.uuid4().hex for _ in senders]
+    for transfer_id, sender, recipient in zip(transfer_ids, senders, recipients):
+        get_pool(sender).run_in_transaction(ATMEngine._send_transfer, transfer_id, sender, recipient,
+                                            'RUB', 5 * MINOR_UNITS, 'RUB', 5 * MINOR_UNITS)
+    # Первый перевод получатель отклонит, а вернуть деньги некуда: счета отправителя тоже нет
+    with get_pool(recipients[0]).connection() as db:
+        db.execute("DELETE FROM Accounts WHERE Card_number = ? AND Currency = 'RUB';", (recipients[0],))
+    with get_pool(senders[0]).connection() as db:
+        db.execute("DELETE FROM Accounts WHERE Card_number = ? AND Currency = 'RUB';", (senders[0],))
+
+    with caplog.at_level(logging.ERROR, logger='atm_engine'):
+        assert ATMEngine.recover_transfers(min_age=0) == 1
+    assert transfer_ids[0] in caplog.text and 'AccountNotFoundError' in caplog.text
+    assert ATMEngine.get_balance(recipients[1]) == {'RUB': 1005 * MINOR_UNITS}
+    assert pending() == 1
+
+    # Счет восстановлен вручную - следующий проход возвращает деньги
+    with get_pool(senders[0]).connection() as db:
+        db.execute("INSERT INTO Accounts (Card_number, Currency, Balance) VALUES (?, 'RUB', 0);", (senders[0],))
+    assert ATMEngine.recover_transfers(min_age=0) == 1
+    assert ATMEngine.get_balance(senders[0]) == {'RUB': 5 * MINOR_UNITS}
+    assert pending() == 0
+
+
+def test_withdraw_from_other_shard(shard_map):
+    card = next(card for card in CARDS if shard_map.shard_of(card) != 0)
+    load_cassettes(1, 'RUB', {1000: 5, 500: 5})
+    result = ATMEngine.withdraw(card, 'RUB', 500 * MINOR_UNITS, atm_id=1)
+    assert result.notes == {500: 1} and result.balance == 500 * MINOR_UNITS
+    assert cassettes(1) == {'RUB': {1000: 5, 500: 4}}
+
+    # Списание не прошло - купюры возвращаются в кассеты
+    with pytest.raises(InsufficientFundsError):
+        ATMEngine.withdraw(card, 'RUB', 1000 * MINOR_UNITS, atm_id=1)
+    assert cassettes(1) == {'RUB': {1000: 5, 500: 4}}
+    assert ATMEngine.get_balance(card) == {'RUB': 500 * MINOR_UNITS}
+    assert withdrawal_states() == [('done',), ('returned',)]
+
+
+def test_recover_withdrawal_after_crash_between_steps(shard_map):
+    first, second = [card for card in CARDS if shard_map.shard_of(card) != 0][:2]
+    load_cassettes(1, 'RUB', {1000: 5})
+    # Процесс упал после выдачи купюр из кассет, до списания: выдача отменяется, купюры возвращаются
+    cancelled = uuid.uuid4().hex
+    get_pool().run_in_transaction(ATMEngine._take_withdrawal_notes, cancelled, 1, first, 'RUB', 1000 * MINOR_UNITS)
+    # Процесс упал после списания, до завершения: выдача завершается, купюры выданы
+    debited = uuid.uuid4().hex
+    get_pool().run_in_transaction(ATMEngine._take_withdrawal_notes, debited, 1, second, 'RUB', 1000 * MINOR_UNITS)
+    get_pool(second).run_in_transaction(ATMEngine._debit_withdrawal, debited, second, 'RUB', 1000 * MINOR_UNITS)
+    assert cassettes(1) == {'RUB': {1000: 3}} and withdrawal_states() == [('pending',), ('pending',)]
+
+    assert ATMEngine.recover_transfers(min_age=0) == 2
+    assert withdrawal_states() == [('returned',), ('done',)]
+    assert cassettes(1) == {'RUB': {1000: 4}}
+    assert ATMEngine.get_balance(first) == {'RUB': 1000 * MINOR_UNITS}
+    assert ATMEngine.get_balance(second) == {'RUB': 0}
+    assert ATMEngine.recover_transfers(min_age=0) == 0
+
+    # Запоздавшее списание отмененной выдачи не проходит
+    with pytest.raises(CashUnavailableError):
+        get_pool(first).run_in_transaction(ATMEngine._debit_withdrawal, cancelled, first, 'RUB', 1000 * MINOR_UNITS)
+    assert ATMEngine.get_balance(first) == {'RUB': 1000 * MINOR_UNITS}
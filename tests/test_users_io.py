@@ -0,0 +1,91 @@
+import csv
+import gzip
+import sqlite3
+from decimal import Decimal
+
+import pytest
+
+from atm_engine import ATMEngine, MINOR_UNITS, WrongPinError
+from sql_query import SQLatm
+from users_io import UsersFileError, detect_format, export_users, import_users, read_users
+
+
+USERS = [(card_number, 1000 + card_number % 9000, Decimal(f'{card_number}.0105'), card_number % 3 or None, None)
+         for card_number in range(1000, 1300)]
+
+
+def reopen(path: str) -> None:
+    SQLatm.configure_db(path, concurrent=True)
+    SQLatm.create_table()
+
+
+@pytest.mark.parametrize('name', ['users.csv', 'users.csv.gz', 'users.jsonl', 'users.jsonl.gz'])
+def test_round_trip(db_path, tmp_path, name):
+    SQLatm.insert_users_bulk(USERS)
+    with pytest.raises(WrongPinError):
+        ATMEngine.authenticate(1001, '0000')  # Состояние карты тоже переносится: осталось 2 попытки
+    snapshot = list(read_users(chunk_size=7))
+    path = str(tmp_path / name)
+    assert export_users(path, chunk_size=7) == len(USERS)
+    if name.endswith('.gz'):
+        with gzip.open(path) as file:
+            assert file.read(1)
+
+    reopen(str(tmp_path / 'copy.db'))
+    report = import_users(path, chunk_size=7)
+    assert report == {'rows': len(USERS), 'inserted': len(USERS), 'failed': 0, 'errors': []}
+    assert list(read_users(chunk_size=7)) == snapshot
+    assert ATMEngine.get_balance(1004) == {'RUB': 10_040_105, 'USD': 2 * MINOR_UNITS}
+    ATMEngine.authenticate(1004, '2004')
+
+
+def test_export_hashes_plain_pins(db_path, tmp_path):
+    SQLatm.insert_users_bulk(USERS[:3])
+    # Карта из старой базы: пин-код еще открытый, перехэшируется только при входе
+    db = sqlite3.connect(db_path)
+    with db:
+        db.execute('UPDATE Users_data SET Pin_code = 4321, Pin_hash = NULL WHERE Card_number = 1000;')
+    db.close()
+    path = tmp_path / 'users.csv'
+    export_users(str(path))
+    with open(path, newline='', encoding='utf-8') as file:
+        rows = list(csv.DictReader(file))
+    assert 'Pin_code' not in rows[0] and '4321' not in path.read_text(encoding='utf-8')
+    assert all(row['Pin_hash'] for row in rows)
+
+    reopen(str(tmp_path / 'copy.db'))
+    assert import_users(str(path))['inserted'] == 3
+    assert ATMEngine.authenticate(1000, '4321').card_number == 1000
+
+
+def test_import_reports_bad_rows(db_path, tmp_path):
+    SQLatm.insert_users_bulk([(1000, 1111, 1, None, None)])
+    path = tmp_path / 'users.csv'
+    path.write_text('Card_number,Pin_code,Balance_RUB,Status\n'
+                    '1000,1111,1,\n'  # Уже есть в базе
+                    '1001,1111,1.5,\n'
+                    '1001,2222,2,\n'  # Дубликат в файле
+                    '1002,11,1,\n'  # Короткий пин-код
+                    '1003,1111,-1,\n'
+                    '1004,1111,1,frozen\n'
+                    '1005,1111,,blocked\n', encoding='utf-8')
+    report = import_users(str(path), chunk_size=3)
+    assert (report['rows'], report['inserted'], report['failed']) == (7, 2, 5)
+    assert [row_number for row_number, _, _ in sorted(report['errors'])] == [1, 3, 4, 5, 6]
+    assert ATMEngine.get_balance(1001) == {'RUB': 15_000}
+    assert ATMEngine.get_balance(1005) == {}
+
+
+def test_unparsed_jsonl_lines(db_path, tmp_path):
+    path = tmp_path / 'users.jsonl'
+    path.write_text('{"Card_number": 1000, "Pin_code": 1111, "Balance_USD": 2.5}\nnot json\n[1]\n', encoding='utf-8')
+    report = import_users(str(path))
+    assert (report['inserted'], report['failed']) == (1, 2)
+    assert ATMEngine.get_balance(1000) == {'USD': 25_000}
+
+
+def test_detect_format():
+    assert detect_format('a.CSV.gz') == ('csv', True)
+    assert detect_format('a.ndjson') == ('jsonl', False)
+    with pytest.raises(UsersFileError):
+        detect_format('a.xlsx')
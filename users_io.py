@@ -0,0 +1,263 @@
+'''Потоковая выгрузка и загрузка пользователей со счетами.
+
+Формат файла - по расширению: .csv или .jsonl, с добавлением .gz - сжатый gzip. Строка файла -
+одна карта: Card_number, Pin_hash, Pin_remaining_tries, Status и Balance_<валюта> для каждой
+валюты CURRENCIES (пусто - счета нет). Выгрузка переносит хэш пин-кода и состояние карты как есть,
+открытых пин-кодов в ней нет: карты, которые еще не перехэшированы при входе, получают хэш при
+выгрузке. Для загрузки начальных данных достаточно Card_number, открытого Pin_code и балансов -
+пин-код хэшируется при загрузке.
+
+Обе команды - конвейеры генераторов: в памяти одновременно одна пачка строк, поэтому размер
+файла не ограничен. Каждые несколько секунд выводится прогресс и скорость.
+    python users_io.py export snapshot.csv.gz [--db atm.db | --shards shards.json] [--chunk 5000]
+    python users_io.py import snapshot.csv.gz [--db atm.db | --shards shards.json] [--chunk 5000]
+'''
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import time
+from decimal import Decimal
+from itertools import groupby, islice
+
+from atm_engine import format_amount
+from balance_cache import balance_cache
+from currencies import CURRENCIES
+from db_pool import all_pools, close_all
+from pin_hash import pin_hasher
+from queries import QUERIES
+import shards
+from sql_query import SQLatm, csv_value, insert_users_chunk
+
+
+# Столбцы выгрузки. Загрузка читает еще Pin_code - открытый пин-код начальных данных
+COLUMNS = ('Card_number', 'Pin_hash', 'Pin_remaining_tries', 'Status',
+           *(f'Balance_{currency}' for currency in CURRENCIES))
+MAX_REPORTED_ERRORS = 1000  # Остальные ошибки только считаются, иначе отчет растет вместе с файлом
+GZIP_LEVEL = 6  # Заметно быстрее уровня 9 по умолчанию при почти том же размере
+
+
+class UsersFileError(Exception):
+    '''Файл нельзя прочитать как выгрузку пользователей'''
+
+
+def detect_format(path: str) -> tuple:
+    '''(формат, сжат ли файл) по расширению'''
+    name = path.lower()
+    compressed = name.endswith('.gz')
+    if compressed:
+        name = name[:-3]
+    for suffix, file_format in (('.csv', 'csv'), ('.jsonl', 'jsonl'), ('.ndjson', 'jsonl')):
+        if name.endswith(suffix):
+            return file_format, compressed
+    raise UsersFileError(f'Неизвестный формат файла {path}: ожидается .csv или .jsonl, можно с .gz')
+
+
+def _open(raw, mode: str, compressed: bool):
+    '''Текстовый поток поверх файла raw. Позиция raw - прочитанные или записанные байты на диске'''
+    if compressed:
+        raw = gzip.GzipFile(fileobj=raw, mode=mode, compresslevel=GZIP_LEVEL)
+    return io.TextIOWrapper(raw, encoding='utf-8', newline='')
+
+
+class Progress:
+    '''Вывод прогресса не чаще раза в every секунд: строк, доля файла, строк/с, МБ/с'''
+
+    def __init__(self, title: str, raw, total_bytes: int | None = None, every: float = 5.0):
+        self.title = title
+        self.raw = raw
+        self.total_bytes = total_bytes
+        self.every = every
+        self.started = time.perf_counter()
+        self._next = self.started + every
+
+    def update(self, rows: int) -> None:
+        if time.perf_counter() >= self._next:
+            self._next = time.perf_counter() + self.every
+            self.print(rows)
+
+    def print(self, rows: int) -> None:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        size = self.raw.tell()
+        done = f', {size / self.total_bytes:.1%}' if self.total_bytes else ''
+        print(f'{self.title}: строк {rows}{done}, {size / 2 ** 20:.1f} МБ, '
+              f'{rows / elapsed:.0f} строк/с, {size / 2 ** 20 / elapsed:.1f} МБ/с')
+
+
+def _json_value(value, convert):
+    '''Число из JSON остается как есть, строка разбирается как ячейка CSV'''
+    return csv_value(value, convert) if isinstance(value, str) else value
+
+
+def read_records(file, file_format: str):
+    '''Генератор кортежей (номер строки, (card_number, pin_code, pin_hash, tries, status, *balances)).
+    Строка, которую не удалось разобрать, приходит как (номер строки, None)'''
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        if reader.fieldnames == None or 'Card_number' not in reader.fieldnames:
+            raise UsersFileError('В заголовке CSV нет столбца Card_number')
+        rows = enumerate(reader, start=1)
+        convert = csv_value
+    else:
+        rows = ((line_number, _json_record(line)) for line_number, line in enumerate(file, start=1) if line.strip())
+        convert = _json_value
+    for row_number, row in rows:
+        if row == None:
+            yield row_number, None
+            continue
+        yield row_number, (
+            convert(row.get('Card_number'), int),
+            convert(row.get('Pin_code'), int),
+            row.get('Pin_hash') or None,
+            convert(row.get('Pin_remaining_tries'), int),
+            row.get('Status') or None,
+            *(convert(row.get(f'Balance_{currency}'), Decimal) for currency in CURRENCIES),
+        )
+
+
+def _json_record(line: str) -> dict | None:
+    try:
+        record = json.loads(line, parse_float=Decimal)  # Decimal - без потерь точности балансов
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def _add_error(report: dict, row_number: int, card_number, error: str) -> None:
+    report['failed'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append((row_number, card_number, error))
+
+
+def import_users(path: str, chunk_size: int = 5000, progress_every: float = 5.0) -> dict:
+    '''Загрузка пользователей из файла пачками по chunk_size строк, каждая пачка - одна транзакция.
+    Карты, которые уже есть в базе, пропускаются с ошибкой в отчете.
+    Возвращает отчет {'rows': строк, 'inserted': добавлено, 'failed': ошибок,
+    'errors': [(номер строки, номер карты, причина), ...] - первые MAX_REPORTED_ERRORS ошибок}'''
+    file_format, compressed = detect_format(path)
+    report = {'rows': 0, 'inserted': 0, 'failed': 0, 'errors': []}
+    with open(path, 'rb') as raw, _open(raw, 'rb', compressed) as file:
+        progress = Progress('Загрузка', raw, os.path.getsize(path), progress_every)
+        chunk = []
+        for row_number, record in read_records(file, file_format):
+            report['rows'] += 1
+            if record == None:
+                _add_error(report, row_number, None, 'строка не разобрана')
+                continue
+            chunk.append((row_number, record))
+            if len(chunk) >= chunk_size:
+                _import_chunk(chunk, report)
+                chunk = []
+                progress.update(report['rows'])
+        if chunk:
+            _import_chunk(chunk, report)
+        progress.print(report['rows'])
+    balance_cache.clear()
+    return report
+
+
+def _import_chunk(chunk: list, report: dict) -> None:
+    inserted, errors = insert_users_chunk(chunk)
+    report['inserted'] += inserted
+    for row_number, card_number, error in errors:
+        _add_error(report, row_number, card_number, error)
+
+
+def read_users(chunk_size: int = 5000):
+    '''Генератор строк выгрузки по COLUMNS, балансы - строки без потери точности.
+    Открытые пин-коды хэшируются пачками по chunk_size карт, в пуле процессов pin_hasher, если он есть.
+    При шардировании базы выгружаются по очереди, карты идут по возрастанию номера внутри шарда'''
+    for pool in all_pools():
+        yield from _read_pool_users(pool, chunk_size)
+
+
+def _read_pool_users(pool, chunk_size: int):
+    '''Один SELECT читает согласованный снимок базы: sqlite держит транзакцию чтения, пока запрос
+    не дочитан, а в WAL-режиме это не мешает банкомату писать. fetchmany держит в памяти одну пачку'''
+    db = pool.connection()
+    cur = db.execute(QUERIES['export_users'])  # Свой курсор: общий курсор db.query сбросит другой запрос
+
+    def rows():
+        while True:
+            batch = cur.fetchmany(chunk_size)
+            if not batch:
+                return
+            yield from batch
+
+    def cards():
+        # Счета карты идут подряд - собираем их в одну строку выгрузки
+        for (card_number, pin_code, pin_hash, tries, status), accounts in groupby(rows(), key=lambda row: row[:5]):
+            balance = {row[5]: row[6] for row in accounts if row[5] != None}
+            yield (card_number, pin_code, pin_hash, tries, status,
+                   *(format_amount(balance[currency]) if currency in balance else None
+                     for currency in CURRENCIES))
+
+    card_rows = cards()
+    while True:
+        batch = list(islice(card_rows, chunk_size))
+        if not batch:
+            return
+        plain = [row for row in batch if row[2] == None]
+        hashes = dict(zip((row[0] for row in plain), pin_hasher.hash_many([str(row[1]) for row in plain])))
+        for card_number, _, pin_hash, *rest in batch:
+            yield (card_number, pin_hash or hashes[card_number], *rest)
+
+
+def export_users(path: str, chunk_size: int = 5000, progress_every: float = 5.0) -> int:
+    '''Выгрузка всех пользователей со счетами в файл. Возвращает число выгруженных карт'''
+    file_format, compressed = detect_format(path)
+    count = 0
+    with open(path, 'wb') as raw, _open(raw, 'wb', compressed) as file:
+        progress = Progress('Выгрузка', raw, every=progress_every)
+        if file_format == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(COLUMNS)
+            write = writer.writerow
+        else:
+            write = lambda row: file.write(json.dumps(
+                {column: value for column, value in zip(COLUMNS, row) if value != None}) + '\n')
+        for row in read_users(chunk_size):
+            write(row)
+            count += 1
+            if count % chunk_size == 0:
+                progress.update(count)
+        file.flush()
+        progress.print(count)
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Выгрузка и загрузка пользователей: .csv или .jsonl, можно с .gz')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('path')
+    parser.add_argument('--db', default='atm.db')
+    parser.add_argument('--shards', help='карта шардов (shards.py) вместо одной базы --db')
+    parser.add_argument('--chunk', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='процессов хэширования пин-кодов')
+    args = parser.parse_args()
+
+    if args.shards != None:
+        shards.configure(args.shards, recover=False)
+    else:
+        SQLatm.configure_db(args.db, concurrent=True)
+    SQLatm.create_table()  # Загрузка возможна и в новую базу
+    pin_hasher.configure(workers=args.workers)
+    try:
+        if args.command == 'export':
+            print(f'{args.path}: выгружено карт: {export_users(args.path, args.chunk)}')
+            return
+        report = import_users(args.path, args.chunk)
+        print(f'{args.path}: строк {report["rows"]}, добавлено {report["inserted"]}, ошибок {report["failed"]}')
+        for row_number, card_number, error in report['errors']:
+            print(f'  строка {row_number}: карта {card_number} - {error}')
+    except UsersFileError as error:
+        print(f'ОШИБКА. {error}')
+    finally:
+        pin_hasher.close()
+        close_all()
+
+
+if __name__ == '__main__':
+    main()